@@ -1,344 +1,1886 @@
 __author__ = 'hunt3r'
 
-from pymongo import GEO2D
+from pymongo import GEO2D, GEOSPHERE
+from collections import OrderedDict
 import json
 from bson.objectid import ObjectId
 from bson.timestamp import Timestamp
+from bson import json_util
 import json.encoder
 import datetime, time
-import jsonschema
+from jsonschema.validators import validator_for
+from caesium.metrics import get_metrics_sink
+from caesium.storage import get_storage_backend, spherical_distance, _compare
+import numbers
 from json import JSONEncoder
 import logging
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from tornado.concurrent import Future
 from tornado.gen import Return, coroutine
+from tornado.ioloop import IOLoop
 import copy
+import functools
+import hashlib
+import math
+import os
+import socket
+import uuid
+import zlib
 
 """
 Base document module is a place to put base model object functionality
 """
 
-class AsyncRevisionStackManager(object):
+METERS_PER_UNIT = {
+    "miles": 1609.344,
+    "kilometers": 1000.0,
+    "meters": 1.0
+}
 
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
 
-    """Find revisions for any document type and action the revision"""
+def _geohash_cell(lng, lat, precision):
+    """Find the geohash tile a point falls in
 
-    def __init__(self, settings):
-        """
-        Constructor
+    :param float lng: Longitude
+    :param float lat: Latitude
+    :param int precision: The number of geohash characters, 5 is a tile of about 5km
+    :returns: The geohash and the tile bounds as (min lng, min lat, max lng, max lat)
+    :rtype: tuple
+    """
+    lng_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        interval, value = (lng_range, lng) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
 
-        :param dict settings: The applications settings, typically it is self.settings in a handler
-        """
-        self.logger = logging.getLogger(self.__class__.__name__)
-        self.settings = settings
-        self.client = settings.get("db")
-        assert self.client is not None
+        even = not even
+        bit_count += 1
 
-    @coroutine
-    def publish(self):
-        """
-        Iterate over the scheduler collections and apply any actions found
-        """
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash), (lng_range[0], lat_range[0], lng_range[1], lat_range[1])
+
+def _location_coordinates(location):
+    """Get the [lng, lat] pair of a location stored as a legacy pair or a GeoJSON point
+
+    :param location: The location attribute of a document
+    :returns: The pair, or None if it isn't a location
+    :rtype: list
+    """
+    if isinstance(location, dict):
+        location = location.get("coordinates")
+
+    if isinstance(location, (list, tuple)) and len(location) == 2 \
+            and all(isinstance(value, numbers.Number) for value in location):
+        return location
+
+    return None
+
+def group_documents_by(documents, attr, valueLabel="value", childrenLabel="children"):
+    """
+    Group documents that are already loaded by the value of an attribute, in a single pass.  Groups are in the
+    order their value is first seen, see BaseAsyncMotorDocument.group_by to group in mongo instead.
+
+    :param list documents: A list of dictionary objects
+    :param str attr: The attribute that the dictionaries should be grouped upon
+    :param str valueLabel: What to call the key of the field we're grouping upon
+    :param str childrenLabel: What to call the list of child objects on the group object
+    :returns: list of grouped objects by a given attribute
+    :rtype: list
+    """
+    groups = OrderedDict()
+
+    for document in documents:
+        value = document.get(attr)
 
         try:
-             for collection in self.settings.get("scheduler").get("collections"):
-                yield self.publish_for_collection(collection)
-        except Exception as ex:
-            self.logger.error(ex)
+            key = hash(value), value
+        except TypeError:
+            #Lists and sub documents can't be hashed, their json is used instead
+            key = None, json.dumps(value, sort_keys=True, cls=BSONEncoder)
 
-    @coroutine
-    def set_all_revisions_to_in_process(self, ids):
-        """
-        Set all revisions found to in process, so that other threads will not pick them up.
+        if key not in groups:
+            groups[key] = {"attribute": attr, valueLabel: value, childrenLabel: []}
 
-        :param list ids:
-        """
+        groups[key][childrenLabel].append(document)
 
-        predicate = {
-            "_id" : {
-                "$in" : [ ObjectId(id) for id in ids ]
-            }
-        }
+    return list(groups.values())
 
-        set = {"$set": { "inProcess": True }}
+class OperationTimings(object):
+    """The durations and counts of the document operations made while handling one request, see
+    BaseAsyncMotorDocument.with_timings
+    """
 
-        yield self.revisions.collection.update(predicate, set, multi=True)
+    def __init__(self):
+        """Constructor"""
+        self.operations = OrderedDict()
 
+    def record(self, name, seconds):
+        """Add the duration of an operation
 
-    @coroutine
-    def __get_pending_revisions(self):
+        :param str name: The operation, ie find
+        :param float seconds: How long it took
         """
-        Get all the pending revisions after the current time
+        if name not in self.operations:
+            self.operations[name] = [0, 0.0]
 
-        :return: A list of revisions
-        :rtype: list
+        self.operations[name][0] += 1
+        self.operations[name][1] += seconds
+
+    def to_dict(self):
+        """The count and total milliseconds of every operation
 
+        :rtype: dict
         """
-        dttime = time.mktime(datetime.datetime.now().timetuple())
-        changes = yield self.revisions.find({
-            "toa" : {
-                "$lt" : dttime,
-            },
-            "processed": False,
-            "inProcess": None
-        })
-        if len(changes) > 0:
-            yield self.set_all_revisions_to_in_process([change.get("id") for change in changes])
+        return OrderedDict((name, {"count": count, "duration_ms": round(seconds * 1000, 3)})
+                           for name, (count, seconds) in self.operations.items())
 
-        raise Return(changes)
+    def server_timing(self):
+        """The operations formatted for a Server-Timing response header
 
-    @coroutine
-    def publish_for_collection(self, collection_name):
+        :rtype: str
         """
-        Run the publishing operations for a given collection
+        return ", ".join('%s;dur=%.3f;desc="%s calls"' % (name, seconds * 1000, count)
+                         for name, (count, seconds) in self.operations.items())
 
-        :param str collection_name:
-        """
-        self.revisions = BaseAsyncMotorDocument("%s_revisions" % collection_name, self.settings)
+class SlowOperationLog(object):
+    """Collects the document operations that took longer than a threshold, by query shape.
 
-        changes = yield self.__get_pending_revisions()
+    The shape of a query is the query with its literal values replaced, so {"sku": "123", "qty": {"$gt": 2}} and
+    {"sku": "456", "qty": {"$gt": 9}} add up in the same statistics.  Every slow operation is also logged on the
+    caesium.slow logger.
+    """
 
-        if len(changes) > 0:
+    THRESHOLD_IN_MILLISECONDS = 100
+    MAX_SHAPES = 500
+    MAX_HANDLERS = 10
 
-            self.logger.info("%s revisions will be actioned" % len(changes))
+    def __init__(self, threshold_in_milliseconds=None, max_shapes=None):
+        """
+        Constructor
 
-            for change in changes:
-                try:
-                    self.logger.info("Applying %s action %s - %s to document: %s/%s" % (change.get("action"), change.get("id"), change.get("meta",{}).get("comment", "No Comment"), change.get("collection"), change.get("master_id")))
+        :param int threshold_in_milliseconds: Operations taking at least this long are recorded
+        :param int max_shapes: The number of shapes kept, the least recently seen are dropped first
+        """
+        self.threshold = (threshold_in_milliseconds if threshold_in_milliseconds is not None
+                          else self.THRESHOLD_IN_MILLISECONDS) / 1000.0
+        self.max_shapes = max_shapes or self.MAX_SHAPES
+        self.shapes = OrderedDict()
+        self.logger = logging.getLogger("caesium.slow")
 
-                    stack = AsyncSchedulableDocumentRevisionStack(
-                        change.get("collection"),
-                        self.settings,
-                        master_id=change.get("master_id")
-                    )
+        #The slow_operations settings the log was built from, see BaseAsyncMotorDocument.get_slow_log
+        self.config = None
 
-                    revision = yield stack.pop()
+    @classmethod
+    def shape(cls, query):
+        """Remove the literal values of a query, keeping its fields and operators
 
-                    self.logger.debug(revision)
+        :param query: A query, or any value in one
+        :returns: The shape
+        """
+        if isinstance(query, dict):
+            return OrderedDict((key, cls.shape(query[key])) for key in sorted(query))
 
-                except Exception as ex:
-                    self.logger.error(ex)
+        if isinstance(query, (list, tuple)) and any(isinstance(item, dict) for item in query):
+            return [cls.shape(item) for item in query]
 
-class AsyncSchedulableDocumentRevisionStack(object):
-    """This class manages a stack of revisions for a given document in a given collection"""
-    SCHEMA = {
-        "title":"Schedulable Revision Document",
-        "type": "object",
-        "required": ["toa", "processed", "collection", "master_id", "action", "patch"],
-        "properties" : {
-            "toa" : {
-                "type": "number",
-            },
-            "processed": {
-                "type": "boolean",
-            },
-            "collection": {
-                "type": "string",
-            },
-            "master_id": {
-                "type": "string",
-            },
-            "action": {
-                "type": "string",
-            },
-            "patch": {
-                "type": ["object", "null"],
-            },
-            "snapshot": {
-                "type": "object"
-            },
-            "meta": {
-                "type": "object"
-            }
+        return "?"
+
+    def record(self, collection_name, operation, query, seconds, documents=None, handler=None):
+        """Record an operation if it is slow
 
+        :param str collection_name: The collection
+        :param str operation: find, update, insert or remove
+        :param dict query: The query, or the document for an insert
+        :param float seconds: How long it took
+        :param int documents: The number of documents returned or written
+        :param str handler: The handler that made the operation
+        """
+        if seconds < self.threshold:
+            return
+
+        shape = json.dumps(self.shape(query or {}))
+        key = (collection_name, operation, shape)
+
+        stats = self.shapes.pop(key, None) or {
+            "collection": collection_name,
+            "operation": operation,
+            "shape": shape,
+            "count": 0,
+            "total_ms": 0.0,
+            "max_ms": 0.0,
+            "documents": 0,
+            "handlers": []
         }
-    }
 
-    DELETE_ACTION = "delete"
-    UPDATE_ACTION = "update"
-    INSERT_ACTION = "insert"
+        milliseconds = seconds * 1000
+        stats["count"] += 1
+        stats["total_ms"] += milliseconds
+        stats["max_ms"] = max(stats["max_ms"], milliseconds)
+        stats["documents"] += documents or 0
+        stats["last_seen"] = time.time()
 
+        if handler and handler not in stats["handlers"] and len(stats["handlers"]) < self.MAX_HANDLERS:
+            stats["handlers"].append(handler)
 
-    def __init__(self, collection_name, settings, collection_schema=None, master_id=None):
-        """
-        Constructor
+        self.shapes[key] = stats
 
-        :param str collection: The collection you want revision documents on
-        :param dict settings: The application settings
-        :param dict collection_schema: This is a JSON Schema dictionary to describe the expected object for that type
-        :param str master_id: The Master ID for this set of revisions
-        """
-        self.master_id=master_id
-        self.logger = logging.getLogger(self.__class__.__name__)
-        self.settings = settings
-        self.client = self.settings.get("db")
-        assert self.client is not None
-        self.revisions = []
-        self.collection_name = collection_name
-        self.collection = BaseAsyncMotorDocument(collection_name, self.settings, schema=collection_schema)
-        self.revisions = BaseAsyncMotorDocument("%s_revisions" % collection_name, self.settings, schema=self.SCHEMA)
-        self.previews = BaseAsyncMotorDocument("previews", self.settings)
+        while len(self.shapes) > self.max_shapes:
+            self.shapes.popitem(last=False)
 
-    @coroutine
-    def __update_action(self, revision):
-        """Update a master document and revision history document
+        self.logger.warning(json.dumps({
+            "collection": collection_name,
+            "operation": operation,
+            "shape": shape,
+            "duration_ms": round(milliseconds, 3),
+            "documents": documents,
+            "handler": handler
+        }))
 
-        :param dict revision: The revision dictionary
+    def top(self, n=10, by="total_ms"):
+        """The shapes that cost the most
+
+        :param int n: The number of shapes
+        :param str by: What to rank them by, total_ms, max_ms or count
+        :rtype: list
         """
+        ranked = sorted(self.shapes.values(), key=lambda stats: stats[by], reverse=True)[:n]
+        return [dict(stats, mean_ms=stats["total_ms"] / stats["count"]) for stats in ranked]
 
-        patch = revision.get("patch")
-        if patch.get("_id"):
-            del patch["_id"]
+    def clear(self):
+        """Forget every shape"""
+        self.shapes.clear()
 
-        update_response = yield self.collection.patch(revision.get("master_id"), self.__make_storeable_patch_patchable(patch))
+def _documents_in(result):
+    """The number of documents an operation returned or wrote, from its result"""
+    if isinstance(result, list):
+        return len(result)
 
-        if update_response.get("n") == 0:
-            raise RevisionNotFoundException()
+    if isinstance(result, dict) and "n" in result:
+        return result.get("n")
 
-    @coroutine
-    def __insert_action(self, revision):
-        """
-        Handle the insert action type.
+    return 0 if result is None else 1
 
-        Creates new document to be created in this collection.
-        This allows you to stage a creation of an object
+def _argument(name, position):
+    """For _timed, get the query of an operation from one of its arguments
 
-        :param dict revision: The revision dictionary
+    :param str name: The argument name
+    :param int position: The argument position, not counting self
+    """
+    def query(args, kwargs):
+        return args[position] if len(args) > position else kwargs.get(name)
 
-        """
+    return query
 
-        revision["patch"]["_id"] = ObjectId(revision.get("master_id"))
+def _predicate(name=None, position=None):
+    """For _timed, get the query of an operation by id or by the attribute named in one of its arguments
 
-        insert_response = yield self.collection.insert(revision.get("patch"))
+    :param str name: The name of the attribute argument, None for operations by id
+    :param int position: The attribute argument position, not counting self
+    """
+    def query(args, kwargs):
+        attribute = "_id"
 
-        if not isinstance(insert_response, str):
-            raise DocumentRevisionInsertFailed()
+        if name is not None:
+            attribute = args[position] if len(args) > position else kwargs.get(name, "_id")
 
-    @coroutine
-    def __delete_action(self, revision):
-        """
-        Handle a delete action to a partiular master id via the revision.
+        return {attribute: "?"}
 
-        :param dict revision:
-        :return:
-        """
-        delete_response = yield self.collection.delete(revision.get("master_id"))
-        if delete_response.get("n") == 0:
-            raise DocumentRevisionDeleteFailed()
+    return query
 
-    @coroutine
-    def pop(self):
-        """Pop the top revision off the stack back onto the collection at the given id. This method applies the action.
+def _timed(name, operation=None, query=None):
+    """Decorate a coroutine method of BaseAsyncMotorDocument to record its duration in the client's timings, its
+    metrics, and in its slow operation log when it is one of the monitored operations.
+    Clients without any of them only pay for three attribute checks.
 
-        Note: This assumes you don't have two revisions scheduled closer than a single scheduling cycle.
+    :param str name: The operation name to record
+    :param str operation: The operation for the slow operation log, find, update, insert or remove
+    :param query: A function of the method's args and kwargs that returns its query for the slow operation log
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.timings is None and self.slow_log is None and self.metrics is None:
+                return method(self, *args, **kwargs)
 
-        """
-        revisions = yield self.list()
+            timings = self.timings
+            metrics = self.metrics
+            slow_log = self.slow_log if operation else None
+            started = time.time()
+            future = method(self, *args, **kwargs)
 
-        if len(revisions) > 0:
-            revision = revisions[0]
+            def done(future):
+                seconds = time.time() - started
+                failed = future.exception() is not None
 
-            # Update type action
-            if revision.get("action") == self.UPDATE_ACTION:
-                try:
-                    yield self.__update_action(revision)
-                except Exception as ex:
-                    self.logger.error(ex)
+                if timings is not None:
+                    timings.record(name, seconds)
 
-            # Insert type update
-            if revision.get("action") == self.INSERT_ACTION:
-                try:
-                    yield self.__insert_action(revision)
-                except Exception as ex:
-                    self.logger.error(ex)
+                if metrics is not None:
+                    tags = {"collection": self.collection_name, "operation": name}
+                    metrics.increment("document_operations_total", tags=tags)
+                    metrics.observe("document_operation_seconds", seconds, tags)
 
-            #Get the updated object for attachment to the snapshot
-            snapshot_object = yield self.collection.find_one_by_id(revision.get("master_id"))
+                    if failed:
+                        metrics.increment("document_errors_total", tags=tags)
+                    elif operation == "find":
+                        metrics.increment("document_documents_returned_total", _documents_in(future.result()), tags)
 
-            #Handle delete action here
-            if revision.get("action") == self.DELETE_ACTION:
-                try:
-                    yield self.__delete_action(revision)
-                except Exception as ex:
-                    self.logger.error(ex)
+                if slow_log is not None and seconds >= slow_log.threshold:
+                    documents = _documents_in(future.result()) if not failed else 0
+                    slow_log.record(self.collection_name, operation, query(args, kwargs), seconds,
+                                    documents=documents, handler=self.handler)
 
-                snapshot_object = None
+            #Done callbacks may run after the caller resumed, record finished operations straight away
+            if future.done():
+                done(future)
+            else:
+                future.add_done_callback(done)
 
-            #Update the revision to be in a post-process state including snapshot
-            revision_update_response = yield self.revisions.patch(revision.get("id"),
-                {
-                    "processed" : True,
-                    "snapshot" : snapshot_object,
-                    "inProcess": False
-                }
-            )
+            return future
 
-            if revision_update_response.get("n") == 0:
-                raise RevisionUpdateFailed(msg="revision document update failed")
+        return wrapper
 
-            revision = yield self.revisions.find_one_by_id(revision.get("id"))
+    return decorator
 
-            #TODO: Make this callback method something that can be passed in.  This was used in
-            #the original implementation to send back to the client via websocket
-            #revision_success.send('revision_success', type="RevisionSuccess", data=revision)
+def _sleep(seconds):
+    """Non-blocking sleep for coroutines, used by background jobs to throttle themselves
 
-            raise Return(revision)
+    :param float seconds: How long to sleep for
+    """
+    future = Future()
+    IOLoop.current().add_timeout(time.time() + seconds, lambda: future.set_result(None))
+    return future
 
-        raise Return(None)
+class Revision(object):
+    """A compact record of the revision fields the scheduler needs, decoded straight from the BSON document.
 
-    def __make_patch_storeable(self, patch):
-        """Replace all dots with pipes in key names, mongo doesn't like to store keys with dots.
+    This is only used inside the AsyncRevisionStackManager, the public APIs return revision dictionaries.
+    """
 
-        :param dict patch: The patch that needs to be made storeable and applied in the future
+    __slots__ = ("id", "toa", "collection", "master_id", "action", "comment")
+
+    #The fields to read from a revision document
+    PROJECTION = {"toa": 1, "collection": 1, "master_id": 1, "action": 1, "meta.comment": 1}
+
+    def __init__(self, id, toa, collection, master_id, action, comment=None):
         """
-        new_patch = {}
-        for key in patch:
-            new_patch[key.replace(".", "|")] = patch[key]
+        Constructor
 
-        return new_patch
+        :param str id: The revision id
+        :param int toa: Time of action
+        :param str collection: The collection the revision applies to
+        :param str master_id: The master id the revision applies to
+        :param str action: The revision action
+        :param str comment: The comment from the revision meta data
+        """
+        self.id = id
+        self.toa = toa
+        self.collection = collection
+        self.master_id = master_id
+        self.action = action
+        self.comment = comment
+
+    @classmethod
+    def from_document(cls, document):
+        """Build a record from a revision document as returned by mongo
+
+        :param dict document: A revision document, at least with the PROJECTION fields
+        :rtype: Revision
+        """
+        return cls(document["_id"].__str__(),
+                   document.get("toa"),
+                   document.get("collection"),
+                   document.get("master_id"),
+                   document.get("action"),
+                   (document.get("meta") or {}).get("comment"))
 
-    def __make_storeable_patch_patchable(self, patch):
-        """Replace all pipes with dots, transform back into the a namespace path.
-        This is done before the $set query is applied to the document
+    def to_dict(self):
+        """Get the record as a revision dictionary
 
-        :param dict patch: The patch that is to be prepared to be applied
+        :rtype: dict
         """
+        return {
+            "id": self.id,
+            "toa": self.toa,
+            "collection": self.collection,
+            "master_id": self.master_id,
+            "action": self.action,
+            "meta": {"comment": self.comment}
+        }
 
-        new_patch = {}
-        for key in patch:
-            new_patch[key.replace("|", ".")] = patch[key]
+class AsyncSchedulerLease(object):
+    """A mongo backed lease that at most one process holds at a time.
 
-        return new_patch
+    Leases are documents in the settings["scheduler"]["leader_election"]["collection"] collection, named
+    "scheduler_leases" by default.  Acquiring a lease you already hold renews it, which is the heartbeat, and
+    a lease that isn't renewed within "lease_in_seconds" can be taken over by another process.
+    """
 
-    @coroutine
-    def push(self, patch=None, toa=None, meta=None):
-        """Push a change on to the revision stack for this ObjectId.  Pushing onto the stack is how you
-        get revisions to be staged and scheduled for some future time.
+    LEASE_IN_SECONDS = 30
+    COLLECTION = "scheduler_leases"
 
-        :param dict patch: None Denotes Delete
-        :param int toa: Time of action
-        :param dict meta: The meta data for this action
+    def __init__(self, settings, name, owner=None):
         """
+        Constructor
 
-        if not meta:
-            meta = {}
+        :param dict settings: The applications settings, typically it is self.settings in a handler
+        :param str name: The name of the lease, ie the collection the scheduler publishes
+        :param str owner: A unique name for the lease holder, defaults to one built from the host and process
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.settings = settings
+        config = settings.get("scheduler", {}).get("leader_election", {})
+        self.leases = BaseAsyncMotorDocument.shared(config.get("collection", self.COLLECTION), settings)
+        self.lease_in_seconds = config.get("lease_in_seconds", self.LEASE_IN_SECONDS)
+        self.name = name
+        self.expires_at = 0
+        self.pid = os.getpid() if owner else None
+        self.__owner = owner
+
+    @property
+    def owner(self):
+        """A unique name for this process, it is regenerated in forked children"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.__owner = "%s:%s:%s" % (socket.gethostname(), self.pid, uuid.uuid4().hex)
+            self.expires_at = 0
+
+        return self.__owner
+
+    @property
+    def held(self):
+        """Whether this process holds the lease, according to the last acquire"""
+        return self.expires_at > time.time()
 
-        if not toa:
-            toa = time.mktime(datetime.datetime.now().timetuple())
+    @coroutine
+    def acquire(self):
+        """Acquire the lease, or renew it when it is already held by this process
 
-        if not isinstance(toa, int):
-            toa = int(toa)
+        :returns: Whether this process holds the lease
+        :rtype: bool
+        """
+        owner = self.owner
+        now = time.time()
 
-        #Documents should be stored in bson formats
-        if isinstance(patch, dict):
-            patch = self.revisions._dictionary_to_cursor(patch)
+        try:
+            lease = yield self.leases.collection.find_and_modify({
+                "_id": self.name,
+                "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]
+            }, {
+                "$set": {"owner": owner, "expires_at": now + self.lease_in_seconds, "renewed_at": now}
+            }, upsert=True, new=True)
+        except OperationFailure as ex:
+            #The upsert collides with the lease document of the current holder
+            if not isinstance(ex, DuplicateKeyError) and "E11000" not in str(ex):
+                raise
+            lease = None
+
+        if lease and lease.get("owner") == owner:
+            if not self.held:
+                self.logger.info("%s took the %s lease" % (owner, self.name))
+            self.expires_at = now + self.lease_in_seconds
+        else:
+            self.expires_at = 0
 
-        action = None
+        raise Return(self.held)
 
-        if isinstance(patch, type(None)):
-            action = self.DELETE_ACTION
-        elif self.master_id and isinstance(patch, dict):
-            action = self.UPDATE_ACTION
-            patch = self.__make_patch_storeable(patch)
-            yield self._lazy_migration(meta=copy.deepcopy(meta), toa=toa-1)
+    @coroutine
+    def release(self):
+        """Give up the lease if this process holds it, so a standby process can take over right away"""
+        yield self.leases.collection.remove({"_id": self.name, "owner": self.owner})
+        self.expires_at = 0
+
+
+class AsyncRevisionStackManager(object):
+
+
+    """Find revisions for any document type and action the revision"""
+
+    def __init__(self, settings, partitions=None, owner=None):
+        """
+        Constructor
+
+        When settings["scheduler"]["leader_election"] is set, a collection is only published by the process
+        holding its AsyncSchedulerLease, the other processes stay on standby without querying revisions.
+
+        When settings["scheduler"]["partitions"] is set, revisions are split into that many partitions by a hash
+        of their master id, and each manager only scans the partitions it owns.  Pass partitions for a fixed
+        assignment, otherwise leader election is used to hold a fair share of partition leases, which are
+        rebalanced as managers join and leave.  All revisions of a master id are in the same partition, so
+        they are still applied in order.
+
+        :param dict settings: The applications settings, typically it is self.settings in a handler
+        :param list partitions: A fixed list of partition numbers for this manager to publish
+        :param str owner: A unique name for this manager in leases, defaults to one built from the host and process
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.settings = settings
+        self.storage = get_storage_backend(settings)
+        self.client = self.storage.database
+        self.indexed_collections = set()
+        self.partitions = partitions
+        self.owner = owner
+        self.owner_name = None
+        self.pid = None
+        self.leases = {}
+
+    def __owner(self):
+        """The name of this manager in leases, a new one after a fork since the parent's leases aren't ours
+
+        :rtype: str
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.owner_name = self.owner or "%s:%s:%s" % (socket.gethostname(), self.pid, uuid.uuid4().hex)
+            self.leases = {}
+
+        return self.owner_name
+
+    def __lease(self, name):
+        owner = self.__owner()
+
+        if name not in self.leases:
+            self.leases[name] = AsyncSchedulerLease(self.settings, name, owner=owner)
+
+        return self.leases[name]
+
+    @coroutine
+    def __owned_partitions(self, collection_name, partition_count):
+        """
+        Work out which partitions of a collection this manager publishes.  The live managers are counted
+        through membership leases, partition leases beyond a fair share are released and missing ones are
+        acquired, so partitions move between managers as they join and leave.
+
+        :param str collection_name:
+        :param int partition_count: The number of partitions
+        :returns: The partition numbers
+        :rtype: list
+        """
+        if self.partitions is not None:
+            raise Return(list(self.partitions))
+
+        if "leader_election" not in self.settings.get("scheduler"):
+            raise Return(list(range(partition_count)))
+
+        owner = self.__owner()
+        member = self.__lease("member:%s" % owner)
+        yield member.acquire()
+
+        members = yield member.leases.collection.find({
+            "_id": {"$regex": "^member:"},
+            "expires_at": {"$gt": time.time()}
+        }).count()
+
+        share = int(math.ceil(float(partition_count) / max(1, members)))
+        owned = []
+
+        for partition in range(partition_count):
+            lease = self.__lease("%s:%s" % (collection_name, partition))
+
+            if lease.held and len(owned) >= share:
+                yield lease.release()
+            elif lease.held:
+                renewed = yield lease.acquire()
+                if renewed:
+                    owned.append(partition)
+
+        #Start somewhere different from the other managers, so they don't all contend for the same partitions
+        offset = zlib.crc32(owner.encode("utf-8")) % partition_count
+
+        for step in range(partition_count):
+            if len(owned) >= share:
+                break
+
+            partition = (offset + step) % partition_count
+            if partition in owned:
+                continue
+
+            acquired = yield self.__lease("%s:%s" % (collection_name, partition)).acquire()
+            if acquired:
+                owned.append(partition)
+
+        raise Return(sorted(owned))
+
+    @coroutine
+    def publish(self):
+        """
+        Iterate over the scheduler collections and apply any actions found
+        """
+
+        try:
+             scheduler = self.settings.get("scheduler")
+
+             for collection in scheduler.get("collections"):
+                partitions = None
+
+                if scheduler.get("partitions") or self.partitions is not None:
+                    partitions = yield self.__owned_partitions(collection, scheduler.get("partitions", 1))
+                    if not partitions:
+                        continue
+
+                elif "leader_election" in scheduler:
+                    leader = yield self.__lease(collection).acquire()
+                    if not leader:
+                        continue
+
+                yield self.publish_for_collection(collection, partitions=partitions)
+        except Exception as ex:
+            self.logger.error(ex)
+
+    @coroutine
+    def heartbeat(self):
+        """
+        Renew the leases this process holds.  Run this more often than lease_in_seconds, ie from its own
+        PeriodicCallback, so a long publish run doesn't lose its lease.
+        """
+        try:
+            for lease in self.leases.values():
+                if lease.held:
+                    yield lease.acquire()
+        except Exception as ex:
+            self.logger.error(ex)
+
+    @coroutine
+    def step_down(self):
+        """
+        Release every lease this process holds, typically called when the process shuts down
+        """
+        for lease in self.leases.values():
+            if lease.held:
+                yield lease.release()
+
+    @coroutine
+    def set_all_revisions_to_in_process(self, ids):
+        """
+        Set all revisions found to in process, so that other threads will not pick them up.
+
+        Revisions another process claimed first are left alone, only the ones claimed here are returned.
+
+        :param list ids:
+        :returns: The ids of the revisions claimed by this call
+        :rtype: list
+        """
+
+        claim = uuid.uuid4().hex
+
+        predicate = {
+            "_id" : {
+                "$in" : [ ObjectId(id) for id in ids ]
+            },
+            "inProcess": None
+        }
+
+        set = {"$set": { "inProcess": True, "claim": claim, "claimed_at": time.time() }}
+
+        yield self.revisions.collection.update(predicate, set, multi=True)
+
+        #The _id index serves this, claim isn't indexed
+        cursor = self.revisions.collection.find(dict(predicate, inProcess=True, claim=claim), {"_id": 1})
+
+        claimed = []
+        while (yield cursor.fetch_next):
+            claimed.append(cursor.next_object()["_id"].__str__())
+
+        raise Return(claimed)
+
+    @coroutine
+    def release_claims(self, ids):
+        """
+        Return revisions this manager claimed but did not apply to the pending queue
+
+        :param list ids:
+        """
+        yield self.revisions.collection.update({
+            "_id": {"$in": [ObjectId(id) for id in ids]},
+            "processed": False
+        }, {
+            "$set": {"inProcess": None},
+            "$unset": {"claim": "", "claimed_at": ""}
+        }, multi=True)
+
+
+    @coroutine
+    def __get_due_revisions(self, collection_name, query):
+        """
+        Get the pending revisions through the due queue, so only due entries are scanned.  Entries whose revision
+        is gone or already processed are removed from the queue.
+
+        :param str collection_name:
+        :param dict query: The pending revisions query
+        :return: A list of revisions
+        :rtype: list
+        """
+        due = BaseAsyncMotorDocument.shared("%s_due" % collection_name, self.settings)
+
+        due_query = {"toa": query["toa"]}
+        if "$or" in query:
+            due_query["$or"] = query["$or"]
+
+        cursor = due.collection.find(due_query, {"_id": 1}).sort("toa", 1)
+
+        ids = []
+        while (yield cursor.fetch_next):
+            ids.append(cursor.next_object()["_id"])
+
+        if len(ids) == 0:
+            raise Return([])
+
+        cursor = self.revisions.collection.find({"_id": {"$in": ids}}, dict(Revision.PROJECTION, processed=1, inProcess=1))
+
+        changes = []
+        orphans = set(ids)
+        while (yield cursor.fetch_next):
+            revision = cursor.next_object()
+
+            if revision.get("processed"):
+                continue
+
+            orphans.discard(revision["_id"])
+
+            #Leave revisions claimed by another manager in the queue
+            if revision.get("inProcess") is None:
+                changes.append(Revision.from_document(revision))
+
+        if len(orphans) > 0:
+            yield due.collection.remove({"_id": {"$in": list(orphans)}})
+
+        raise Return(sorted(changes, key=lambda change: change.toa))
+
+    @coroutine
+    def __get_pending_revisions(self, collection_name, partitions=None):
+        """
+        Get all the pending revisions after the current time
+
+        :param str collection_name: The collection the revisions are for, used to label metrics
+        :param list partitions: Only get revisions in these partitions, None gets all of them
+        :return: A list of revisions
+        :rtype: list
+
+        """
+        dttime = time.mktime(datetime.datetime.now().timetuple())
+        query = {
+            "toa" : {
+                "$lt" : dttime,
+            },
+            "processed": False,
+            "inProcess": None
+        }
+
+        if partitions is not None:
+            query["$or"] = AsyncSchedulableDocumentRevisionStack.partition_predicates(
+                partitions, self.settings.get("scheduler", {}).get("partitions", 1))
+
+        if self.settings.get("scheduler", {}).get("due_queue", False):
+            changes = yield self.__get_due_revisions(collection_name, query)
+        else:
+            cursor = self.revisions.collection.find(query, Revision.PROJECTION).sort("toa", 1)
+
+            changes = []
+            while (yield cursor.fetch_next):
+                changes.append(Revision.from_document(cursor.next_object()))
+
+        metrics = get_metrics_sink(self.settings)
+        metrics.gauge("scheduler_backlog", len(changes), {"collection": collection_name})
+
+        if len(changes) > 0:
+            with metrics.timer("scheduler_phase_seconds", {"collection": collection_name, "phase": "claim"}):
+                claimed = yield self.set_all_revisions_to_in_process([change.id for change in changes])
+            claimed = set(claimed)
+            changes = [change for change in changes if change.id in claimed]
+
+        raise Return(changes)
+
+    @coroutine
+    def publish_for_collection(self, collection_name, partitions=None):
+        """
+        Run the publishing operations for a given collection
+
+        :param str collection_name:
+        :param list partitions: Only publish revisions in these partitions, None publishes all of them
+        """
+        self.revisions = BaseAsyncMotorDocument.shared("%s_revisions" % collection_name, self.settings)
+
+        if collection_name not in self.indexed_collections:
+            stack = AsyncSchedulableDocumentRevisionStack(collection_name, self.settings)
+            yield stack.ensure_indexes()
+
+            if stack.due_queue_enabled:
+                queued = yield stack.backfill_due_queue()
+                self.logger.info("%s pending revisions queued in %s_due" % (queued, collection_name))
+
+            if partitions is not None:
+                hashed = yield stack.backfill_partition_hashes()
+                self.logger.info("%s pending revisions of %s given a partition hash" % (hashed, collection_name))
+
+            self.indexed_collections.add(collection_name)
+
+        changes = yield self.__get_pending_revisions(collection_name, partitions)
+
+        if len(changes) > 0:
+
+            self.logger.info("%s revisions will be actioned" % len(changes))
+
+            skipped = []
+
+            for change in changes:
+                try:
+                    self.logger.info("Applying %s action %s - %s to document: %s/%s" % (change.action, change.id, change.comment or "No Comment", change.collection, change.master_id))
+
+                    stack = AsyncSchedulableDocumentRevisionStack(
+                        change.collection,
+                        self.settings,
+                        master_id=change.master_id
+                    )
+
+                    revision = yield stack.pop(revision_id=change.id)
+
+                    #An earlier revision of the master id is pending elsewhere, retry on the next run
+                    if revision is None:
+                        skipped.append(change.id)
+
+                    self.logger.debug(revision)
+
+                except Exception as ex:
+                    self.logger.error(ex)
+
+            if len(skipped) > 0:
+                self.logger.info("%s revisions are waiting on earlier revisions" % len(skipped))
+                yield self.release_claims(skipped)
+
+class AsyncRevisionCompactor(object):
+    """Move old processed revisions from <collection>_revisions to <collection>_revisions_archive.
+
+    This is meant to run alongside the AsyncRevisionStackManager, typically from a PeriodicCallback, and it
+    is configured with settings["scheduler"]["compaction"]::
+
+        {
+            "keep_last": 10,                    # processed revisions kept per master id, at least 1
+            "retention_in_seconds": 2592000,    # processed revisions newer than this are kept too
+            "batch_size": 100,                  # revisions moved per batch
+            "batch_delay_in_milliseconds": 250  # pause between batches
+        }
+
+    A keyframe that a kept delta encoded revision is based on is always kept.
+    """
+
+    BATCH_SIZE = 100
+    BATCH_DELAY_IN_MILLISECONDS = 250
+
+    def __init__(self, settings):
+        """
+        Constructor
+
+        :param dict settings: The applications settings, typically it is self.settings in a handler
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.settings = settings
+        self.storage = get_storage_backend(settings)
+        self.client = self.storage.database
+        self.running = False
+
+    @coroutine
+    def compact(self):
+        """
+        Iterate over the scheduler collections and archive old processed revisions
+        """
+        if self.running:
+            return
+
+        self.running = True
+
+        try:
+            for collection in self.settings.get("scheduler").get("collections"):
+                archived = yield self.compact_collection(collection)
+                self.logger.info("%s revisions archived for %s" % (archived, collection))
+        except Exception as ex:
+            self.logger.error(ex)
+        finally:
+            self.running = False
+
+    @coroutine
+    def __kept_ids(self, revisions, master_ids, keep_last):
+        """Get the ids of the processed revisions that have to stay for a set of master ids
+
+        :param BaseAsyncMotorDocument revisions: The revisions collection
+        :param set master_ids: The master ids to check
+        :param int keep_last: Number of processed revisions to keep per master id
+        :rtype: set
+        """
+        kept = set()
+
+        for master_id in master_ids:
+            cursor = revisions.collection.find({"master_id": master_id, "processed": True},
+                                               {"_id": 1, "snapshot_base": 1})
+            cursor.sort("toa", -1).limit(keep_last)
+
+            while (yield cursor.fetch_next):
+                revision = cursor.next_object()
+                kept.add(revision["_id"])
+
+                if revision.get("snapshot_base"):
+                    kept.add(ObjectId(revision["snapshot_base"]))
+
+        raise Return(kept)
+
+    @coroutine
+    def compact_collection(self, collection_name):
+        """
+        Archive the old processed revisions of a single collection, in batches
+
+        :param str collection_name:
+        :returns: The number of revisions archived
+        :rtype: int
+        """
+        config = self.settings.get("scheduler", {}).get("compaction", {})
+
+        if "keep_last" not in config and "retention_in_seconds" not in config:
+            self.logger.warning("No keep_last or retention_in_seconds compaction settings, nothing to compact")
+            raise Return(0)
+
+        keep_last = max(1, config.get("keep_last", 1))
+        batch_size = config.get("batch_size", self.BATCH_SIZE)
+        delay = config.get("batch_delay_in_milliseconds", self.BATCH_DELAY_IN_MILLISECONDS) / 1000.0
+
+        revisions = BaseAsyncMotorDocument.shared("%s_revisions" % collection_name, self.settings)
+        archive = BaseAsyncMotorDocument.shared("%s_revisions_archive" % collection_name, self.settings)
+
+        predicate = {"processed": True}
+
+        if config.get("retention_in_seconds"):
+            now = time.mktime(datetime.datetime.now().timetuple())
+            predicate["toa"] = {"$lt": now - config.get("retention_in_seconds")}
+
+        archived = 0
+
+        while True:
+            cursor = revisions.collection.find(predicate).sort("_id", 1).limit(batch_size)
+
+            batch = []
+            while (yield cursor.fetch_next):
+                batch.append(cursor.next_object())
+
+            if len(batch) == 0:
+                break
+
+            predicate["_id"] = {"$gt": batch[-1]["_id"]}
+
+            kept = yield self.__kept_ids(revisions, set(revision.get("master_id") for revision in batch), keep_last)
+            expired = [revision for revision in batch if revision["_id"] not in kept]
+
+            if len(expired) > 0:
+                try:
+                    yield archive.collection.insert(expired, continue_on_error=True)
+                except DuplicateKeyError:
+                    #Already archived by a run that was interrupted before removing them
+                    pass
+
+                yield revisions.collection.remove({"_id": {"$in": [revision["_id"] for revision in expired]}})
+                archived += len(expired)
+
+            if len(batch) < batch_size:
+                break
+
+            yield _sleep(delay)
+
+        raise Return(archived)
+
+class AsyncStaleRevisionReaper(object):
+    """Return revisions claimed by a scheduler that died to the pending queue.
+
+    The manager marks the revisions it claims as in process with a claimed_at timestamp, a claim older than
+    the timeout is considered abandoned.  Claims without a claimed_at were made by a scheduler that doesn't record
+    it, ie an older version during a rolling deploy, the reaper stamps them when it first sees them so they expire
+    a timeout later.  Run this from a PeriodicCallback next to the manager, it is configured with
+    settings["scheduler"]["reaper"]::
+
+        {
+            "claim_timeout_in_seconds": 300,    # age of a claim before it is reclaimed
+            "batch_size": 100,                  # revisions reclaimed per batch
+            "batch_delay_in_milliseconds": 250  # pause between batches
+        }
+
+    pop renews the claim before it applies a revision and before it stores the snapshot, so a claim only expires
+    while it waits in a publish run or when a single phase runs longer than the timeout.  The timeout has to be
+    longer than a publish run can take, or revisions may be applied twice.
+    """
+
+    CLAIM_TIMEOUT_IN_SECONDS = 300
+    BATCH_SIZE = 100
+    BATCH_DELAY_IN_MILLISECONDS = 250
+
+    def __init__(self, settings):
+        """
+        Constructor
+
+        :param dict settings: The applications settings, typically it is self.settings in a handler
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.settings = settings
+        self.storage = get_storage_backend(settings)
+        self.client = self.storage.database
+        self.running = False
+
+    @coroutine
+    def reap(self):
+        """
+        Iterate over the scheduler collections and reclaim expired claims
+        """
+        if self.running:
+            return
+
+        self.running = True
+
+        try:
+            for collection in self.settings.get("scheduler").get("collections"):
+                reclaimed = yield self.reap_collection(collection)
+                if reclaimed > 0:
+                    self.logger.warning("%s abandoned revisions reclaimed for %s" % (reclaimed, collection))
+        except Exception as ex:
+            self.logger.error(ex)
+        finally:
+            self.running = False
+
+    @coroutine
+    def reap_collection(self, collection_name):
+        """
+        Reclaim the expired claims of a single collection, in batches
+
+        :param str collection_name:
+        :returns: The number of revisions reclaimed
+        :rtype: int
+        """
+        config = self.settings.get("scheduler", {}).get("reaper", {})
+        timeout = config.get("claim_timeout_in_seconds", self.CLAIM_TIMEOUT_IN_SECONDS)
+        batch_size = config.get("batch_size", self.BATCH_SIZE)
+        delay = config.get("batch_delay_in_milliseconds", self.BATCH_DELAY_IN_MILLISECONDS) / 1000.0
+
+        revisions = BaseAsyncMotorDocument.shared("%s_revisions" % collection_name, self.settings)
+        metrics = get_metrics_sink(self.settings)
+
+        #Start the clock on untimed claims, they may still be live
+        yield revisions.collection.update(
+            {"processed": False, "inProcess": True, "claimed_at": {"$exists": False}},
+            {"$set": {"claimed_at": time.time()}},
+            multi=True
+        )
+
+        predicate = {
+            "processed": False,
+            "inProcess": True,
+            "claimed_at": {"$lt": time.time() - timeout}
+        }
+
+        reclaimed = 0
+
+        while True:
+            cursor = revisions.collection.find(predicate, {"_id": 1}).limit(batch_size)
+
+            ids = []
+            while (yield cursor.fetch_next):
+                ids.append(cursor.next_object()["_id"])
+
+            if len(ids) == 0:
+                break
+
+            #Repeat the predicate, a revision finished since the find must stay processed
+            batch_predicate = dict(predicate, _id={"$in": ids})
+            response = yield revisions.collection.update(batch_predicate, {
+                "$set": {"inProcess": None},
+                "$unset": {"claim": "", "claimed_at": ""}
+            }, multi=True)
+
+            count = response.get("n", 0)
+            reclaimed += count
+            metrics.increment("scheduler_reclaimed_total", count, {"collection": collection_name})
+
+            if len(ids) < batch_size:
+                break
+
+            yield _sleep(delay)
+
+        raise Return(reclaimed)
+
+class SchemaValidatorRegistry(object):
+    """A process wide registry of compiled JSON schema validators.
+
+    jsonschema.validate checks the schema and builds a new validator on every call, the registry does that
+    once per schema and reuses the validator.  Schemas are recognized by identity, so a schema should not be
+    mutated after it has been used for validation.
+    """
+
+    #Compiled validators are kept for at most this many schemas
+    MAX_SCHEMAS = 256
+
+    def __init__(self):
+        """Constructor"""
+        self.validators = OrderedDict()
+        self.fast_paths = {}
+        self.timings = {}
+
+    def validator(self, schema):
+        """Get the compiled validator for a schema, compiling it on first use
+
+        :param dict schema: A JSON Schema dictionary
+        :returns: A jsonschema validator instance
+        """
+        entry = self.validators.get(id(schema))
+
+        if entry is None or entry[0] is not schema:
+            cls = validator_for(schema)
+            cls.check_schema(schema)
+
+            #The schema is kept with its validator, so its id can't be reused while it is registered
+            entry = (schema, cls(schema))
+            self.validators[id(schema)] = entry
+
+            while len(self.validators) > self.MAX_SCHEMAS:
+                self.validators.popitem(last=False)
+
+        return entry[1]
+
+    def register_fast_path(self, schema, check):
+        """Register a hand written check for a schema.
+
+        The check returns True when an instance is certainly valid, anything else falls back to the compiled
+        validator, so the errors raised are always the jsonschema ones.
+
+        :param dict schema: A JSON Schema dictionary
+        :param callable check: A function taking the instance and returning a boolean
+        """
+        self.fast_paths[id(schema)] = (schema, check)
+
+    def validate(self, instance, schema, fast_path=True):
+        """Validate an instance against a schema, this is a drop in replacement for jsonschema.validate
+
+        :param instance: The instance to validate
+        :param dict schema: A JSON Schema dictionary
+        :param bool fast_path: Whether a registered fast path may be used
+        :raises ValidationError: The instance is invalid
+        """
+        start = time.time()
+        fast = False
+
+        try:
+            entry = self.fast_paths.get(id(schema)) if fast_path else None
+            fast = entry is not None and entry[0] is schema and entry[1](instance)
+
+            if not fast:
+                self.validator(schema).validate(instance)
+        finally:
+            self.__record(schema.get("title", "untitled"), time.time() - start, fast)
+
+    def __record(self, title, seconds, fast):
+        timing = self.timings.setdefault(title, {"count": 0, "fast_path_count": 0, "seconds": 0.0})
+        timing["count"] += 1
+        timing["seconds"] += seconds
+
+        if fast:
+            timing["fast_path_count"] += 1
+
+    def stats(self):
+        """Validation time metrics per schema title
+
+        :returns: count, fast_path_count, total seconds and average seconds for each schema title
+        :rtype: dict
+        """
+        stats = {}
+        for title, timing in self.timings.items():
+            stats[title] = dict(timing, average_seconds=timing["seconds"] / timing["count"])
+
+        return stats
+
+schema_validators = SchemaValidatorRegistry()
+
+class MigratedMasterIdCache(object):
+    """A bounded, least recently used set of master ids that are known to have revisions.
+
+    Only master ids that were seen in, or written to, a revisions collection are added, so a hit is safe to
+    trust no matter how many processes are writing.  A miss only means the revisions collection has to be asked.
+    """
+
+    def __init__(self, size):
+        """
+        Constructor
+
+        :param int size: The maximum number of master ids to remember
+        """
+        self.size = size
+        self.master_ids = OrderedDict()
+
+    def __contains__(self, master_id):
+        if master_id not in self.master_ids:
+            return False
+
+        #Move it to the most recently used end
+        self.master_ids[master_id] = self.master_ids.pop(master_id)
+        return True
+
+    def __len__(self):
+        return len(self.master_ids)
+
+    def add(self, master_id):
+        """Remember a master id, evicting the least recently used one when full
+
+        :param str master_id: The master id
+        """
+        self.master_ids.pop(master_id, None)
+        self.master_ids[master_id] = True
+
+        while len(self.master_ids) > self.size:
+            self.master_ids.popitem(last=False)
+
+    def clear(self):
+        """Forget every master id"""
+        self.master_ids.clear()
+
+class AsyncSchedulableDocumentRevisionStack(object):
+    """This class manages a stack of revisions for a given document in a given collection"""
+    SCHEMA = {
+        "title":"Schedulable Revision Document",
+        "type": "object",
+        "required": ["toa", "processed", "collection", "master_id", "action", "patch"],
+        "properties" : {
+            "toa" : {
+                "type": "number",
+            },
+            "processed": {
+                "type": "boolean",
+            },
+            "collection": {
+                "type": "string",
+            },
+            "master_id": {
+                "type": "string",
+            },
+            "action": {
+                "type": "string",
+            },
+            "patch": {
+                "type": ["object", "null"],
+            },
+            "snapshot": {
+                "type": "object"
+            },
+            "snapshot_delta": {
+                "type": "object"
+            },
+            "snapshot_base": {
+                "type": "string"
+            },
+            "snapshot_depth": {
+                "type": "integer"
+            },
+            "partition_hash": {
+                "type": "integer"
+            },
+            "meta": {
+                "type": "object"
+            }
+
+        }
+    }
+
+    DELETE_ACTION = "delete"
+    UPDATE_ACTION = "update"
+    INSERT_ACTION = "insert"
+
+    #A materialized preview checkpoint is stored after this many replayed revisions
+    CHECKPOINT_INTERVAL = 25
+
+    #A processed revision stores a full snapshot every this many revisions, the rest store a delta
+    SNAPSHOT_KEYFRAME_INTERVAL = 10
+
+    #How many migrated master ids are remembered per collection
+    MIGRATED_CACHE_SIZE = 10000
+
+    #Process wide MigratedMasterIdCache instances, by revisions collection name
+    migrated_caches = {}
+
+    #Shared by every stack, so building one per revision doesn't look a logger up
+    logger = logging.getLogger("AsyncSchedulableDocumentRevisionStack")
+
+
+    def __init__(self, collection_name, settings, collection_schema=None, master_id=None):
+        """
+        Constructor
+
+        :param str collection: The collection you want revision documents on
+        :param dict settings: The application settings
+        :param dict collection_schema: This is a JSON Schema dictionary to describe the expected object for that type
+        :param str master_id: The Master ID for this set of revisions
+
+        The collection clients are shared by every stack on the same collection, which makes a stack a lightweight
+        view of the revisions for a single master id.
+        """
+        self.master_id=master_id
+        self.settings = settings
+        self.storage = get_storage_backend(self.settings)
+        self.client = self.storage.database
+        self.revisions = []
+        self.collection_name = collection_name
+        self.collection = BaseAsyncMotorDocument.shared(collection_name, self.settings, schema=collection_schema)
+        self.revisions = BaseAsyncMotorDocument.shared("%s_revisions" % collection_name, self.settings, schema=self.SCHEMA)
+        self.previews = BaseAsyncMotorDocument.shared("previews", self.settings)
+        self.checkpoints = BaseAsyncMotorDocument.shared("%s_checkpoints" % collection_name, self.settings)
+        self.due = BaseAsyncMotorDocument.shared("%s_due" % collection_name, self.settings)
+        self.archive = BaseAsyncMotorDocument.shared("%s_revisions_archive" % collection_name, self.settings)
+
+    @staticmethod
+    def is_valid_revision(revision):
+        """A fast path check for SCHEMA, see SchemaValidatorRegistry.register_fast_path
+
+        :param dict revision: The revision document
+        :returns: True when the revision is certainly valid
+        :rtype: bool
+        """
+        strings = (str, type(u""))
+
+        if not isinstance(revision, dict):
+            return False
+
+        for key in AsyncSchedulableDocumentRevisionStack.SCHEMA["required"]:
+            if key not in revision:
+                return False
+
+        toa = revision["toa"]
+        depth = revision.get("snapshot_depth", 0)
+        partition_hash = revision.get("partition_hash", 0)
+
+        return isinstance(toa, numbers.Number) and not isinstance(toa, bool) \
+            and isinstance(revision["processed"], bool) \
+            and isinstance(revision["collection"], strings) \
+            and isinstance(revision["master_id"], strings) \
+            and isinstance(revision["action"], strings) \
+            and (revision["patch"] is None or isinstance(revision["patch"], dict)) \
+            and isinstance(revision.get("snapshot", {}), dict) \
+            and isinstance(revision.get("snapshot_delta", {}), dict) \
+            and isinstance(revision.get("snapshot_base", ""), strings) \
+            and isinstance(depth, int) and not isinstance(depth, bool) \
+            and isinstance(partition_hash, numbers.Integral) and not isinstance(partition_hash, bool) \
+            and isinstance(revision.get("meta", {}), dict)
+
+    @staticmethod
+    def partition_hash(master_id):
+        """A stable hash of a master id, stored on pending revisions so the scheduler can be partitioned
+
+        :param str master_id: The master id
+        :rtype: int
+        """
+        return zlib.crc32(master_id.encode("utf-8")) & 0xffffffff
+
+    @staticmethod
+    def partition_predicates(partitions, partition_count):
+        """Build the $or clauses that select the revisions in some partitions
+
+        Revisions pushed before partitioning was turned on have no partition hash, see backfill_partition_hashes.
+        Partition 0 picks up any that are left, pop keeps the revisions of a master id in order when they end up
+        in two partitions.
+
+        :param list partitions: The partition numbers
+        :param int partition_count: The total number of partitions
+        :rtype: list
+        """
+        predicates = [{"partition_hash": {"$mod": [partition_count, partition]}} for partition in partitions]
+
+        if 0 in partitions:
+            predicates.append({"partition_hash": {"$exists": False}})
+
+        return predicates
+
+    @property
+    def due_queue_enabled(self):
+        """Whether pending revisions are also queued in <collection>_due, the "due_queue" scheduler setting
+
+        The due queue holds one small entry per pending revision, keyed by the revision id and holding its toa,
+        so the scheduler scan doesn't have to go through the processed history in <collection>_revisions.
+
+        :rtype: bool
+        """
+        return self.settings.get("scheduler", {}).get("due_queue", False)
+
+    @coroutine
+    def enqueue(self, revision):
+        """Add a pending revision to the due queue
+
+        :param dict revision: The revision, with its _id
+        """
+        yield self.due.collection.update({"_id": revision["_id"]}, {
+            "_id": revision["_id"],
+            "toa": revision["toa"],
+            "master_id": revision["master_id"],
+            "partition_hash": revision.get("partition_hash", self.partition_hash(revision["master_id"]))
+        }, upsert=True)
+
+    @coroutine
+    def backfill_due_queue(self):
+        """Queue every pending revision of the collection, for revisions pushed before the due queue was turned on.
+        This is safe to call more than once.
+
+        :returns: The number of revisions queued
+        :rtype: int
+        """
+        cursor = self.revisions.collection.find({"processed": False},
+                                                {"_id": 1, "toa": 1, "master_id": 1, "partition_hash": 1})
+
+        queued = 0
+        while (yield cursor.fetch_next):
+            yield self.enqueue(cursor.next_object())
+            queued += 1
+
+        raise Return(queued)
+
+    @coroutine
+    def backfill_partition_hashes(self):
+        """Give a partition hash to the pending revisions pushed before partitioning was turned on, so they are
+        in the same partition as the newer revisions of their master id.  This is safe to call more than once.
+
+        :returns: The number of revisions updated
+        :rtype: int
+        """
+        cursor = self.revisions.collection.find({"processed": False, "partition_hash": {"$exists": False}},
+                                                {"master_id": 1})
+
+        master_ids = set()
+        while (yield cursor.fetch_next):
+            master_ids.add(cursor.next_object()["master_id"])
+
+        hashed = 0
+        for master_id in master_ids:
+            response = yield self.revisions.collection.update(
+                {"master_id": master_id, "processed": False, "partition_hash": {"$exists": False}},
+                {"$set": {"partition_hash": self.partition_hash(master_id)}},
+                multi=True
+            )
+            hashed += response.get("n", 0)
+
+        raise Return(hashed)
+
+    @property
+    def migrated_cache(self):
+        """The process wide cache of master ids that already have revisions in this collection
+
+        :returns: The cache, or None when the "migrated_cache_size" scheduler setting is 0
+        :rtype: MigratedMasterIdCache
+        """
+        size = self.settings.get("scheduler", {}).get("migrated_cache_size", self.MIGRATED_CACHE_SIZE)
+
+        if not size:
+            return None
+
+        if self.revisions.collection_name not in self.migrated_caches:
+            self.migrated_caches[self.revisions.collection_name] = MigratedMasterIdCache(size)
+
+        return self.migrated_caches[self.revisions.collection_name]
+
+    @coroutine
+    def warm_migrated_cache(self):
+        """
+        Fill the migrated master id cache from the most recently processed revisions, typically this is called
+        once per collection when your application starts.
+        """
+        cache = self.migrated_cache
+
+        if cache is None:
+            return
+
+        cursor = self.revisions.collection.find({"processed": True}, {"master_id": 1})
+        cursor.sort("toa", -1).limit(cache.size)
+
+        master_ids = []
+        while (yield cursor.fetch_next):
+            master_ids.append(cursor.next_object().get("master_id"))
+
+        #Add the oldest first, so the most recent master ids are the last to be evicted
+        for master_id in reversed(master_ids):
+            cache.add(master_id)
+
+    @coroutine
+    def ensure_indexes(self):
+        """
+        Create the indexes the stack queries rely on, this is safe to call more than once.
+        Typically this is called once per collection when your application starts.
+        """
+        yield self.revisions.create_index([("master_id", 1), ("processed", 1), ("toa", -1)])
+        yield self.revisions.create_index([("processed", 1), ("inProcess", 1), ("toa", 1)])
+        yield self.checkpoints.create_index([("master_id", 1), ("base_hash", 1), ("toa", -1)])
+        yield self.archive.create_index([("master_id", 1), ("toa", -1)])
+
+        if self.due_queue_enabled:
+            yield self.due.create_index([("toa", 1)])
+
+    @coroutine
+    def __update_action(self, revision):
+        """Update a master document and revision history document
+
+        :param dict revision: The revision dictionary
+        """
+
+        patch = revision.get("patch")
+        if patch.get("_id"):
+            del patch["_id"]
+
+        update_response = yield self.collection.patch(revision.get("master_id"), self.__make_storeable_patch_patchable(patch))
+
+        if update_response.get("n") == 0:
+            raise RevisionNotFoundException()
+
+    @coroutine
+    def __insert_action(self, revision):
+        """
+        Handle the insert action type.
+
+        Creates new document to be created in this collection.
+        This allows you to stage a creation of an object
+
+        :param dict revision: The revision dictionary
+
+        """
+
+        revision["patch"]["_id"] = ObjectId(revision.get("master_id"))
+
+        insert_response = yield self.collection.insert(revision.get("patch"))
+
+        if not isinstance(insert_response, str):
+            raise DocumentRevisionInsertFailed()
+
+    @coroutine
+    def __delete_action(self, revision):
+        """
+        Handle a delete action to a partiular master id via the revision.
+
+        :param dict revision:
+        :return:
+        """
+        delete_response = yield self.collection.delete(revision.get("master_id"))
+        if delete_response.get("n") == 0:
+            raise DocumentRevisionDeleteFailed()
+
+    @coroutine
+    def pop(self, revision_id=None):
+        """Pop the top revision off the stack back onto the collection at the given id. This method applies the action.
+
+        Note: This assumes you don't have two revisions scheduled closer than a single scheduling cycle.
+
+        :param str revision_id: Only apply the top revision if it is this one, ie a revision the caller claimed.
+            When an earlier revision is still pending nothing is applied, so revisions apply in order.
+        :returns: The applied revision, or None
+        :rtype: dict
+        """
+        revisions = yield self.list(limit=1)
+
+        if len(revisions) > 0 and revision_id is not None and revisions[0].get("id") != str(revision_id):
+            raise Return(None)
+
+        if len(revisions) > 0:
+            revision = revisions[0]
+            action = revision.get("action")
+            metrics = get_metrics_sink(self.settings)
+            tags = {"collection": self.collection_name}
+            failed = False
+
+            started = time.time()
+            metrics.observe("scheduler_apply_lag_seconds", max(0.0, started - revision.get("toa")), tags)
+
+            yield self.__renew_claim(revision)
+
+            # Update type action
+            if action == self.UPDATE_ACTION:
+                try:
+                    yield self.__update_action(revision)
+                except Exception as ex:
+                    failed = True
+                    self.logger.error(ex)
+
+            # Insert type update
+            if action == self.INSERT_ACTION:
+                try:
+                    yield self.__insert_action(revision)
+                except Exception as ex:
+                    failed = True
+                    self.logger.error(ex)
+
+            #Get the updated object for attachment to the snapshot
+            snapshot_object = yield self.collection.find_one_by_id(revision.get("master_id"))
+
+            #Handle delete action here
+            if action == self.DELETE_ACTION:
+                try:
+                    yield self.__delete_action(revision)
+                except Exception as ex:
+                    failed = True
+                    self.logger.error(ex)
+
+                snapshot_object = None
+
+            applied = time.time()
+            metrics.observe("scheduler_phase_seconds", applied - started, dict(tags, phase="apply"))
+
+            yield self.__renew_claim(revision)
+
+            #Update the revision to be in a post-process state including snapshot
+            revision_update = yield self.__snapshot_fields(snapshot_object)
+            revision_update.update({
+                "processed" : True,
+                "inProcess": False
+            })
+
+            snapshotted = time.time()
+            metrics.observe("scheduler_phase_seconds", snapshotted - applied, dict(tags, phase="snapshot"))
+
+            revision_update_response = yield self.revisions.patch(revision.get("id"), revision_update)
+
+            if revision_update_response.get("n") == 0:
+                metrics.increment("scheduler_failed_total", tags=dict(tags, action=action))
+                raise RevisionUpdateFailed(msg="revision document update failed")
+
+            #The master document moved forward, preview checkpoints were built on the old state
+            yield self.invalidate_checkpoints()
+
+            if self.due_queue_enabled:
+                yield self.due.collection.remove({"_id": ObjectId(revision.get("id"))})
+
+            metrics.observe("scheduler_phase_seconds", time.time() - snapshotted, dict(tags, phase="mark"))
+            metrics.increment("scheduler_failed_total" if failed else "scheduler_applied_total",
+                              tags=dict(tags, action=action))
+
+            revision = yield self.revisions.find_one_by_id(revision.get("id"))
+            yield self.materialize_snapshots([revision])
+
+            #TODO: Make this callback method something that can be passed in.  This was used in
+            #the original implementation to send back to the client via websocket
+            #revision_success.send('revision_success', type="RevisionSuccess", data=revision)
+
+            raise Return(revision)
+
+        raise Return(None)
+
+    @coroutine
+    def __renew_claim(self, revision):
+        """Move the claimed_at of a claimed revision forward, so AsyncStaleRevisionReaper doesn't take it back
+        while it is being applied.  Revisions nobody claimed are left alone.
+
+        :param dict revision: The revision
+        """
+        yield self.revisions.collection.update({"_id": ObjectId(revision.get("id")), "inProcess": True},
+                                               {"$set": {"claimed_at": time.time()}})
+
+    @coroutine
+    def __snapshot_fields(self, snapshot):
+        """Build the snapshot fields for a revision that is being processed.
+
+        Every SNAPSHOT_KEYFRAME_INTERVAL revisions of a master id store the full snapshot, the revisions in
+        between only store a delta against that keyframe.  The interval can be changed with the
+        "snapshot_keyframe_interval" scheduler setting, 1 stores a full snapshot on every revision.
+
+        :param dict snapshot: The state of the master document after the revision was applied
+        :returns: The fields to set on the revision
+        :rtype: dict
+        """
+        keyframe = {"snapshot": snapshot, "snapshot_depth": 0}
+
+        interval = self.settings.get("scheduler", {}).get("snapshot_keyframe_interval",
+                                                          self.SNAPSHOT_KEYFRAME_INTERVAL)
+
+        if not isinstance(snapshot, dict) or interval <= 1:
+            raise Return(keyframe)
+
+        previous = yield self.revisions.find({
+            "master_id": self.master_id,
+            "processed": True
+        }, orderby="toa", order_by_direction=-1, limit=1)
+
+        if len(previous) == 0 or previous[0].get("snapshot_depth", 0) + 1 >= interval:
+            raise Return(keyframe)
+
+        previous = previous[0]
+
+        if "snapshot_delta" in previous:
+            base = yield self.revisions.find_one_by_id(previous.get("snapshot_base"))
+        else:
+            base = previous
+
+        if not isinstance(base, dict) or not isinstance(base.get("snapshot"), dict):
+            raise Return(keyframe)
+
+        delta = self._snapshot_delta(base.get("snapshot"), snapshot)
+
+        #A delta that isn't smaller than the document itself isn't worth storing
+        if len(json.dumps(delta, cls=BSONEncoder)) >= len(json.dumps(snapshot, cls=BSONEncoder)):
+            raise Return(keyframe)
+
+        raise Return({
+            "snapshot_delta": delta,
+            "snapshot_base": base.get("id"),
+            "snapshot_depth": previous.get("snapshot_depth", 0) + 1
+        })
+
+    def _snapshot_delta(self, base, snapshot, path=None, delta=None):
+        """Describe the changes from one snapshot to another.
+
+        Paths are stored as lists of keys, so that keys which can't be stored in mongo never become field names.
+
+        :param dict base: The snapshot the delta applies to
+        :param dict snapshot: The snapshot the delta produces
+        :returns: A dictionary with a "set" list of [path, value] pairs and an "unset" list of paths
+        :rtype: dict
+        """
+        path = path or []
+
+        if delta is None:
+            delta = {"set": [], "unset": []}
+
+        for key, value in snapshot.items():
+            if key not in base:
+                delta["set"].append([path + [key], value])
+            elif isinstance(value, dict) and isinstance(base[key], dict):
+                self._snapshot_delta(base[key], value, path + [key], delta)
+            elif type(value) != type(base[key]) or value != base[key]:
+                delta["set"].append([path + [key], value])
+
+        for key in base:
+            if key not in snapshot:
+                delta["unset"].append(path + [key])
+
+        return delta
+
+    def _apply_snapshot_delta(self, base, delta):
+        """Rebuild a snapshot from a base snapshot and a delta
+
+        :param dict base: The snapshot the delta applies to
+        :param dict delta: A delta produced by _snapshot_delta
+        :returns: The rebuilt snapshot
+        :rtype: dict
+        """
+        snapshot = copy.deepcopy(base)
+
+        for path in delta.get("unset", []):
+            target = snapshot
+            for key in path[:-1]:
+                target = target.get(key) if isinstance(target, dict) else None
+
+            if isinstance(target, dict):
+                target.pop(path[-1], None)
+
+        for path, value in delta.get("set", []):
+            target = snapshot
+            for key in path[:-1]:
+                if not isinstance(target.get(key), dict):
+                    target[key] = {}
+                target = target[key]
+
+            target[path[-1]] = copy.deepcopy(value)
+
+        return snapshot
+
+    @coroutine
+    def materialize_snapshots(self, revisions):
+        """Rebuild the full snapshot of any delta encoded revisions in a list, in place
+
+        :param list revisions: Revision dictionaries for this collection
+        :returns: The same list of revisions
+        :rtype: list
+        """
+        keyframes = dict((revision.get("id"), revision.get("snapshot")) for revision in revisions
+                         if isinstance(revision, dict) and "snapshot_delta" not in revision)
+
+        missing = set(revision.get("snapshot_base") for revision in revisions
+                      if isinstance(revision, dict) and "snapshot_delta" in revision) - set(keyframes)
+
+        #Bases of archived revisions may be archived too, see AsyncRevisionCompactor
+        for collection in [self.revisions, self.archive]:
+            if not missing:
+                break
+
+            bases = yield collection.find({"_id": {"$in": [ObjectId(id) for id in missing]}})
+            for base in bases:
+                keyframes[base.get("id")] = base.get("snapshot")
+                missing.discard(base.get("id"))
+
+        for revision in revisions:
+            if isinstance(revision, dict) and "snapshot_delta" in revision:
+                base = keyframes.get(revision.get("snapshot_base"))
+                delta = revision.pop("snapshot_delta")
+                revision["snapshot"] = self._apply_snapshot_delta(base, delta) if isinstance(base, dict) else None
+
+        raise Return(revisions)
+
+    def __make_patch_storeable(self, patch):
+        """Replace all dots with pipes in key names, mongo doesn't like to store keys with dots.
+
+        :param dict patch: The patch that needs to be made storeable and applied in the future
+        """
+        new_patch = {}
+        for key in patch:
+            new_patch[key.replace(".", "|")] = patch[key]
+
+        return new_patch
+
+    def __make_storeable_patch_patchable(self, patch):
+        """Replace all pipes with dots, transform back into the a namespace path.
+        This is done before the $set query is applied to the document
+
+        :param dict patch: The patch that is to be prepared to be applied
+        """
+
+        new_patch = {}
+        for key in patch:
+            new_patch[key.replace("|", ".")] = patch[key]
+
+        return new_patch
+
+    @coroutine
+    def push(self, patch=None, toa=None, meta=None, coalesce=None):
+        """Push a change on to the revision stack for this ObjectId.  Pushing onto the stack is how you
+        get revisions to be staged and scheduled for some future time.
+
+        :param dict patch: None Denotes Delete
+        :param int toa: Time of action
+        :param dict meta: The meta data for this action
+        :param bool coalesce: Merge an update into a pending update with the same time of action, see
+            __coalesce.  Defaults to the "coalesce_updates" scheduler setting, which defaults to False.
+        """
+
+        if not meta:
+            meta = {}
+
+        if not toa:
+            toa = time.mktime(datetime.datetime.now().timetuple())
+
+        if not isinstance(toa, int):
+            toa = int(toa)
+
+        #Documents should be stored in bson formats
+        if isinstance(patch, dict):
+            patch = self.revisions._dictionary_to_cursor(patch)
+
+        action = None
+
+        if isinstance(patch, type(None)):
+            action = self.DELETE_ACTION
+        elif self.master_id and isinstance(patch, dict):
+            action = self.UPDATE_ACTION
+            patch = self.__make_patch_storeable(patch)
+
+            cache = self.migrated_cache
+            if cache is None or self.master_id not in cache:
+                yield self._lazy_migration(meta=copy.deepcopy(meta), toa=toa-1)
 
         elif not self.master_id and isinstance(patch, dict):
             #Scheduled inserts will not have an object ID and one should be generated
@@ -346,239 +1888,1277 @@ class AsyncSchedulableDocumentRevisionStack(object):
             patch["_id"] = ObjectId()
             self.master_id = patch["_id"].__str__()
 
-        elif not action:
-            raise RevisionActionNotValid()
+        elif not action:
+            raise RevisionActionNotValid()
+
+        # We shall never store the _id to a patch dictionary
+        if patch and patch.get("_id"):
+            del patch["_id"]
+
+        change = {
+            "toa": toa,
+            "processed": False,
+            "collection": self.collection_name,
+            "master_id": self.master_id,
+            "action": action,
+            "patch" : None if action == self.DELETE_ACTION else self.collection._dictionary_to_cursor(patch),
+            "meta": meta,
+            "partition_hash": self.partition_hash(self.master_id)
+        }
+
+        schema_validators.validate(change, self.SCHEMA,
+                                   fast_path=self.settings.get("scheduler", {}).get("fast_revision_validation", True))
+
+        if coalesce is None:
+            coalesce = self.settings.get("scheduler", {}).get("coalesce_updates", False)
+
+        if coalesce and action == self.UPDATE_ACTION:
+            id = yield self.__coalesce(change)
+
+            if id:
+                yield self.invalidate_checkpoints(toa=toa)
+                raise Return(id)
+
+        id = yield self.revisions.insert(change)
+
+        if self.due_queue_enabled:
+            yield self.enqueue(dict(change, _id=ObjectId(id)))
+
+        if action != self.INSERT_ACTION:
+            yield self.invalidate_checkpoints(toa=toa)
+
+        raise Return(id)
+
+    def __patches_conflict(self, keys, other_keys):
+        """Check whether two sets of storeable patch keys touch the same path at different depths,
+        ie "sub_document" and "sub_document|depth", which can't be applied by a single $set
+
+        :param set keys: Keys of one patch
+        :param set other_keys: Keys of the other patch
+        :rtype: bool
+        """
+        for key in keys:
+            for other_key in other_keys:
+                if key.startswith(other_key + "|") or other_key.startswith(key + "|"):
+                    return True
+
+        return False
+
+    @coroutine
+    def __coalesce(self, change):
+        """Merge an update change into a pending, unclaimed update for the same master id and time of action.
+
+        Keys of the new patch win over the existing ones, which is the order the scheduler would have applied
+        them in.  The merge is recorded in the meta.coalesced list of the existing revision, and the merge is
+        skipped when the patches touch the same path at different depths.
+
+        :param dict change: The validated revision document that would have been inserted
+        :returns: The id of the revision the change was merged into, or None when nothing could be merged
+        :rtype: str
+        """
+        if not change.get("patch"):
+            raise Return(None)
+
+        pending = yield self.revisions.collection.find_one({
+            "master_id": self.master_id,
+            "toa": change.get("toa"),
+            "action": self.UPDATE_ACTION,
+            "processed": False,
+            "inProcess": None
+        }, {"patch": 1, "meta.coalesced_count": 1})
+
+        if not pending or self.__patches_conflict(set(change["patch"]), set(pending.get("patch") or {})):
+            raise Return(None)
+
+        record = dict(change.get("meta"), coalesced_at=time.mktime(datetime.datetime.now().timetuple()))
+
+        #The coalesced count guards against another push merging into the same revision in the meantime
+        merged = yield self.revisions.collection.find_and_modify({
+            "_id": pending["_id"],
+            "processed": False,
+            "inProcess": None,
+            "meta.coalesced_count": (pending.get("meta") or {}).get("coalesced_count")
+        }, {
+            "$set": dict(("patch.%s" % key, value) for key, value in change["patch"].items()),
+            "$push": {"meta.coalesced": record},
+            "$inc": {"meta.coalesced_count": 1}
+        }, fields={"_id": 1})
+
+        raise Return(merged["_id"].__str__() if merged else None)
+
+    @coroutine
+    def list(self, toa=None, show_history=False, limit=0, projection=None):
+        """Return all revisions for this stack, in order of time of action
+
+        The query is served by the (master_id, processed, toa) index from ensure_indexes, so with a limit
+        the cost doesn't depend on how many revisions are queued.
+
+        :param int toa: The time of action as a UTC timestamp
+        :param bool show_history: Whether to show historical revisions
+        :param int limit: Number of revisions to return, 0 for all
+        :param dict projection: The fields to return, ie {"toa": 1}, None returns whole revisions
+        """
+        if not toa:
+            toa = time.mktime(datetime.datetime.now().timetuple())
+
+        query = {
+            "master_id": self.master_id,
+            "processed": show_history,
+            "toa" : {"$lte" : toa}
+        }
+
+        revisions = yield self.revisions.find(query, orderby="toa", order_by_direction=1, limit=limit,
+                                              projection=projection)
+
+        if show_history:
+            yield self.materialize_snapshots(revisions)
+
+        raise Return(revisions)
+
+
+    @coroutine
+    def _lazy_migration(self, patch=None, meta=None, toa=None):
+        """
+        Handle when a revision scheduling is turned onto a collection that was previously not scheduleable.
+        This method will create the first revision for each object before its every used in the context of scheduling.
+
+        :param dict patch: The patch that should be used
+        :param dict meta: Meta data for this action
+        :param int toa: The time of action
+        :return: A legacy revision for a document that was previously
+        :rtype: list
+        """
+        objects = yield self.revisions.find({"master_id": self.master_id}, limit=1)
+        cache = self.migrated_cache
+
+        if len(objects) > 0:
+            if cache is not None:
+                cache.add(self.master_id)
+            raise Return(objects)
+
+        if not patch:
+            patch = yield self.collection.find_one_by_id(self.master_id)
+
+        if not toa:
+             toa = long(time.mktime(datetime.datetime.now().timetuple()))
+
+        meta["comment"] = "This document was migrated automatically."
+
+        if isinstance(patch, dict) and patch.get("id"):
+            del patch["id"]
+
+        if isinstance(patch, dict) and patch.get("_id"):
+            del patch["_id"]
+
+        #Here we separate patch and snapshot, and make sure that the snapshot looks like the master document
+        snapshot = copy.deepcopy(patch)
+        snapshot["id"] = self.master_id
+        snapshot["published"] = self.settings.get("scheduler", {}).get("lazy_migrated_published_by_default", False)
+
+        #If no objects are returned, this is some legacy object that needs a first revision
+        #Create it here
+        legacy_revision = {
+            "toa": toa,
+            "processed": True,
+            "collection": self.collection_name,
+            "master_id": self.master_id,
+            "action": self.INSERT_ACTION,
+            "patch": self.collection._dictionary_to_cursor(patch),
+            "snapshot": snapshot,
+            "meta": meta,
+        }
+
+        response = yield self.revisions.insert(legacy_revision)
+        if isinstance(response, str):
+            if cache is not None:
+                cache.add(self.master_id)
+            raise Return([legacy_revision])
+
+        raise Return(None)
+
+    @coroutine
+    def __create_preview_object_base(self, dct):
+        """
+        The starting point for a preview of a future object.
+        This is the object which will have future revisions iterated and applied to.
+
+        :param dict dct: The starting object dictionary
+        :return: The preview object id
+        :rtype: str
+
+        """
+        if dct.get("_id"):
+            del dct["_id"]
+
+        preview_object_id = yield self.previews.insert(dct)
+
+        raise Return(preview_object_id)
+
+    def __fingerprint(self, dct):
+        """Hash a document, this is used to tie a checkpoint to the document state it was replayed from
+
+        :param dict dct: The document to hash
+        :rtype: str
+        """
+        return hashlib.sha1(json.dumps(dct, sort_keys=True, cls=BSONEncoder).encode("utf-8")).hexdigest()
+
+    @coroutine
+    def __pending_revisions(self, toa, after_toa=None, limit=0):
+        """Get the unprocessed revisions for this master id, in order of time of action
+
+        :param int toa: Only revisions at or before this time of action
+        :param int after_toa: Only revisions after this time of action
+        :param int limit: Number of revisions to return, 0 for all
+        :rtype: list
+        """
+        toa_predicate = {"$lte": toa}
+
+        if after_toa is not None:
+            toa_predicate["$gt"] = after_toa
+
+        revisions = yield self.revisions.find({
+            "master_id": self.master_id,
+            "processed": False,
+            "toa": toa_predicate
+        }, orderby="toa", order_by_direction=1, limit=limit)
+
+        raise Return(revisions)
+
+    @coroutine
+    def __nearest_checkpoint(self, base_hash, toa):
+        """Find the latest checkpoint at or before a time of action that was replayed from the given base
+
+        :param str base_hash: The fingerprint of the preview base document
+        :param int toa: The time of action being previewed
+        :returns: The checkpoint or None
+        :rtype: dict
+        """
+        checkpoints = yield self.checkpoints.find({
+            "master_id": self.master_id,
+            "base_hash": base_hash,
+            "toa": {"$lte": toa}
+        }, orderby="toa", order_by_direction=-1, limit=1)
+
+        raise Return(checkpoints[0] if len(checkpoints) > 0 else None)
+
+    @coroutine
+    def __save_checkpoint(self, base_hash, revision, preview_id):
+        """Materialize the current state of a preview object as a checkpoint
+
+        :param str base_hash: The fingerprint of the preview base document
+        :param dict revision: The last revision applied to the preview object
+        :param str preview_id: The id of the preview object
+        """
+        snapshot = yield self.previews.find_one_by_id(preview_id)
+        del snapshot["id"]
+
+        predicate = {
+            "master_id": self.master_id,
+            "base_hash": base_hash,
+            "toa": revision.get("toa")
+        }
+
+        checkpoint = dict(predicate, revision_id=revision.get("id"), snapshot=snapshot)
+
+        yield self.checkpoints.collection.update(predicate, checkpoint, True)
+
+    @coroutine
+    def invalidate_checkpoints(self, toa=None):
+        """Remove the preview checkpoints that are no longer valid for this master id.
+
+        Call this whenever a revision is added, changed or removed outside of push and pop.
+
+        :param int toa: Remove checkpoints at or after this time of action, None removes all of them
+        """
+        predicate = {"master_id": self.master_id}
+
+        if toa is not None:
+            predicate["toa"] = {"$gte": toa}
+
+        yield self.checkpoints.collection.remove(predicate)
+
+    @coroutine
+    def preview(self, revision_id):
+        """Get an ephemeral preview of a revision with all revisions applied between it and the current state
+
+        Replaying starts from the nearest checkpoint at or before the revision, and a new checkpoint is
+        stored every CHECKPOINT_INTERVAL revisions that had to be replayed.  The interval can be changed
+        with the "preview_checkpoint_interval" scheduler setting, 0 disables checkpoints.
+
+        :param str revision_id: The ID of the revision state you want to preview the master id at.
+        :return: A snapshot of a future state of the object
+        :rtype: dict
+        """
+
+        target_revision = yield self.revisions.find_one_by_id(revision_id)
+
+        if not isinstance(target_revision, dict):
+            raise RevisionNotFound()
+
+        yield self.materialize_snapshots([target_revision])
+
+        if isinstance(target_revision.get("snapshot"), dict):
+            raise Return(target_revision)
+
+        preview_object = None
+
+        revision_collection_client = BaseAsyncMotorDocument.shared(target_revision.get("collection"), self.settings)
+
+        self.master_id = target_revision.get("master_id")
+
+        action = target_revision.get("action")
+
+        if action == self.DELETE_ACTION:
+            raise Return(preview_object)
+
+        if action in [self.INSERT_ACTION, self.UPDATE_ACTION]:
+
+            toa = target_revision.get("toa")
+
+            first_revisions = yield self.__pending_revisions(toa, limit=1)
+
+            if len(first_revisions) == 0:
+                raise NoRevisionsAvailable()
+
+            first_revision = first_revisions[0]
+            current_document = None
+
+
+            if first_revision.get("action") == self.UPDATE_ACTION:
+                current_document = yield revision_collection_client.find_one_by_id(target_revision.get("master_id"))
+
+            elif first_revision.get("action") == self.INSERT_ACTION:
+                # If we are doing an insert, the first revision patch is the current state
+                current_document = first_revision.get("patch")
+
+            if not current_document:
+                raise RevisionNotFound()
+
+            base_hash = self.__fingerprint(current_document)
+            checkpoint_interval = self.settings.get("scheduler", {}).get("preview_checkpoint_interval",
+                                                                         self.CHECKPOINT_INTERVAL)
+
+            checkpoint = None
+            if checkpoint_interval:
+                checkpoint = yield self.__nearest_checkpoint(base_hash, toa)
+
+            if checkpoint:
+                current_document = checkpoint.get("snapshot")
+                revisions = yield self.__pending_revisions(toa, after_toa=checkpoint.get("toa"))
+            else:
+                revisions = yield self.__pending_revisions(toa)
+
+            preview_id = yield self.__create_preview_object_base(current_document)
+
+            replayed = 0
+            for index, revision in enumerate(revisions):
+                patch = revision.get("patch")
+
+                if patch.get("_id"):
+                    del patch["_id"]
+
+                yield self.previews.patch(preview_id, self.__make_storeable_patch_patchable(patch))
+                replayed += 1
+
+                # Revisions sharing a toa have no order between them, only checkpoint after the last of them
+                next_toa = revisions[index + 1].get("toa") if index + 1 < len(revisions) else None
+
+                if checkpoint_interval and replayed >= checkpoint_interval and next_toa != revision.get("toa"):
+                    yield self.__save_checkpoint(base_hash, revision, preview_id)
+                    replayed = 0
+
+            preview_object = yield self.previews.find_one_by_id(preview_id)
+
+
+            preview_object["id"] = target_revision["id"]
+            target_revision["snapshot"] = self.collection._obj_cursor_to_dictionary(preview_object)
+            target_revision["snapshot"]["id"] = target_revision["master_id"]
+
+            # Delete the last preview
+            yield self.previews.delete(preview_id)
+
+        raise Return(target_revision)
+
+
+    @coroutine
+    def as_of(self, timestamp):
+        """Get the state of the master document at a point in time.
+
+        Past and present timestamps are answered with the snapshot of the latest processed revision at or
+        before the timestamp, which is read from <collection>_revisions_archive when AsyncRevisionCompactor
+        archived it.  Future timestamps are answered by previewing the latest revision scheduled
+        at or before the timestamp, or with the current document when nothing is scheduled by then.
+
+        :param float timestamp: A UTC timestamp
+        :returns: The document as it was, or will be, at that time.  None if it did not exist.
+        :rtype: dict
+        """
+        now = time.mktime(datetime.datetime.now().timetuple())
+
+        processed = timestamp <= now
+
+        query = {
+            "master_id": self.master_id,
+            "processed": processed,
+            "toa": {"$lte": timestamp}
+        }
+
+        revisions = yield self.revisions.find(query, orderby="toa", order_by_direction=-1, limit=1)
+
+        if processed:
+            archived = yield self.archive.find(query, orderby="toa", order_by_direction=-1, limit=1)
+            revisions = sorted(revisions + archived, key=lambda revision: revision.get("toa"), reverse=True)[:1]
+
+            yield self.materialize_snapshots(revisions)
+            raise Return(revisions[0].get("snapshot") if len(revisions) > 0 else None)
+
+        if len(revisions) == 0:
+            document = yield self.collection.find_one_by_id(self.master_id)
+            raise Return(document)
+
+        revision = yield self.preview(revisions[0].get("id"))
+
+        raise Return(revision.get("snapshot") if isinstance(revision, dict) else None)
+
+    @coroutine
+    def peek(self):
+        """Return the top object on the stack for this ID
+
+        :returns: The next revision
+        :rtype: dict
+        """
+        revisions = yield self.list(limit=1)
+        raise Return(revisions[0] if len(revisions) > 0 else None)
+
+
+schema_validators.register_fast_path(AsyncSchedulableDocumentRevisionStack.SCHEMA,
+                                     AsyncSchedulableDocumentRevisionStack.is_valid_revision)
+
+
+class GeoTileCache(object):
+    """A least recently used cache of location_based_search results, by geohash tile.
+
+    A search is rounded to the tile its center falls in, and mongo is asked once for everything within the
+    radius of any point of the tile.  Every search of the same radius and attribute filters from the same tile
+    is then answered from memory, with the exact distance filter applied to the cached documents.
+
+    Writes through BaseAsyncMotorDocument invalidate the tiles holding the written document or covering its
+    location.  Writes from other processes are only seen once a tile expires.
+    """
+
+    PRECISION = 5
+    TTL_IN_SECONDS = 60
+    MAX_TILES = 1024
+
+    def __init__(self, precision=None, ttl_in_seconds=None, max_tiles=None):
+        """
+        Constructor
+
+        :param int precision: The number of geohash characters of a tile
+        :param int ttl_in_seconds: How long a tile is kept
+        :param int max_tiles: The number of tiles kept, the least recently used are evicted first
+        """
+        self.precision = precision or self.PRECISION
+        self.ttl = ttl_in_seconds or self.TTL_IN_SECONDS
+        self.max_tiles = max_tiles or self.MAX_TILES
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def tile(self, lng, lat, radius, attribute_map=None):
+        """Work out the tile a search falls in
+
+        :param float lng: Longitude of the search
+        :param float lat: Latitude of the search
+        :param float radius: The search radius, in degrees
+        :param dict attribute_map: The additional attribute filters of the search
+        :returns: The tile key, and the center and radius in degrees to query mongo with for the whole tile
+        :rtype: tuple
+        """
+        geohash, bounds = _geohash_cell(lng, lat, self.precision)
+        min_lng, min_lat, max_lng, max_lat = bounds
+
+        center = [(min_lng + max_lng) / 2, (min_lat + max_lat) / 2]
+        half_diagonal = math.sqrt(((max_lng - min_lng) / 2) ** 2 + ((max_lat - min_lat) / 2) ** 2)
+
+        filters = json.dumps(attribute_map or {}, sort_keys=True, cls=BSONEncoder)
+
+        return (geohash, radius, filters), center, radius + half_diagonal
+
+    def get(self, key):
+        """Get the documents of a tile
+
+        :param tuple key: The tile key
+        :returns: The documents, or None when the tile isn't cached or expired
+        :rtype: list
+        """
+        entry = self.tiles.get(key)
+
+        if entry is None or entry["expires_at"] < time.time():
+            self.tiles.pop(key, None)
+            self.misses += 1
+            return None
+
+        #Move it to the most recently used end
+        self.tiles[key] = self.tiles.pop(key)
+        self.hits += 1
+        return entry["documents"]
+
+    def put(self, key, center, radius, documents):
+        """Cache the documents of a tile, evicting the least recently used tile when full
+
+        :param tuple key: The tile key
+        :param list center: The [lng, lat] the tile was queried around
+        :param float radius: The radius the tile was queried with, in degrees
+        :param list documents: The documents
+        """
+        self.tiles.pop(key, None)
+        self.tiles[key] = {
+            "center": center,
+            "radius": radius,
+            "ids": set(document.get("id") for document in documents),
+            "documents": documents,
+            "expires_at": time.time() + self.ttl
+        }
+
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+
+    def invalidate(self, _id=None, location=None):
+        """Drop the tiles holding a document or covering a location
+
+        :param str _id: The id of a written document
+        :param list location: The [lng, lat] of a written document
+        """
+        for key in list(self.tiles.keys()):
+            entry = self.tiles[key]
+
+            if _id is not None and _id in entry["ids"]:
+                del self.tiles[key]
+            elif location is not None and math.hypot(location[0] - entry["center"][0],
+                                                     location[1] - entry["center"][1]) <= entry["radius"]:
+                del self.tiles[key]
+
+    def clear(self):
+        """Drop every tile"""
+        self.tiles.clear()
+
+class QueryResultCache(object):
+    """A least recently used cache of find and count results for a collection.
+
+    Entries are keyed by the query, sort, page, limit and projection.  The collection has a generation, kept in
+    mongo so every process shares it, that every write through BaseAsyncMotorDocument increments, including the
+    writes of scheduler pops in the leader process.  An entry is only used while the generation it was filled in
+    is current, and the shared generation is read again at most every generation_check_in_seconds, which bounds
+    how long a write from another process goes unseen.
+    """
+
+    MAX_ENTRIES = 1024
+    TTL_IN_SECONDS = 30
+    GENERATION_CHECK_IN_SECONDS = 1
+
+    def __init__(self, max_entries=None, ttl_in_seconds=None, generation_check_in_seconds=None):
+        """
+        Constructor
+
+        :param int max_entries: The number of results kept, the least recently used are evicted first
+        :param int ttl_in_seconds: How long a result is kept
+        :param float generation_check_in_seconds: How long the shared generation is trusted before it is read again
+        """
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.ttl = ttl_in_seconds or self.TTL_IN_SECONDS
+        self.generation_check = self.GENERATION_CHECK_IN_SECONDS if generation_check_in_seconds is None \
+            else generation_check_in_seconds
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.checked_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(*args):
+        """Normalize a query and its options into a key, the same query with its keys in any order gives the same key
+
+        :rtype: str
+        """
+        return json_util.dumps(args, sort_keys=True)
+
+    @property
+    def hit_ratio(self):
+        """The share of lookups answered from the cache
+
+        :rtype: float
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def get(self, key):
+        """Get a cached result
+
+        :param str key: The key
+        :returns: A copy of the result, or None when it isn't cached, expired or from an older generation
+        """
+        entry = self.entries.get(key)
+
+        if entry is None or entry["generation"] != self.generation or entry["expires_at"] < time.time():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        #Move it to the most recently used end
+        self.entries[key] = self.entries.pop(key)
+        self.hits += 1
+        return copy.deepcopy(entry["result"])
+
+    def put(self, key, result, generation):
+        """Cache a result, evicting the least recently used one when full
+
+        :param str key: The key
+        :param result: The result
+        :param int generation: The generation when the query was sent, a write since then makes the result stale
+        """
+        if generation != self.generation:
+            return
+
+        self.entries.pop(key, None)
+        self.entries[key] = {
+            "result": copy.deepcopy(result),
+            "generation": generation,
+            "expires_at": time.time() + self.ttl
+        }
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @property
+    def generation_checked(self):
+        """Whether the shared generation was read recently enough to be trusted
+
+        :rtype: bool
+        """
+        return self.checked_at is not None and time.time() - self.checked_at < self.generation_check
+
+    def advance(self, generation):
+        """Move to the shared generation read from mongo, a different one makes every cached result stale
+
+        :param int generation: The shared generation
+        """
+        if generation != self.generation:
+            self.generation = generation
+            self.entries.clear()
+
+        self.checked_at = time.time()
+
+class CollectionReplica(object):
+    """A full in memory copy of a small, read mostly collection, with secondary indexes on chosen fields.
+
+    The copy is loaded on first use, then refreshed by polling for documents whose modified field changed since
+    the last poll, at most every refresh_in_seconds.  The modified field is stamped with the clock of the writing
+    process, so a poll goes back clock_skew_in_seconds before the newest stamp it has seen, a write stamped by a
+    clock further behind is only seen by the next full reload.  A poll can't see documents removed by other
+    processes, so the copy is also reloaded in full every reload_in_seconds.  Writes through BaseAsyncMotorDocument
+    stamp the modified field and update the copy of this process straight away.
+
+    Only queries made of equality tests on plain values can be answered locally, see can_answer.
+    """
+
+    REFRESH_IN_SECONDS = 5
+    RELOAD_IN_SECONDS = 300
+    MODIFIED_FIELD = "modified_at"
+    CLOCK_SKEW_IN_SECONDS = 5
+
+    def __init__(self, indexes=None, refresh_in_seconds=None, reload_in_seconds=None, modified_field=None,
+                 clock_skew_in_seconds=None):
+        """
+        Constructor
+
+        :param list indexes: The fields to index
+        :param int refresh_in_seconds: How often modified documents are polled for
+        :param int reload_in_seconds: How often the whole collection is reloaded
+        :param str modified_field: The field holding the time a document was last written
+        :param float clock_skew_in_seconds: How far the clocks of the writing processes may be apart
+        """
+        self.index_fields = list(indexes or [])
+        self.refresh_interval = refresh_in_seconds if refresh_in_seconds is not None else self.REFRESH_IN_SECONDS
+        self.reload_interval = reload_in_seconds if reload_in_seconds is not None else self.RELOAD_IN_SECONDS
+        self.modified_field = modified_field or self.MODIFIED_FIELD
+        self.clock_skew = clock_skew_in_seconds if clock_skew_in_seconds is not None else self.CLOCK_SKEW_IN_SECONDS
+        self.documents = {}
+        self.indexes = dict((field, {}) for field in self.index_fields)
+        self.loaded_at = None
+        self.refreshed_at = None
+        self.watermark = None
+        self.refreshing = None
+
+    def __len__(self):
+        return len(self.documents)
+
+    @staticmethod
+    def value_key(value):
+        """A hashable key for a plain value, which keeps booleans apart from numbers like mongo does
+
+        :returns: The key, or None when the value can't be compared locally
+        """
+        if isinstance(value, ObjectId):
+            value = str(value)
+
+        if isinstance(value, bool):
+            return "bool", value
+
+        if isinstance(value, numbers.Number):
+            return "number", value
+
+        if value is None or isinstance(value, (str, type(u""))):
+            return "value", value
+
+        return None
+
+    @staticmethod
+    def field_value(document, field):
+        """Get a field of a document, following dots into sub documents"""
+        if field == "_id":
+            field = "id"
+
+        value = document
+        for part in field.split("."):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+
+        return value
+
+    def __value_keys(self, document, field):
+        """The keys a document is indexed under for a field, an array is indexed under each of its items"""
+        value = self.field_value(document, field)
+        values = value if isinstance(value, list) else [value]
+
+        keys = set()
+        for item in values:
+            key = self.value_key(item)
+            if key is not None:
+                keys.add(key)
+
+        return keys
+
+    def put(self, document):
+        """Add or replace a json ready document
+
+        :param dict document: The document, with its id
+        """
+        self.remove(document.get("id"))
+        self.documents[document.get("id")] = document
+
+        for field in self.index_fields:
+            for key in self.__value_keys(document, field):
+                self.indexes[field].setdefault(key, set()).add(document.get("id"))
+
+        modified = document.get(self.modified_field)
+        if isinstance(modified, numbers.Number) and (self.watermark is None or modified > self.watermark):
+            self.watermark = modified
+
+    def remove(self, _id):
+        """Remove a document
+
+        :param str _id: The document id
+        """
+        document = self.documents.pop(_id, None)
+
+        if document is None:
+            return
+
+        for field in self.index_fields:
+            for key in self.__value_keys(document, field):
+                ids = self.indexes[field].get(key)
+                if ids is not None:
+                    ids.discard(_id)
+                    if not ids:
+                        del self.indexes[field][key]
+
+    def clear(self):
+        """Forget every document, the next read reloads the collection"""
+        self.documents = {}
+        self.indexes = dict((field, {}) for field in self.index_fields)
+        self.loaded_at = None
+        self.refreshed_at = None
+        self.watermark = None
+
+    def can_answer(self, query, projection=None):
+        """Whether a query can be answered locally, it has to be made only of equality tests on plain values
+
+        :param dict query: The query
+        :param dict projection: The fields to return, only whole documents are answered locally
+        :rtype: bool
+        """
+        if projection is not None:
+            return False
+
+        for field, value in (query or {}).items():
+            if field.startswith("$") or self.value_key(value) is None:
+                return False
+
+        return True
+
+    def __matches(self, document, field, key):
+        value = self.field_value(document, field)
+        values = value if isinstance(value, list) else [value]
+        return any(self.value_key(item) == key for item in values)
+
+    def find(self, query, orderby=None, order_by_direction=1, page=0, limit=0):
+        """Answer a query locally, the query has to pass can_answer
+
+        :param dict query: The query
+        :param str orderby: The attribute to order results by
+        :param int order_by_direction: 1 or -1
+        :param int page: The page to return
+        :param int limit: Number of results per page
+        :returns: Copies of the matching documents
+        :rtype: list
+        """
+        conditions = [(field, self.value_key(value)) for field, value in (query or {}).items()]
+
+        #Start from the smallest index that applies, or from an id lookup
+        candidates = None
+        for field, key in conditions:
+            if field in ["_id", "id"]:
+                ids = set([key[1]]) if key[1] in self.documents else set()
+            elif field in self.indexes:
+                ids = self.indexes[field].get(key, set())
+            else:
+                continue
+
+            if candidates is None or len(ids) < len(candidates):
+                candidates = ids
+
+        documents = [self.documents[_id] for _id in candidates] if candidates is not None \
+            else list(self.documents.values())
+
+        results = [document for document in documents
+                   if all(self.__matches(document, field, key) for field, key in conditions)]
+
+        if orderby:
+            #Ranked by type like mongo, missing values first, so mixed types don't raise a TypeError
+            results.sort(key=functools.cmp_to_key(lambda a, b: _compare(self.field_value(a, orderby),
+                                                                        self.field_value(b, orderby))),
+                         reverse=order_by_direction == -1)
+
+        if limit:
+            results = results[page*limit:(page+1)*limit]
+
+        return copy.deepcopy(results)
+
+    def find_one_by_id(self, _id):
+        """Get a copy of a document by id
+
+        :param str _id: The document id
+        :rtype: dict
+        """
+        return copy.deepcopy(self.documents.get(str(_id)))
+
+    @coroutine
+    def sync(self, document_client):
+        """Load or refresh the copy when it is due, concurrent callers wait for the same refresh
+
+        :param BaseAsyncMotorDocument document_client: The client of the collection
+        """
+        now = time.time()
+
+        if self.loaded_at is not None and now - self.refreshed_at < self.refresh_interval:
+            return
+
+        if self.refreshing is not None:
+            yield self.refreshing
+            return
+
+        self.refreshing = Future()
+
+        try:
+            if self.loaded_at is None or now - self.loaded_at >= self.reload_interval:
+                yield self.__load(document_client, {})
+                self.loaded_at = now
+            else:
+                yield self.__load(document_client, {self.modified_field: {"$gte": self.watermark - self.clock_skew}}
+                                  if self.watermark is not None else {})
+
+            self.refreshed_at = now
+        finally:
+            refreshing, self.refreshing = self.refreshing, None
+            refreshing.set_result(None)
+
+    @coroutine
+    def __load(self, document_client, query):
+        cursor = document_client.collection.find(query)
+
+        documents = []
+        while (yield cursor.fetch_next):
+            documents.append(document_client._obj_cursor_to_dictionary(cursor.next_object()))
+
+        if not query:
+            self.clear()
+
+        for document in documents:
+            self.put(document)
+
+class BaseAsyncMotorDocument(object):
+    """Concrete abstract class for a mongo collection and document interface
+
+    This class simplifies the use of the motor library, encoding/decoding special types, etc
+    """
+
+    def __init__(self, collection_name, settings, schema=None, scheduleable=False):
+
+        """
+        Constructor
+
+        :param str collection_name: The name of the collection you want to operate on
+        :param dict settings: The application settings
+        :param dict schema: A JSON Schema definition for this object type, used for validation
+        :param bool scheduleable: Whether or not this document is scheduleable
+
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.settings = settings
+        self.storage = get_storage_backend(self.settings)
+        self.client = self.storage.database
+        self.scheduleable = scheduleable
+        self.collection_name = collection_name
+        self.revisions_collection = self.storage.collection("revisions")
+        self.collection = self.storage.collection(collection_name)
+        self.schema = schema
+        self.slow_log = self.get_slow_log(self.settings)
+        self.metrics = get_metrics_sink(self.settings) if self.__reports_metrics() else None
+
+    #Shared instances, least recently used first, see BaseAsyncMotorDocument.shared
+    shared_instances = OrderedDict()
+
+    #How many shared instances are kept
+    MAX_SHARED_INSTANCES = 256
+
+    #Where operation durations are recorded, see BaseAsyncMotorDocument.with_timings
+    timings = None
+
+    #The handler using this client, for the slow operation log
+    handler = None
+
+    #See BaseAsyncMotorDocument.get_slow_log
+    slow_log = None
 
-        # We shall never store the _id to a patch dictionary
-        if patch and patch.get("_id"):
-            del patch["_id"]
+    #The metrics sink, when settings["document_metrics"] covers this collection
+    metrics = None
 
-        change = {
-            "toa": toa,
-            "processed": False,
-            "collection": self.collection_name,
-            "master_id": self.master_id,
-            "action": action,
-            "patch" : None if action == self.DELETE_ACTION else self.collection._dictionary_to_cursor(patch),
-            "meta": meta
-        }
+    def __reports_metrics(self):
+        """Whether operations on this collection are reported to the metrics sink.  settings["document_metrics"]
+        is off by default, True reports every collection, a list of names only reports those, which bounds the
+        collection label when collection names come from requests.
 
-        jsonschema.validate(change, self.SCHEMA)
+        :rtype: bool
+        """
+        config = self.settings.get("document_metrics", False)
 
-        id = yield self.revisions.insert(change)
+        if isinstance(config, (list, tuple, set)):
+            return self.collection_name in config
 
-        raise Return(id)
+        return bool(config)
 
-    @coroutine
-    def list(self, toa=None, show_history=False):
-        """Return all revisions for this stack
+    def with_timings(self, timings, handler=None):
+        """Get a copy of this client that records the duration of its operations, typically one per request.
+        The copy shares the collection and the caches of this client.
 
-        :param int toa: The time of action as a UTC timestamp
-        :param bool show_history: Whether to show historical revisions
+        :param OperationTimings timings: Where to record the durations, can be None
+        :param str handler: The name of the handler using the copy, reported in the slow operation log
+        :rtype: BaseAsyncMotorDocument
         """
-        if not toa:
-            toa = time.mktime(datetime.datetime.now().timetuple())
+        client = copy.copy(self)
+        client.timings = timings
+        client.handler = handler
+        return client
 
-        query = {
-            "$query": {
-                "master_id": self.master_id,
-                "processed": show_history,
-                "toa" : {"$lte" : toa}
-            },
-            "$orderby": {
-                "toa": 1
-            }
-        }
+    #The settings key the slow operation log is kept under, see BaseAsyncMotorDocument.get_slow_log
+    SLOW_LOG_SETTING = "_slow_operation_log"
 
-        revisions = yield self.revisions.find(query)
+    @classmethod
+    def get_slow_log(cls, settings):
+        """The slow operation log configured in settings["slow_operations"]::
 
-        raise Return(revisions)
+            {
+                "threshold_in_milliseconds": 100,   # operations taking at least this long are recorded
+                "max_shapes": 500                   # query shapes kept
+            }
 
+        The log is kept in the settings, so it lives as long as they do.  A copy of the settings with its own
+        slow_operations gets its own log.
 
-    @coroutine
-    def _lazy_migration(self, patch=None, meta=None, toa=None):
+        :param dict settings: The application settings
+        :returns: The log, or None when it isn't configured
+        :rtype: SlowOperationLog
         """
-        Handle when a revision scheduling is turned onto a collection that was previously not scheduleable.
-        This method will create the first revision for each object before its every used in the context of scheduling.
+        config = settings.get("slow_operations")
 
-        :param dict patch: The patch that should be used
-        :param dict meta: Meta data for this action
-        :param int toa: The time of action
-        :return: A legacy revision for a document that was previously
-        :rtype: list
-        """
-        objects = yield self.revisions.find({"master_id": self.master_id}, limit=1)
+        if config is None:
+            return None
 
-        if len(objects) > 0:
-            raise Return(objects)
+        log = settings.get(cls.SLOW_LOG_SETTING)
 
-        if not patch:
-            patch = yield self.collection.find_one_by_id(self.master_id)
+        if log is None or log.config is not config:
+            log = SlowOperationLog(threshold_in_milliseconds=config.get("threshold_in_milliseconds"),
+                                   max_shapes=config.get("max_shapes"))
+            log.config = config
+            settings[cls.SLOW_LOG_SETTING] = log
 
-        if not toa:
-             toa = long(time.mktime(datetime.datetime.now().timetuple()))
+        return log
 
-        meta["comment"] = "This document was migrated automatically."
+    #Process wide geo tile caches by collection, see BaseAsyncMotorDocument.geo_cache
+    geo_caches = {}
 
-        if isinstance(patch, dict) and patch.get("id"):
-            del patch["id"]
+    #Process wide query result caches by collection, see BaseAsyncMotorDocument.query_cache
+    query_caches = {}
 
-        if isinstance(patch, dict) and patch.get("_id"):
-            del patch["_id"]
+    @property
+    def query_cache(self):
+        """The result cache of find and count, for the collections listed in settings["query_cache"]::
 
-        #Here we separate patch and snapshot, and make sure that the snapshot looks like the master document
-        snapshot = copy.deepcopy(patch)
-        snapshot["id"] = self.master_id
-        snapshot["published"] = self.settings.get("scheduler", {}).get("lazy_migrated_published_by_default", False)
+            {
+                "collections": ["products"],    # collections whose query results are cached
+                "max_entries": 1024,            # results kept per collection
+                "ttl_in_seconds": 30,           # how long a result is kept
+                "generation_check_in_seconds": 1    # how often writes from other processes are looked for
+            }
 
-        #If no objects are returned, this is some legacy object that needs a first revision
-        #Create it here
-        legacy_revision = {
-            "toa": toa,
-            "processed": True,
-            "collection": self.collection_name,
-            "master_id": self.master_id,
-            "action": self.INSERT_ACTION,
-            "patch": self.collection._dictionary_to_cursor(patch),
-            "snapshot": snapshot,
-            "meta": meta,
-        }
+        The scheduler has to run with the same setting, so its pops make the other processes' results stale.
 
-        response = yield self.revisions.insert(legacy_revision)
-        if isinstance(response, str):
-            raise Return([legacy_revision])
+        :returns: The cache, or None when this collection isn't cached
+        :rtype: QueryResultCache
+        """
+        config = self.settings.get("query_cache")
 
-        raise Return(None)
+        if not config or self.collection_name not in config.get("collections", []):
+            return None
+
+        key = (id(self.settings), self.collection_name)
+
+        if key not in self.query_caches:
+            self.query_caches[key] = QueryResultCache(
+                max_entries=config.get("max_entries"),
+                ttl_in_seconds=config.get("ttl_in_seconds"),
+                generation_check_in_seconds=config.get("generation_check_in_seconds"))
+
+        return self.query_caches[key]
+
+    #The collection holding the shared query cache generations, one document per collection
+    QUERY_CACHE_GENERATIONS = "query_cache_generations"
 
     @coroutine
-    def __create_preview_object_base(self, dct):
+    def __check_generation(self, cache):
+        """Read the shared generation of the query cache, unless it was read recently
+
+        :param QueryResultCache cache: The cache
         """
-        The starting point for a preview of a future object.
-        This is the object which will have future revisions iterated and applied to.
+        if cache.generation_checked:
+            return
 
-        :param dict dct: The starting object dictionary
-        :return: The preview object id
-        :rtype: str
+        shared = yield self.storage.collection(self.QUERY_CACHE_GENERATIONS).find_one({"_id": self.collection_name})
+        cache.advance(shared.get("generation", 0) if shared else 0)
+
+    def __cached(self, cache, key):
+        """Look a result up in the query cache, and report the lookup to the metrics sink
 
+        :param QueryResultCache cache: The cache
+        :param str key: The key
+        :returns: The result, or None
         """
-        if dct.get("_id"):
-            del dct["_id"]
+        result = cache.get(key)
 
-        preview_object_id = yield self.previews.insert(dct)
+        metrics = get_metrics_sink(self.settings)
+        tags = {"collection": self.collection_name}
+        metrics.increment("query_cache_misses_total" if result is None else "query_cache_hits_total", tags=tags)
+        metrics.gauge("query_cache_hit_ratio", cache.hit_ratio, tags)
+        metrics.gauge("query_cache_entries", len(cache), tags)
 
-        raise Return(preview_object_id)
+        return result
 
-    @coroutine
-    def preview(self, revision_id):
-        """Get an ephemeral preview of a revision with all revisions applied between it and the current state
+    @property
+    def geo_cache(self):
+        """The tile cache of location_based_search, for the collections listed in settings["geo_cache"]::
 
-        :param str revision_id: The ID of the revision state you want to preview the master id at.
-        :return: A snapshot of a future state of the object
-        :rtype: dict
+            {
+                "collections": ["stores"],  # collections whose location searches are cached
+                "precision": 5,             # geohash characters of a tile
+                "ttl_in_seconds": 60,       # how long a tile is kept
+                "max_tiles": 1024           # tiles kept per collection
+            }
+
+        :returns: The cache, or None when this collection isn't cached
+        :rtype: GeoTileCache
         """
+        config = self.settings.get("geo_cache")
 
-        target_revision = yield self.revisions.find_one_by_id(revision_id)
+        if not config or self.collection_name not in config.get("collections", []):
+            return None
 
-        if isinstance(target_revision.get("snapshot"), dict):
-            raise Return(target_revision)
+        key = (id(self.settings), self.collection_name)
 
-        preview_object = None
+        if key not in self.geo_caches:
+            self.geo_caches[key] = GeoTileCache(precision=config.get("precision"),
+                                                ttl_in_seconds=config.get("ttl_in_seconds"),
+                                                max_tiles=config.get("max_tiles"))
 
-        if not isinstance(target_revision, dict):
-            raise RevisionNotFound()
+        return self.geo_caches[key]
 
-        revision_collection_client = BaseAsyncMotorDocument(target_revision.get("collection"), self.settings)
+    #Process wide in memory copies by collection, see BaseAsyncMotorDocument.replica
+    replicas = {}
 
-        self.master_id = target_revision.get("master_id")
+    @property
+    def replica(self):
+        """The in memory copy of this collection, for the collections in settings["replicas"]::
 
-        action = target_revision.get("action")
+            {
+                "store_configs": {
+                    "indexes": ["store_id", "region"],  # fields with a secondary index
+                    "refresh_in_seconds": 5,            # how often modified documents are polled for
+                    "reload_in_seconds": 300,           # how often the whole collection is reloaded
+                    "modified_field": "modified_at",    # field stamped with the time of every write
+                    "clock_skew_in_seconds": 5          # how far the writing processes' clocks may be apart
+                }
+            }
 
-        if action == self.DELETE_ACTION:
-            raise Return(preview_object)
+        :returns: The copy, or None when this collection isn't replicated
+        :rtype: CollectionReplica
+        """
+        config = self.settings.get("replicas")
 
-        if action in [self.INSERT_ACTION, self.UPDATE_ACTION]:
+        if not config or self.collection_name not in config:
+            return None
 
-            revisions = yield self.list(toa=target_revision.get("toa"))
+        key = (id(self.settings), self.collection_name)
 
-            if len(revisions) == 0:
-                raise NoRevisionsAvailable()
+        if key not in self.replicas:
+            collection_config = config.get(self.collection_name) or {}
+            self.replicas[key] = CollectionReplica(indexes=collection_config.get("indexes"),
+                                                   refresh_in_seconds=collection_config.get("refresh_in_seconds"),
+                                                   reload_in_seconds=collection_config.get("reload_in_seconds"),
+                                                   modified_field=collection_config.get("modified_field"),
+                                                   clock_skew_in_seconds=collection_config.get("clock_skew_in_seconds"))
 
-            first_revision = revisions[0]
-            current_document = None
+        return self.replicas[key]
 
+    def __validate(self, dct):
+        """Validate a document against the schema of this collection
 
-            if first_revision.get("action") == self.UPDATE_ACTION:
-                current_document = yield revision_collection_client.find_one_by_id(target_revision.get("master_id"))
+        :param dict dct: The document
+        :raises ValidationError: The document isn't valid
+        """
+        if self.timings is None:
+            schema_validators.validate(dct, self.schema)
+            return
 
-            elif first_revision.get("action") == self.INSERT_ACTION:
-                # If we are doing an insert, the first revision patch is the current state
-                current_document = first_revision.get("patch")
+        started = time.time()
+        try:
+            schema_validators.validate(dct, self.schema)
+        finally:
+            self.timings.record("validate", time.time() - started)
 
-            if not current_document:
-                raise RevisionNotFound()
+    def __stamp_modified(self, dct):
+        """Record the time of a write on a replicated collection, so the other processes' copies see it
 
-            preview_id = yield self.__create_preview_object_base(current_document)
+        :param dict dct: The document or attributes being written, it isn't changed
+        :returns: A stamped copy, or dct itself when the collection isn't replicated
+        :rtype: dict
+        """
+        replica = self.replica
 
-            for revision in revisions:
-                patch = revision.get("patch")
+        if replica is None:
+            return dct
 
-                if patch.get("_id"):
-                    del patch["_id"]
+        stamped = dict(dct)
+        stamped[replica.modified_field] = time.time()
+        return stamped
 
-                yield self.previews.patch(preview_id, self.__make_storeable_patch_patchable(patch))
+    @coroutine
+    def _invalidate_caches(self, _id=None, document=None):
+        """Called after every write, to drop what the caches hold about the written document
 
-            preview_object = yield self.previews.find_one_by_id(preview_id)
+        :param _id: The id of the written document, None when the write wasn't by id
+        :param dict document: The written attributes, when they are known
+        """
+        query_cache = self.query_cache
 
+        if query_cache is not None:
+            shared = yield self.storage.collection(self.QUERY_CACHE_GENERATIONS).find_and_modify(
+                {"_id": self.collection_name}, {"$inc": {"generation": 1}}, upsert=True, new=True)
+            query_cache.advance(shared.get("generation", 0))
 
-            preview_object["id"] = target_revision["id"]
-            target_revision["snapshot"] = self.collection._obj_cursor_to_dictionary(preview_object)
-            target_revision["snapshot"]["id"] = target_revision["master_id"]
+        replica = self.replica
 
-            # Delete the last preview
-            yield self.previews.delete(preview_id)
+        if replica is not None and replica.loaded_at is not None:
+            if _id is None:
+                replica.clear()
+            else:
+                current = yield self.collection.find_one({"_id": ObjectId(_id)})
 
-        raise Return(target_revision)
+                if current is None:
+                    replica.remove(str(_id))
+                else:
+                    replica.put(self._obj_cursor_to_dictionary(current))
 
+        geo_cache = self.geo_cache
 
-    @coroutine
-    def peek(self):
-        """Return the top object on the stack for this ID
+        if geo_cache is None or len(geo_cache) == 0:
+            return
 
-        :returns: The next revision
-        :rtype: dict
-        """
-        revisions = yield self.list()
-        raise Return(revisions[0] if len(revisions) > 0 else None)
+        if _id is None:
+            geo_cache.clear()
+            return
 
+        _id = str(_id)
 
-class BaseAsyncMotorDocument(object):
-    """Concrete abstract class for a mongo collection and document interface
+        if document is not None and "loc" in document:
+            location = document.get("loc")
+        else:
+            #The location wasn't written, the document may have moved into a filter where it is
+            current = yield self.collection.find_one({"_id": ObjectId(_id)}, {"loc": 1})
+            location = current.get("loc") if current else None
 
-    This class simplifies the use of the motor library, encoding/decoding special types, etc
-    """
+        coordinates = _location_coordinates(location)
 
-    def __init__(self, collection_name, settings, schema=None, scheduleable=False):
+        if location is not None and coordinates is None:
+            geo_cache.clear()
+            return
 
-        """
-        Constructor
+        geo_cache.invalidate(_id=_id, location=coordinates)
+
+    @classmethod
+    def shared(cls, collection_name, settings, schema=None):
+        """Get a process wide client for a collection, it is created on first use and reused afterwards.
+
+        Clients are shared per settings dictionary, collection name and schema, so this is safe to call
+        for every request or revision instead of building a new client each time.  At most MAX_SHARED_INSTANCES
+        clients are kept, the least recently used is dropped first.  A kept client holds on to its settings and
+        schema, so their ids can't be reused by other objects while it is kept.
 
         :param str collection_name: The name of the collection you want to operate on
         :param dict settings: The application settings
         :param dict schema: A JSON Schema definition for this object type, used for validation
-        :param bool scheduleable: Whether or not this document is scheduleable
-
+        :rtype: BaseAsyncMotorDocument
         """
-        self.logger = logging.getLogger(self.__class__.__name__)
-        self.settings = settings
-        self.client = self.settings.get("db")
+        key = (cls, id(settings), collection_name, id(schema))
+        instance = cls.shared_instances.pop(key, None)
 
-        assert self.client is not None
-        self.scheduleable = scheduleable
-        self.collection_name = collection_name
-        self.revisions_collection = self.client["revisions"]
-        self.collection = self.client[collection_name]
-        self.schema = schema
+        if instance is None or instance.settings is not settings or instance.schema is not schema:
+            instance = cls(collection_name, settings, schema=schema)
+
+        cls.shared_instances[key] = instance
+
+        while len(cls.shared_instances) > cls.MAX_SHARED_INSTANCES:
+            cls.shared_instances.popitem(last=False)
+
+        return instance
 
+    @_timed("insert", "insert", _argument("dct", 0))
     @coroutine
     def insert(self, dct, toa=None, comment=""):
         """Create a document
@@ -590,10 +3170,14 @@ class BaseAsyncMotorDocument(object):
         :returns string bson id:
         """
         if self.schema:
-            jsonschema.validate(dct, self.schema)
+            self.__validate(dct)
+
+        dct = self.__stamp_modified(dct)
 
         bson_obj = yield self.collection.insert(dct)
 
+        yield self._invalidate_caches(bson_obj, dct)
+
         raise Return(bson_obj.__str__())
 
     @coroutine
@@ -610,6 +3194,7 @@ class BaseAsyncMotorDocument(object):
 
         raise Return(mongo_response)
 
+    @_timed("update", "update", _predicate("attribute", 3))
     @coroutine
     def update(self, predicate_value, dct, upsert=False, attribute="_id"):
         """Update an existing document
@@ -621,7 +3206,7 @@ class BaseAsyncMotorDocument(object):
         :returns: JSON Mongo client response including the "n" key to show number of objects effected
         """
         if self.schema:
-            jsonschema.validate(dct, self.schema)
+            self.__validate(dct)
 
         if attribute=="_id" and not isinstance(predicate_value, ObjectId):
             predicate_value = ObjectId(predicate_value)
@@ -630,12 +3215,16 @@ class BaseAsyncMotorDocument(object):
 
 
         dct = self._dictionary_to_cursor(dct)
+        dct = self.__stamp_modified(dct)
 
         mongo_response = yield self.collection.update(predicate, dct, upsert)
 
+        yield self._invalidate_caches(predicate_value if attribute == "_id" else None, dct)
+
         raise Return(self._obj_cursor_to_dictionary(mongo_response))
 
 
+    @_timed("patch", "update", _predicate("predicate_attribute", 2))
     @coroutine
     def patch(self, predicate_value, attrs, predicate_attribute="_id"):
         """Update an existing document via a $set query, this will apply only these attributes.
@@ -656,12 +3245,17 @@ class BaseAsyncMotorDocument(object):
         if dct.get("_id"):
             del dct["_id"]
 
+        dct = self.__stamp_modified(dct)
+
         set = { "$set": dct }
 
         mongo_response = yield self.collection.update(predicate, set, False)
 
+        yield self._invalidate_caches(predicate_value if predicate_attribute == "_id" else None, dct)
+
         raise Return(self._obj_cursor_to_dictionary(mongo_response))
 
+    @_timed("delete", "remove", _predicate())
     @coroutine
     def delete(self, _id):
         """Delete a document or create a DELETE revision
@@ -671,8 +3265,11 @@ class BaseAsyncMotorDocument(object):
         """
         mongo_response = yield self.collection.remove({"_id": ObjectId(_id)})
 
+        yield self._invalidate_caches(_id)
+
         raise Return(mongo_response)
 
+    @_timed("find_one", "find", _argument("query", 0))
     @coroutine
     def find_one(self, query):
         """Find one wrapper with conversion to dictionary
@@ -682,8 +3279,9 @@ class BaseAsyncMotorDocument(object):
         mongo_response = yield self.collection.find_one(query)
         raise Return(self._obj_cursor_to_dictionary(mongo_response))
 
+    @_timed("find", "find", _argument("query", 0))
     @coroutine
-    def find(self, query, orderby=None, order_by_direction=1, page=0, limit=0):
+    def find(self, query, orderby=None, order_by_direction=1, page=0, limit=0, projection=None):
         """Find a document by any criteria
 
         :param dict query: The query to perform
@@ -691,12 +3289,29 @@ class BaseAsyncMotorDocument(object):
         :param int order_by_direction: 1 or -1
         :param int page: The page to return
         :param int limit: Number of results per page
+        :param dict projection: The fields to return, ie {"toa": 1}, None returns the whole document
         :returns: A list of results
         :rtype: list
 
         """
+        replica = self.replica
+
+        if replica is not None and replica.can_answer(query, projection):
+            yield replica.sync(self)
+            raise Return(replica.find(query, orderby=orderby, order_by_direction=order_by_direction,
+                                      page=page, limit=limit))
 
-        cursor = self.collection.find(query)
+        cache = self.query_cache
+
+        if cache is not None:
+            yield self.__check_generation(cache)
+            key = cache.key("find", query, orderby, order_by_direction, page, limit, projection)
+            results = self.__cached(cache, key)
+            if results is not None:
+                raise Return(results)
+            generation = cache.generation
+
+        cursor = self.collection.find(query, projection)
 
         if orderby:
             cursor.sort(orderby, order_by_direction)
@@ -707,8 +3322,85 @@ class BaseAsyncMotorDocument(object):
         while (yield cursor.fetch_next):
             results.append(self._obj_cursor_to_dictionary(cursor.next_object()))
 
+        if cache is not None:
+            cache.put(key, results, generation)
+
         raise Return(results)
 
+    @_timed("count")
+    @coroutine
+    def count(self, query=None, estimated=False):
+        """Count the documents matching a query on the server, without loading them
+
+        :param dict query: The query to perform, None counts the whole collection
+        :param bool estimated: Count an unfiltered collection from its metadata instead of scanning an index,
+            which is much faster on large collections but may be off after an unclean shutdown.  It is ignored
+            when there is a query.
+        :returns: The number of matching documents
+        :rtype: int
+        """
+        cache = self.query_cache
+
+        if cache is not None:
+            yield self.__check_generation(cache)
+            key = cache.key("count", query or {}, estimated)
+            count = self.__cached(cache, key)
+            if count is not None:
+                raise Return(count)
+            generation = cache.generation
+
+        if estimated and not query:
+            count = yield self.collection.count()
+        else:
+            count = yield self.collection.find(query or {}).count()
+
+        if cache is not None:
+            cache.put(key, count, generation)
+
+        raise Return(count)
+
+    @_timed("group_by")
+    @coroutine
+    def group_by(self, attr, query=None, orderby=None, order_by_direction=1, valueLabel="value",
+                 childrenLabel="children"):
+        """Group the documents matching a query by the value of an attribute, with a mongo aggregation.
+        Groups are sorted by their value, and each group has to fit in a single mongo document.
+
+        :param str attr: The attribute that the documents should be grouped upon
+        :param dict query: The query to perform, None groups the whole collection
+        :param str orderby: The attribute to order the children of a group by
+        :param int order_by_direction: 1 or -1
+        :param str valueLabel: What to call the key of the field we're grouping upon
+        :param str childrenLabel: What to call the list of child objects on the group object
+        :returns: list of grouped objects by a given attribute, like group_documents_by
+        :rtype: list
+        """
+        pipeline = [{"$match": query or {}}]
+
+        if orderby:
+            pipeline.append({"$sort": {orderby: order_by_direction}})
+
+        pipeline.append({"$group": {"_id": "$%s" % attr, "children": {"$push": "$$ROOT"}}})
+        pipeline.append({"$sort": {"_id": 1}})
+
+        response = yield self.collection.aggregate(pipeline)
+
+        #Older drivers answer with the command response, newer ones with the documents
+        if isinstance(response, dict):
+            response = response.get("result", [])
+
+        groups = []
+        for group in response:
+            groups.append({
+                "attribute": attr,
+                #Ids and dates are converted like the children, so the groups serialize to JSON
+                valueLabel: json.loads(json.dumps(group.get("_id"), cls=BSONEncoder)),
+                childrenLabel: self._list_cursor_to_json(group.get("children"))
+            })
+
+        raise Return(groups)
+
+    @_timed("find_one_by_id", "find", _predicate())
     @coroutine
     def find_one_by_id(self, _id):
         """
@@ -719,6 +3411,14 @@ class BaseAsyncMotorDocument(object):
         :rtype: dict
 
         """
+        replica = self.replica
+
+        if replica is not None:
+            #Check the id first, like the query would
+            ObjectId(_id)
+            yield replica.sync(self)
+            raise Return(replica.find_one_by_id(_id))
+
         document = (yield self.collection.find_one({"_id": ObjectId(_id)}))
         raise Return(self._obj_cursor_to_dictionary(document))
 
@@ -726,9 +3426,14 @@ class BaseAsyncMotorDocument(object):
     def create_index(self, index, index_type=GEO2D):
         """Create an index on a given attribute
 
-        :param str index: Attribute to set index on
+        :param index: Attribute to set index on, or a list of (attribute, index type) pairs for a compound index
         :param str index_type: See PyMongo index types for further information, defaults to GEO2D index.
         """
+        if isinstance(index, list):
+            self.logger.info("Adding compound index to %s on attributes: %s" % (self.collection_name, index))
+            yield self.collection.create_index(index)
+            return
+
         self.logger.info("Adding %s index to stores on attribute: %s" % (index_type, index))
         yield self.collection.create_index([(index, index_type)])
 
@@ -749,9 +3454,15 @@ class BaseAsyncMotorDocument(object):
 
         #Determine what type of radian conversion you want base on a unit of measure
         if unit == "miles":
-            distance = float(distance/69)
+            distance = float(distance)/69
         else:
-            distance = float(distance/111.045)
+            distance = float(distance)/111.045
+
+        geo_cache = self.geo_cache
+
+        if geo_cache is not None:
+            results = yield self.__cached_location_search(geo_cache, lng, lat, distance, attribute_map)
+            raise Return(results[page*limit:(page+1)*limit] if limit else results)
 
         #Start with geospatial query
         query = {
@@ -763,11 +3474,149 @@ class BaseAsyncMotorDocument(object):
 
         #Allow querying additional attributes
         if attribute_map:
-            query = dict(query.items() + attribute_map.items())
+            query.update(attribute_map)
 
+        #find already returns json ready documents
         results = yield self.find(query, page=page, limit=limit)
 
-        raise Return(self._list_cursor_to_json(results))
+        raise Return(results)
+
+    @coroutine
+    def __cached_location_search(self, geo_cache, lng, lat, distance, attribute_map):
+        """Answer a location search from the tile its center is in, querying mongo for the tile on a miss
+
+        :param GeoTileCache geo_cache: The cache
+        :param float lng: Longitude parameter
+        :param float lat: Latitude parameter
+        :param float distance: The radius of the query, in degrees
+        :param dict attribute_map: Additional attributes to apply to the location bases query
+        :returns: Every object within the distance
+        :rtype: list
+        """
+        key, center, radius = geo_cache.tile(lng, lat, distance, attribute_map)
+        documents = geo_cache.get(key)
+
+        if documents is None:
+            query = {
+                "loc": {
+                    "$within": {
+                        "$center": [center, radius]}
+                    }
+            }
+
+            if attribute_map:
+                query.update(attribute_map)
+
+            documents = yield self.find(query)
+            geo_cache.put(key, center, radius, documents)
+
+        results = []
+        for document in documents:
+            coordinates = _location_coordinates(document.get("loc"))
+
+            #Copies, so callers can't change the cached documents
+            if coordinates is not None and math.hypot(coordinates[0] - lng, coordinates[1] - lat) <= distance:
+                results.append(dict(document))
+
+        raise Return(results)
+
+    @_timed("spherical_location_search")
+    @coroutine
+    def spherical_location_search(self, lng, lat, distance, unit="miles", attribute_map=None, page=0, limit=50,
+                                  min_distance=None, attribute="loc", exclude_ids=None):
+        """Search around a point with $nearSphere on a 2dsphere index, ie create_index("loc", GEOSPHERE)
+
+        Results are sorted nearest first, and each one has a "distance" from the point in the given unit.
+        To page through a large result set without skipping, continue after the last page with page 0 and the
+        arguments from next_location_page, ie::
+
+            cursor = client.next_location_page(results, cursor=cursor)
+            results = yield client.spherical_location_search(lng, lat, 10, **cursor)
+
+        $minDistance is inclusive, so the results at the distance of the last one are excluded by id.
+
+        :param float lng: Longitude parameter
+        :param float lat: Latitude parameter
+        :param float distance: The radius of the query
+        :param str unit: The unit of measure for the distances, one of miles, kilometers or meters, defaults to miles
+        :param dict attribute_map: Additional attributes to apply to the location bases query
+        :param int page: The page to return
+        :param int limit: Number of results per page
+        :param float min_distance: Only return documents at least this far from the point
+        :param str attribute: The attribute holding the location, a GeoJSON point or a legacy [lng, lat] pair
+        :param list exclude_ids: The ids of documents to leave out, ie the last results of the previous page
+        :returns: List of objects
+        :rtype: list
+        """
+        if unit not in METERS_PER_UNIT:
+            raise ValueError("Unknown unit of measure %s" % unit)
+
+        meters = METERS_PER_UNIT[unit]
+
+        near = {
+            "$geometry": {"type": "Point", "coordinates": [lng, lat]},
+            "$maxDistance": float(distance) * meters
+        }
+
+        if min_distance is not None:
+            near["$minDistance"] = float(min_distance) * meters
+
+        query = {attribute: {"$nearSphere": near}}
+
+        if attribute_map:
+            query.update(attribute_map)
+
+        if exclude_ids:
+            query["_id"] = {"$nin": [ObjectId(_id) for _id in exclude_ids]}
+
+        cursor = self.collection.find(query).skip(page*limit).limit(limit)
+
+        results = []
+        while (yield cursor.fetch_next):
+            document = self._obj_cursor_to_dictionary(cursor.next_object())
+
+            location = document.get(attribute)
+            if isinstance(location, dict):
+                location = location.get("coordinates")
+
+            document["distance"] = spherical_distance(lng, lat, location[0], location[1]) / meters
+            results.append(document)
+
+        raise Return(results)
+
+    #Distances this close, in meters, are ties when paging, which covers rounding between mongo and spherical_distance
+    DISTANCE_TIE_IN_METERS = 0.01
+
+    @classmethod
+    def next_location_page(cls, results, unit="miles", cursor=None):
+        """The arguments of spherical_location_search that continue after a page of its results
+
+        :param list results: The page, nearest first
+        :param str unit: The unit of measure the page was searched with
+        :param dict cursor: What next_location_page returned for the page before, the ids it excluded are kept
+            while they are still tied with the last result
+        :returns: The min_distance, unit and exclude_ids arguments
+        :rtype: dict
+        """
+        if len(results) == 0:
+            raise ValueError("There is no page to continue after")
+
+        if cursor is not None:
+            unit = cursor.get("unit", unit)
+
+        tie = cls.DISTANCE_TIE_IN_METERS / METERS_PER_UNIT[unit]
+        min_distance = max(0.0, results[-1].get("distance") - tie)
+
+        exclude_ids = [result.get("id") for result in results if result.get("distance") >= min_distance]
+
+        if cursor is not None and cursor.get("min_distance", 0.0) >= min_distance - tie:
+            exclude_ids = cursor.get("exclude_ids", []) + exclude_ids
+
+        return {
+            "min_distance": min_distance,
+            "unit": unit,
+            "exclude_ids": exclude_ids
+        }
 
     def _dictionary_to_cursor(self, obj):
         """
@@ -795,12 +3644,23 @@ class BaseAsyncMotorDocument(object):
         if not cursor:
             return cursor
 
+        started = time.time() if self.timings is not None or self.metrics is not None else None
+
         cursor = json.loads(json.dumps(cursor, cls=BSONEncoder))
 
         if cursor.get("_id"):
             cursor["id"] = cursor.get("_id")
             del cursor["_id"]
 
+        if started is not None:
+            seconds = time.time() - started
+
+            if self.timings is not None:
+                self.timings.record("convert", seconds)
+
+            if self.metrics is not None:
+                self.metrics.observe("document_conversion_seconds", seconds, {"collection": self.collection_name})
+
         return cursor
 
     def _list_cursor_to_json(self, cursor):
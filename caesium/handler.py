@@ -15,9 +15,12 @@ from pymongo.errors import InvalidId
 import tornado.web
 from tornado.gen import coroutine, Return
 
+from caesium.metrics import get_metrics_sink
 from caesium.document import (
     AsyncSchedulableDocumentRevisionStack,
     BaseAsyncMotorDocument,
+    OperationTimings,
+    group_documents_by,
 )
 
 
@@ -30,6 +33,61 @@ class BaseHandler(tornado.web.RequestHandler):
     def initialize(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
+    def prepare(self):
+        """Start recording document operation timings when settings["server_timing"] is on, they are sent
+        back in a Server-Timing header and logged as a json line when the request finishes.
+        """
+        self.timings = OperationTimings() if self.settings.get("server_timing") else None
+
+        client = getattr(self, "client", None)
+        if isinstance(client, BaseAsyncMotorDocument):
+            self.client = self.timed(client)
+
+    def timed(self, client):
+        """Get a client that records its operations in this request's timings, use it for clients that are
+        built while handling the request
+
+        :param BaseAsyncMotorDocument client: The client
+        :rtype: BaseAsyncMotorDocument
+        """
+        timings = getattr(self, "timings", None)
+
+        if timings is None and client.slow_log is None:
+            return client
+
+        return client.with_timings(timings, handler=self.__class__.__name__)
+
+    def finish(self, chunk=None):
+        """Add the Server-Timing header and log the timings, if they are recorded, then finish the request"""
+        timings = getattr(self, "timings", None)
+
+        if timings is not None and not self._finished:
+            total = self.request.request_time()
+            header = timings.server_timing()
+            self.set_header("Server-Timing", 'total;dur=%.3f%s' % (total * 1000, ", " + header if header else ""))
+
+            logging.getLogger("caesium.timing").info(json.dumps({
+                "method": self.request.method,
+                "uri": self.request.uri,
+                "status": self.get_status(),
+                "duration_ms": round(total * 1000, 3),
+                "operations": timings.to_dict()
+            }))
+
+        return super(BaseHandler, self).finish(chunk)
+
+    def on_finish(self):
+        """Record the latency and status of the request in the metrics sink, unless settings["request_metrics"]
+        is False
+        """
+        if not self.settings.get("request_metrics", True):
+            return
+
+        metrics = get_metrics_sink(self.settings)
+        tags = {"handler": self.__class__.__name__, "method": self.request.method, "status": str(self.get_status())}
+        metrics.increment("http_requests_total", tags=tags)
+        metrics.observe("http_request_duration_seconds", self.request.request_time(), tags)
+
     def load_json(self):
         """Load JSON from the request body and store them in
         self.request.arguments, like Tornado does by default for POSTed form
@@ -92,9 +150,16 @@ class BaseHandler(tornado.web.RequestHandler):
         :rtype: dynamic
         """
 
-        val = self.get_query_argument(key, default)
+        return self.value_as_type(self.get_query_argument(key, default))
+
+    def value_as_type(self, val):
+        """Convert a query string value like true, yes or no to a boolean, other values are returned as they are
 
-        if isinstance(val, int):
+        :param str val: The value
+        :returns: adapted value
+        :rtype: dynamic
+        """
+        if not isinstance(val, (str, type(u""))):
             return val
 
         if val.lower() in ['true', 'yes']:
@@ -115,12 +180,13 @@ class BaseHandler(tornado.web.RequestHandler):
         query = {}
         for arg in self.request.arguments:
             if arg not in reserved_attributes:
-                if len(self.request.arguments.get(arg)) > 1:
+                values = self.get_query_arguments(arg)
+                if len(values) > 1:
                     query["$or"] = []
-                    for val in self.request.arguments.get(arg):
-                        query["$or"].append({arg: self.get_arg_value_as_type(val)})
+                    for val in values:
+                        query["$or"].append({arg: self.value_as_type(val)})
                 else:
-                    query[arg] = self.get_arg_value_as_type(self.request.arguments.get(arg)[0])
+                    query[arg] = self.value_as_type(values[0])
 
         return query
 
@@ -220,26 +286,7 @@ class BaseHandler(tornado.web.RequestHandler):
         :rtype: list
         """
 
-        groups = []
-        for obj in list:
-            val = obj.get(attr)
-            if not val:
-                pass
-
-            newGroup = {"attribute": attr, valueLabel: val, childrenLabel: [obj]}
-
-            found = False
-            for i in range(0,len(groups)):
-                if val == groups[i].get(valueLabel):
-                    found = True
-                    groups[i][childrenLabel].append(obj)
-                    pass
-
-            if not found:
-                groups.append(newGroup)
-
-
-        return groups
+        return group_documents_by(list, attr, valueLabel=valueLabel, childrenLabel=childrenLabel)
 
     def get_current_user(self):
         """Gets the current user from the secure cookie store
@@ -293,13 +340,19 @@ class BaseRestfulMotorHandler(BaseHandler):
     @coroutine
     def get(self, id):
         """
-        Get an by object by unique identifier
+        Get an by object by unique identifier, pass an asOf query parameter with a UTC timestamp to get the
+        object as it was, or is scheduled to be, at that time.
 
         :id string id: the bson id of an object
         :rtype: JSON
         """
+        as_of = self.get_query_argument("asOf", None)
+
         try:
-            if self.request.headers.get("Id"):
+            if as_of:
+                stack = AsyncSchedulableDocumentRevisionStack(self.client.collection_name, self.settings, master_id=id)
+                object_ = yield stack.as_of(float(as_of))
+            elif self.request.headers.get("Id"):
                 object_ = yield self.client.find_one({self.request.headers.get("Id"): id})
             else:
                 object_ = yield self.client.find_one_by_id(id)
@@ -312,6 +365,8 @@ class BaseRestfulMotorHandler(BaseHandler):
 
         except InvalidId as ex:
             self.raise_error(400, message="Your ID is malformed: %s" % id)
+        except ValueError as ex:
+            self.raise_error(400, message="asOf must be a UTC timestamp: %s" % as_of)
         except Exception as ex:
             self.logger.error(ex)
             self.raise_error()
@@ -494,7 +549,7 @@ class BaseRevisionList(BaseRestfulMotorHandler):
         :return:
         """
         collection_name = self.request.headers.get("collection")
-        self.client = BaseAsyncMotorDocument("%s_revisions" % collection_name)
+        self.client = self.timed(BaseAsyncMotorDocument.shared("%s_revisions" % collection_name, self.settings))
 
         limit = self.get_query_argument("limit", 2)
         add_current_revision = self.get_arg_value_as_type("addCurrent",
@@ -538,6 +593,9 @@ class BaseRevisionList(BaseRestfulMotorHandler):
                                                        limit=1)
 
         if len(objects_processed) > 0:
+            stack = AsyncSchedulableDocumentRevisionStack(collection_name, self.settings, master_id=master_id)
+            yield stack.materialize_snapshots(objects_processed)
+
             objects_processed = objects_processed[::-1]
             objects_processed[-1]["current"] = True
             objects = objects_processed + objects
@@ -631,6 +689,9 @@ class RevisionHandler(BaseRestfulMotorHandler):
 class BaseMotorSearch(BaseHandler):
     """Handles searching of the stores endpoint"""
 
+    #Query parameters that control the search rather than filter it
+    SEARCH_PARAMS = ["countOnly", "limit", "page", "estimated"]
+
     def initialize(self):
         """Initializer for the Search Handler"""
         self.client = None
@@ -655,12 +716,52 @@ class BaseMotorSearch(BaseHandler):
                 "attr2": true
             }
 
+        These query parameters are not part of the query:
+
+        * countOnly=true only returns the count of matching objects, without loading them
+        * limit and page return a page of the results, with the count of all matching objects as total
+        * estimated=true uses the estimated count of the collection when there are no other parameters
+
+        These names are reserved, so fields called countOnly, limit, page or estimated can't be searched on
+        here.  Override SEARCH_PARAMS in a subclass to change them.
 
         """
-        objects = yield self.client.find(self.get_mongo_query_from_arguments())
+        query = self.get_mongo_query_from_arguments(reserved_attributes=self.SEARCH_PARAMS)
+        estimated = self.get_query_argument("estimated", "false").lower() in ["true", "yes"]
+
+        if self.get_query_argument("countOnly", "false").lower() in ["true", "yes"]:
+            count = yield self.client.count(query, estimated=estimated)
+            self.write({"count": count})
+            self.finish()
+            return
+
+        limit = self.get_query_argument("limit", None)
+
+        if limit is None:
+            objects = yield self.client.find(query)
+
+            self.write({
+                "count" : len(objects),
+                "results": objects
+            })
+            self.finish()
+            return
+
+        try:
+            limit = int(limit)
+            page = int(self.get_query_argument("page", 0))
+        except ValueError:
+            self.raise_error(400, message="limit and page must be integers")
+            return
+
+        objects = yield self.client.find(query, page=page, limit=limit)
+        total = yield self.client.count(query, estimated=estimated)
 
         self.write({
             "count" : len(objects),
+            "total": total,
+            "page": page,
+            "limit": limit,
             "results": objects
         })
         self.finish()
@@ -731,3 +832,24 @@ class BaseBulkScheduleableUpdateHandler(BaseHandler):
         result = yield self.revisions.collection.remove({"meta.bulk_id": bulk_id})
 
         self.write(result)
+
+
+class MetricsHandler(BaseHandler):
+    """Serves the metrics sink in the Prometheus text format, mount it in your application with::
+
+        (r"/metrics", MetricsHandler)
+
+    The request, document and scheduler metrics are in the sink from settings["metrics_sink"], or the default
+    in memory sink.
+    """
+
+    def get(self):
+        """Write every metric"""
+        sink = get_metrics_sink(self.settings)
+
+        if not hasattr(sink, "prometheus"):
+            self.raise_error(404, "The metrics sink %s can't be scraped" % sink.__class__.__name__)
+            return
+
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(sink.prometheus())
@@ -0,0 +1,310 @@
+import bisect
+import collections
+import re
+import time
+
+
+class MetricsSink(object):
+    """The interface Caesium reports its metrics through.
+
+    Set settings["metrics_sink"] to an instance of a subclass to send the metrics somewhere else, ie statsd.
+    Every method is a no-op here, so a subclass only needs to implement what it cares about.
+    """
+
+    def increment(self, name, value=1, tags=None):
+        """Increment a counter
+
+        :param str name: The metric name
+        :param number value: The amount to add
+        :param dict tags: Labels for the metric, ie {"action": "update"}
+        """
+        pass
+
+    def gauge(self, name, value, tags=None):
+        """Set a gauge to its current value
+
+        :param str name: The metric name
+        :param number value: The value
+        :param dict tags: Labels for the metric
+        """
+        pass
+
+    def observe(self, name, value, tags=None):
+        """Record a sample in a histogram, ie a timing in seconds
+
+        :param str name: The metric name
+        :param number value: The sample
+        :param dict tags: Labels for the metric
+        """
+        pass
+
+    def timer(self, name, tags=None):
+        """A context manager recording the seconds spent in its block to a histogram
+
+        :param str name: The metric name
+        :param dict tags: Labels for the metric
+        :rtype: Timer
+        """
+        return Timer(self, name, tags)
+
+
+class Timer(object):
+    """Records the time spent in a with block"""
+
+    def __init__(self, sink, name, tags=None):
+        self.sink = sink
+        self.name = name
+        self.tags = tags
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.sink.observe(self.name, time.time() - self.start, self.tags)
+        return False
+
+
+class Histogram(object):
+    """A histogram with fixed bucket upper bounds, keeping the count, sum, min and max of its samples"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """An estimate of a quantile, the upper bound of the bucket it falls in
+
+        :param float q: The quantile, between 0 and 1
+        :rtype: float
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": list(zip(self.buckets + (float("inf"),), self.counts))
+        }
+
+
+class InMemoryMetricsSink(MetricsSink):
+    """Keeps metrics in process, so they can be scraped with snapshot(), rate() or prometheus()
+
+    Counters also keep their increments per second over a sliding window, which gives a per second rate.
+
+    Updates take no lock, they are meant to come from the IOLoop thread, which is where Caesium reports from.
+    """
+
+    RATE_WINDOW_IN_SECONDS = 60
+
+    def __init__(self, rate_window_in_seconds=None):
+        self.rate_window = rate_window_in_seconds or self.RATE_WINDOW_IN_SECONDS
+        self.reset()
+
+    def reset(self):
+        """Forget every metric"""
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.events = {}
+
+    @staticmethod
+    def key(name, tags=None):
+        """The key a metric is stored under, its name and sorted labels
+
+        :param str name:
+        :param dict tags:
+        :rtype: tuple
+        """
+        return name, tuple(sorted((tags or {}).items()))
+
+    def increment(self, name, value=1, tags=None):
+        key = self.key(name, tags)
+        second = int(time.time())
+
+        self.counters[key] = self.counters.get(key, 0) + value
+
+        events = self.events.get(key)
+        if events is None:
+            events = self.events[key] = collections.deque()
+
+        if events and events[-1][0] == second:
+            events[-1][1] += value
+        else:
+            events.append([second, value])
+            self.__expire(events, second)
+
+    def gauge(self, name, value, tags=None):
+        self.gauges[self.key(name, tags)] = value
+
+    def observe(self, name, value, tags=None):
+        key = self.key(name, tags)
+        histogram = self.histograms.get(key)
+
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+
+        histogram.observe(value)
+
+    def __expire(self, events, now):
+        while events and events[0][0] <= now - self.rate_window:
+            events.popleft()
+
+    def counter(self, name, tags=None):
+        """The total of a counter
+
+        :param str name:
+        :param dict tags:
+        :rtype: number
+        """
+        return self.counters.get(self.key(name, tags), 0)
+
+    def rate(self, name, tags=None):
+        """The per second rate of a counter over the sliding window
+
+        :param str name:
+        :param dict tags:
+        :rtype: float
+        """
+        events = self.events.get(self.key(name, tags))
+        if not events:
+            return 0.0
+
+        self.__expire(events, int(time.time()))
+        return sum(value for second, value in events) / float(self.rate_window)
+
+    def histogram(self, name, tags=None):
+        """A histogram, or None if nothing was observed
+
+        :param str name:
+        :param dict tags:
+        :rtype: Histogram
+        """
+        return self.histograms.get(self.key(name, tags))
+
+    def snapshot(self):
+        """Every metric as plain values, ie for a json status endpoint
+
+        :rtype: dict
+        """
+        def label(key):
+            name, tags = key
+            if not tags:
+                return name
+            return "%s{%s}" % (name, ",".join("%s=%s" % tag for tag in tags))
+
+        return {
+            "counters": dict((label(key), value) for key, value in list(self.counters.items())),
+            "gauges": dict((label(key), value) for key, value in list(self.gauges.items())),
+            "histograms": dict((label(key), histogram.to_dict()) for key, histogram in list(self.histograms.items())),
+            "rates": dict((label(key), self.rate(key[0], dict(key[1]))) for key in list(self.events.keys()))
+        }
+
+    def prometheus(self):
+        """Every metric in the Prometheus text exposition format, see MetricsHandler
+
+        :rtype: str
+        """
+        lines = []
+
+        for kind, metrics in [("counter", self.counters), ("gauge", self.gauges)]:
+            for name, samples in _by_name(metrics):
+                lines.append("# TYPE %s %s" % (name, kind))
+                for tags, value in samples:
+                    lines.append("%s%s %s" % (name, _labels(tags), _number(value)))
+
+        for name, samples in _by_name(self.histograms):
+            lines.append("# TYPE %s histogram" % name)
+            for tags, histogram in samples:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %s" % (name, _labels(tags + (("le", _number(bound)),)), cumulative))
+                lines.append("%s_sum%s %s" % (name, _labels(tags), _number(histogram.sum)))
+                lines.append("%s_count%s %s" % (name, _labels(tags), histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_name(name):
+    """Replace the characters Prometheus doesn't allow in metric and label names"""
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def _by_name(metrics):
+    """Group a metrics dictionary by name, sorted, as (name, [(tags, value)])"""
+    names = {}
+    for (name, tags), value in list(metrics.items()):
+        names.setdefault(_prometheus_name(name), []).append((tags, value))
+
+    return [(name, sorted(names[name], key=lambda sample: sample[0])) for name in sorted(names)]
+
+
+def _labels(tags):
+    """Format labels, escaping their values"""
+    if not tags:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{%s}" % ",".join('%s="%s"' % (_prometheus_name(str(key)), escape(value)) for key, value in tags)
+
+
+def _number(value):
+    """Format a sample value"""
+    if value == float("inf"):
+        return "+Inf"
+
+    if isinstance(value, bool):
+        return "1" if value else "0"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+default_sink = InMemoryMetricsSink()
+
+
+def get_metrics_sink(settings):
+    """The metrics sink configured in settings["metrics_sink"], or the shared in memory sink
+
+    :param dict settings: The applications settings
+    :rtype: MetricsSink
+    """
+    sink = (settings or {}).get("metrics_sink")
+
+    if sink is None:
+        return default_sink
+
+    return sink
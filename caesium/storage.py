@@ -0,0 +1,810 @@
+__author__ = 'hunt3r'
+
+"""
+Storage backends for the document layer.
+
+Caesium talks to its collections through the Motor 0.3 collection API.  A storage backend hands out
+collection objects by name, which lets the document layer run against Motor in production, or against
+the in-memory engine in benchmarks, scheduler simulations and tests.
+"""
+
+import copy
+import functools
+import math
+import re
+
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from tornado.concurrent import Future
+from tornado.gen import Return, coroutine
+
+#Radius used by mongo for spherical distance calculations on GeoJSON points, in meters
+EARTH_RADIUS_IN_METERS = 6378100.0
+
+
+class StorageBackend(object):
+    """Interface for anything that can vend collection objects to the document layer"""
+
+    def collection(self, name):
+        """Get a collection object by name
+
+        :param str name: The collection name
+        :returns: An object that implements the Motor collection API used by Caesium
+        """
+        raise NotImplementedError()
+
+    @property
+    def database(self):
+        """What the document layer exposes as its client attribute, the backend itself unless it wraps a database"""
+        return self
+
+    def __getitem__(self, name):
+        return self.collection(name)
+
+
+class MotorStorageBackend(StorageBackend):
+    """Backend for a Motor database, this is what settings["db"] is wrapped in by default"""
+
+    def __init__(self, db):
+        """
+        Constructor
+
+        :param db: A Motor database
+        """
+        self.db = db
+
+    def collection(self, name):
+        """Get a motor collection by name
+
+        :param str name: The collection name
+        :returns: A motor collection
+        """
+        return self.db[name]
+
+    @property
+    def database(self):
+        """The Motor database"""
+        return self.db
+
+
+class MemoryStorageBackend(StorageBackend):
+    """A process local, in-memory storage engine.
+
+    Supports the query, update, sort and projection subset that Caesium uses, which makes it possible to
+    run Caesium without a mongod.  Nothing is persisted.
+    """
+
+    def __init__(self):
+        """Constructor"""
+        self.collections = {}
+
+    def collection(self, name):
+        """Get an in-memory collection by name, collections are created on first use
+
+        :param str name: The collection name
+        :returns: The in-memory collection
+        :rtype: MemoryCollection
+        """
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+
+        return self.collections[name]
+
+
+def get_storage_backend(settings):
+    """Get the storage backend for the given application settings.
+
+    settings["storage"] wins when present, otherwise settings["db"] is wrapped in a MotorStorageBackend.
+
+    :param dict settings: The application settings
+    :returns: The storage backend
+    :rtype: StorageBackend
+    """
+    storage = settings.get("storage")
+
+    if storage is not None:
+        return storage
+
+    db = settings.get("db")
+    assert db is not None, "settings must have a storage backend or a Motor database in \"storage\" or \"db\""
+
+    if isinstance(db, StorageBackend):
+        return db
+
+    return MotorStorageBackend(db)
+
+
+def _resolved(value):
+    """Wrap a value in a finished future, this is how every in-memory operation responds"""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+_MISSING = object()
+
+
+def _get_path(document, path):
+    """Get the value at a dotted path
+
+    :param dict document: The document
+    :param str path: A dotted path, ie "meta.comment"
+    :returns: The value, or _MISSING
+    """
+    value = document
+    for key in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(key, _MISSING)
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return _MISSING
+
+        if value is _MISSING:
+            return value
+
+    return value
+
+
+def _set_path(document, path, value):
+    """Set the value at a dotted path, creating sub documents as needed"""
+    keys = path.split(".")
+    for key in keys[:-1]:
+        if not isinstance(document.get(key), dict):
+            document[key] = {}
+        document = document[key]
+
+    document[keys[-1]] = value
+
+
+def _unset_path(document, path):
+    """Remove the value at a dotted path"""
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document.get(key)
+        if not isinstance(document, dict):
+            return
+
+    document.pop(keys[-1], None)
+
+
+def _type_rank(value):
+    """Mongo sorts different types in a fixed order, this approximates it"""
+    if value is _MISSING or value is None:
+        return 0
+    if isinstance(value, bool):
+        return 4
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, (str, type(u""))):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, ObjectId):
+        return 5
+    return 6
+
+
+def _compare(a, b):
+    """Compare two values the way a mongo sort would"""
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+    if rank_a == 0:
+        return 0
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        return 0
+
+
+def _comparable(value, other):
+    """Range operators only match values of the same type bracket"""
+    return value is not _MISSING and value is not None and _type_rank(value) == _type_rank(other)
+
+
+def _values_equal(value, condition):
+    """Equality match, including matching an element of an array"""
+    if value is _MISSING:
+        return condition is None
+
+    if value == condition:
+        return True
+
+    return isinstance(value, list) and condition in value
+
+
+def _match_operators(value, operators):
+    """Evaluate a dictionary of query operators against a value"""
+    for operator, argument in operators.items():
+        if operator == "$lt":
+            matched = _comparable(value, argument) and value < argument
+        elif operator == "$lte":
+            matched = _comparable(value, argument) and value <= argument
+        elif operator == "$gt":
+            matched = _comparable(value, argument) and value > argument
+        elif operator == "$gte":
+            matched = _comparable(value, argument) and value >= argument
+        elif operator == "$ne":
+            matched = not _values_equal(value, argument)
+        elif operator == "$in":
+            matched = any(_values_equal(value, candidate) for candidate in argument)
+        elif operator == "$nin":
+            matched = not any(_values_equal(value, candidate) for candidate in argument)
+        elif operator == "$exists":
+            matched = (value is not _MISSING) == bool(argument)
+        elif operator == "$mod":
+            matched = isinstance(value, (int, float)) and not isinstance(value, bool) \
+                and value % argument[0] == argument[1]
+        elif operator == "$regex":
+            matched = isinstance(value, (str, type(u""))) \
+                and re.search(argument, value, re.I if "i" in operators.get("$options", "") else 0) is not None
+        elif operator == "$options":
+            matched = True
+        elif operator == "$not":
+            matched = not _match_operators(value, argument)
+        elif operator in ["$nearSphere", "$near", "$within", "$geoWithin", "$maxDistance", "$minDistance"]:
+            # Geo operators are resolved by the cursor, which knows the distances
+            matched = True
+        else:
+            raise OperationFailure("Unsupported query operator for the in-memory engine: %s" % operator)
+
+        if not matched:
+            return False
+
+    return True
+
+
+def _is_operator_dictionary(value):
+    return isinstance(value, dict) and len(value) > 0 and all(key.startswith("$") for key in value)
+
+
+def match(document, query):
+    """Check whether a document matches a mongo query
+
+    :param dict document: The document to check
+    :param dict query: A mongo query
+    :rtype: bool
+    """
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(match(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$and":
+            if not all(match(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$nor":
+            if any(match(document, sub_query) for sub_query in condition):
+                return False
+        else:
+            value = _get_path(document, key)
+            if _is_operator_dictionary(condition):
+                if not _match_operators(value, condition):
+                    return False
+            elif not _values_equal(value, condition):
+                return False
+
+    return True
+
+
+def _sort_documents(documents, sort):
+    """Sort documents in place by a list of (key, direction) pairs"""
+    def compare_documents(a, b):
+        for key, direction in sort:
+            result = _compare(_get_path(a, key), _get_path(b, key))
+            if result:
+                return result * direction
+        return 0
+
+    documents.sort(key=functools.cmp_to_key(compare_documents))
+
+
+def _project(document, fields):
+    """Apply a projection, which may be a list of field names or a dictionary"""
+    if not fields:
+        return document
+
+    if isinstance(fields, (list, tuple)):
+        fields = dict((field, 1) for field in fields)
+
+    include = [key for key, value in fields.items() if value and key != "_id"]
+
+    if include:
+        projected = {}
+        for key in include:
+            value = _get_path(document, key)
+            if value is not _MISSING:
+                _set_path(projected, key, value)
+        if fields.get("_id", 1) and "_id" in document:
+            projected["_id"] = document["_id"]
+        return projected
+
+    projected = copy.deepcopy(document)
+    for key, value in fields.items():
+        if not value:
+            _unset_path(projected, key)
+
+    return projected
+
+
+def _apply_update(document, update, inserting=False):
+    """Apply an update document to a stored document in place
+
+    :param dict document: The stored document
+    :param dict update: Either a replacement document or a dictionary of update operators
+    :param bool inserting: Whether this is the insert half of an upsert
+    """
+    if not any(key.startswith("$") for key in update):
+        _id = document.get("_id")
+        document.clear()
+        document.update(copy.deepcopy(update))
+        if _id is not None:
+            document["_id"] = _id
+        return
+
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            value = copy.deepcopy(value)
+            if operator == "$set":
+                _set_path(document, path, value)
+            elif operator == "$setOnInsert":
+                if inserting:
+                    _set_path(document, path, value)
+            elif operator == "$unset":
+                _unset_path(document, path)
+            elif operator == "$inc":
+                current = _get_path(document, path)
+                _set_path(document, path, (0 if current is _MISSING else current) + value)
+            elif operator == "$push":
+                current = _get_path(document, path)
+                current = [] if current is _MISSING else current
+                if isinstance(value, dict) and "$each" in value:
+                    current.extend(value["$each"])
+                else:
+                    current.append(value)
+                _set_path(document, path, current)
+            elif operator == "$addToSet":
+                current = _get_path(document, path)
+                current = [] if current is _MISSING else current
+                if value not in current:
+                    current.append(value)
+                _set_path(document, path, current)
+            else:
+                raise OperationFailure("Unsupported update operator for the in-memory engine: %s" % operator)
+
+
+def _upsert_seed(query):
+    """Build the starting document for an upsert from the equality parts of a query"""
+    seed = {}
+    for key, value in (query or {}).items():
+        if not key.startswith("$") and not _is_operator_dictionary(value):
+            _set_path(seed, key, copy.deepcopy(value))
+
+    return seed
+
+
+def spherical_distance(lng1, lat1, lng2, lat2):
+    """Great circle distance in meters between two points, with the haversine formula
+
+    :param float lng1: Longitude of the first point
+    :param float lat1: Latitude of the first point
+    :param float lng2: Longitude of the second point
+    :param float lat2: Latitude of the second point
+    :rtype: float
+    """
+    lng1, lat1, lng2, lat2 = [math.radians(float(value)) for value in (lng1, lat1, lng2, lat2)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_IN_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _coordinates(value):
+    """Get [lng, lat] from a legacy pair or a GeoJSON point"""
+    if isinstance(value, dict):
+        value = value.get("coordinates")
+
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        return value
+
+    return None
+
+
+def _geo_filter(query):
+    """Find the geo clause of a query, returns (path, kind, arguments)"""
+    for key, condition in (query or {}).items():
+        if isinstance(condition, dict):
+            for operator in ["$nearSphere", "$near", "$within", "$geoWithin"]:
+                if operator in condition:
+                    return key, operator, condition
+
+    return None, None, None
+
+
+class MemoryCursor(object):
+    """Cursor over an in-memory collection, it behaves like a MotorCursor"""
+
+    def __init__(self, collection, query=None, fields=None):
+        query = query or {}
+
+        self.collection = collection
+        self.sort_spec = []
+
+        if "$query" in query:
+            if query.get("$orderby"):
+                self.sort_spec = list(query["$orderby"].items())
+            query = query["$query"]
+
+        self.query = query
+        self.fields = fields
+        self.skip_count = 0
+        self.limit_count = 0
+        self.results = None
+
+    def sort(self, key_or_list, direction=None):
+        """Sort by a key and direction, or by a list of (key, direction) pairs"""
+        if isinstance(key_or_list, (list, tuple)):
+            self.sort_spec = list(key_or_list)
+        else:
+            self.sort_spec = [(key_or_list, direction or 1)]
+        return self
+
+    def skip(self, skip):
+        self.skip_count = skip
+        return self
+
+    def limit(self, limit):
+        self.limit_count = limit
+        return self
+
+    def _matching(self):
+        """All matching documents in cursor order, before skip and limit"""
+        documents = [document for document in self.collection.documents if match(document, self.query)]
+        path, operator, condition = _geo_filter(self.query)
+
+        if operator in ["$nearSphere", "$near"]:
+            near = condition[operator]
+            center = _coordinates(near.get("$geometry", near) if isinstance(near, dict) else near)
+            max_distance = condition.get("$maxDistance", near.get("$maxDistance") if isinstance(near, dict) else None)
+            min_distance = condition.get("$minDistance", near.get("$minDistance") if isinstance(near, dict) else None)
+
+            located = []
+            for document in documents:
+                point = _coordinates(_get_path(document, path))
+                if point is None:
+                    continue
+                distance = spherical_distance(center[0], center[1], point[0], point[1])
+                if max_distance is not None and distance > max_distance:
+                    continue
+                if min_distance is not None and distance < min_distance:
+                    continue
+                located.append((distance, document))
+
+            located.sort(key=lambda pair: pair[0])
+            documents = [document for distance, document in located]
+
+        elif operator in ["$within", "$geoWithin"]:
+            circle = condition[operator].get("$center")
+            located = []
+            for document in documents:
+                point = _coordinates(_get_path(document, path))
+                if point is not None and math.hypot(point[0] - circle[0][0], point[1] - circle[0][1]) <= circle[1]:
+                    located.append(document)
+            documents = located
+
+        if self.sort_spec:
+            _sort_documents(documents, self.sort_spec)
+
+        return documents
+
+    def _evaluate(self):
+        if self.results is None:
+            documents = self._matching()[self.skip_count:]
+            if self.limit_count:
+                documents = documents[:abs(self.limit_count)]
+            self.results = [_project(copy.deepcopy(document), self.fields) for document in documents]
+
+        return self.results
+
+    @property
+    def fetch_next(self):
+        """A future that resolves to whether there is another document to read"""
+        return _resolved(len(self._evaluate()) > 0)
+
+    def next_object(self):
+        """Get the next document from the cursor"""
+        results = self._evaluate()
+        return results.pop(0) if results else None
+
+    def count(self, with_limit_and_skip=False):
+        """Count the documents matching the cursor query"""
+        if with_limit_and_skip:
+            return _resolved(len(self._evaluate()))
+
+        return _resolved(len(self._matching()))
+
+    def to_list(self, length=None):
+        """Read the rest of the cursor into a list"""
+        results = self._evaluate()
+        documents, self.results = results[:length] if length else results, results[length:] if length else []
+        return _resolved(documents)
+
+    def distinct(self, key):
+        """Distinct values of a key across the matching documents"""
+        values = []
+        for document in self._matching():
+            value = _get_path(document, key)
+            if value is not _MISSING and value not in values:
+                values.append(value)
+
+        return _resolved(values)
+
+
+class MemoryCollection(object):
+    """An in-memory collection that implements the Motor 0.3 collection API used by Caesium"""
+
+    def __init__(self, name):
+        """
+        Constructor
+
+        :param str name: The name of the collection
+        """
+        self.name = name
+        self.documents = []
+        self.indexes = []
+
+    def _find_index(self, _id):
+        for index, document in enumerate(self.documents):
+            if document.get("_id") == _id:
+                return index
+
+        return None
+
+    def _insert_one(self, document):
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+
+        if self._find_index(document["_id"]) is not None:
+            raise DuplicateKeyError("E11000 duplicate key error index: %s.$_id_ dup key: { : %s }" % (self.name, document["_id"]))
+
+        self.documents.append(copy.deepcopy(document))
+        return document["_id"]
+
+    def insert(self, doc_or_docs, continue_on_error=False, **kwargs):
+        """Insert a document or a list of documents
+
+        :returns: A future resolving to the inserted _id, or a list of them
+        """
+        if isinstance(doc_or_docs, dict):
+            return _resolved(self._insert_one(doc_or_docs))
+
+        ids, error = [], None
+        for document in doc_or_docs:
+            try:
+                ids.append(self._insert_one(document))
+            except DuplicateKeyError as ex:
+                error = ex
+                if not continue_on_error:
+                    break
+
+        if error is not None:
+            future = Future()
+            future.set_exception(error)
+            return future
+
+        return _resolved(ids)
+
+    def save(self, document, **kwargs):
+        """Insert or replace a document by _id"""
+        if "_id" in document and self._find_index(document["_id"]) is not None:
+            self.documents[self._find_index(document["_id"])] = copy.deepcopy(document)
+            return _resolved(document["_id"])
+
+        return self.insert(document)
+
+    def update(self, spec, document, upsert=False, manipulate=False, safe=None, multi=False, **kwargs):
+        """Update documents matching spec
+
+        :returns: A future resolving to a pymongo 2.x style response dictionary
+        """
+        updated = 0
+        for stored in self.documents:
+            if match(stored, spec):
+                _apply_update(stored, document)
+                updated += 1
+                if not multi:
+                    break
+
+        response = {"n": updated, "updatedExisting": updated > 0, "ok": 1.0, "err": None}
+
+        if updated == 0 and upsert:
+            seeded = _upsert_seed(spec)
+            _apply_update(seeded, document, inserting=True)
+            if "_id" not in seeded and "_id" in spec and not isinstance(spec["_id"], dict):
+                seeded["_id"] = spec["_id"]
+            response["upserted"] = self._insert_one(seeded)
+            response["n"] = 1
+
+        return _resolved(response)
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        """Remove documents matching spec
+
+        :returns: A future resolving to a pymongo 2.x style response dictionary
+        """
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+
+        removed = 0
+        kept = []
+        for document in self.documents:
+            if (multi or removed == 0) and match(document, spec_or_id):
+                removed += 1
+            else:
+                kept.append(document)
+
+        self.documents = kept
+        return _resolved({"n": removed, "ok": 1.0, "err": None})
+
+    def find(self, spec=None, fields=None, **kwargs):
+        """Find documents
+
+        :returns: A cursor
+        :rtype: MemoryCursor
+        """
+        return MemoryCursor(self, spec, fields or kwargs.get("projection"))
+
+    def find_one(self, spec_or_id=None, fields=None, **kwargs):
+        """Find a single document"""
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+
+        results = MemoryCursor(self, spec_or_id, fields).limit(1)._evaluate()
+        return _resolved(results[0] if results else None)
+
+    def find_and_modify(self, query=None, update=None, upsert=False, sort=None, full_response=False,
+                        new=False, fields=None, remove=False, **kwargs):
+        """Atomically find and update or remove a single document
+
+        :returns: A future resolving to the document, before the update unless new=True
+        """
+        cursor = MemoryCursor(self, query or {})
+        if sort:
+            cursor.sort(list(sort.items()) if isinstance(sort, dict) else sort)
+
+        documents = cursor._matching()
+
+        if not documents:
+            if upsert and not remove:
+                seeded = _upsert_seed(query)
+                _apply_update(seeded, update, inserting=True)
+                self._insert_one(seeded)
+                return _resolved(_project(copy.deepcopy(seeded), fields) if new else None)
+            return _resolved(None)
+
+        stored = documents[0]
+        before = copy.deepcopy(stored)
+
+        if remove:
+            self.documents.remove(stored)
+            return _resolved(_project(before, fields))
+
+        _apply_update(stored, update)
+        return _resolved(_project(copy.deepcopy(stored) if new else before, fields))
+
+    def count(self):
+        """Count all documents in the collection"""
+        return _resolved(len(self.documents))
+
+    def distinct(self, key):
+        """Distinct values of a key across the collection"""
+        return MemoryCursor(self).distinct(key)
+
+    def create_index(self, keys, **kwargs):
+        """Indexes are recorded but have no effect in memory"""
+        if keys not in self.indexes:
+            self.indexes.append(keys)
+
+        return _resolved(keys)
+
+    ensure_index = create_index
+
+    def index_information(self):
+        """The recorded indexes by name, in the pymongo format ie {"toa_1": {"key": [("toa", 1)]}}"""
+        information = {"_id_": {"key": [("_id", 1)]}}
+
+        for keys in self.indexes:
+            keys = [(keys, 1)] if isinstance(keys, (str, type(u""))) else list(keys)
+            information["_".join("%s_%s" % key for key in keys)] = {"key": keys}
+
+        return _resolved(information)
+
+    def drop(self):
+        """Remove every document in the collection"""
+        self.documents = []
+        self.indexes = []
+        return _resolved(None)
+
+    def aggregate(self, pipeline, **kwargs):
+        """Run the $match, $group, $sort, $skip, $limit and $project stages of an aggregation pipeline
+
+        :returns: A future resolving to a pymongo 2.x style {"result": [...]} response
+        """
+        documents = [copy.deepcopy(document) for document in self.documents]
+
+        for stage in pipeline:
+            operator, argument = list(stage.items())[0]
+
+            if operator == "$match":
+                documents = [document for document in documents if match(document, argument)]
+            elif operator == "$sort":
+                _sort_documents(documents, list(argument.items()))
+            elif operator == "$skip":
+                documents = documents[argument:]
+            elif operator == "$limit":
+                documents = documents[:argument]
+            elif operator == "$project":
+                documents = [_project(document, argument) for document in documents]
+            elif operator == "$group":
+                documents = _group(documents, argument)
+            else:
+                raise OperationFailure("Unsupported aggregation stage for the in-memory engine: %s" % operator)
+
+        return _resolved({"result": documents, "ok": 1.0})
+
+
+def _expression(document, expression):
+    """Evaluate a field path expression like "$field" or "$$ROOT" """
+    if expression == "$$ROOT":
+        return document
+
+    if isinstance(expression, (str, type(u""))) and expression.startswith("$"):
+        value = _get_path(document, expression[1:])
+        return None if value is _MISSING else value
+
+    if isinstance(expression, dict):
+        return dict((key, _expression(document, value)) for key, value in expression.items())
+
+    return expression
+
+
+def _group(documents, spec):
+    """Evaluate a $group stage"""
+    groups = []
+    by_key = {}
+
+    for document in documents:
+        key = _expression(document, spec["_id"])
+        hashable = repr(key)
+
+        if hashable not in by_key:
+            by_key[hashable] = {"_id": key}
+            groups.append(by_key[hashable])
+
+        group = by_key[hashable]
+
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+
+            operator, expression = list(accumulator.items())[0]
+            value = _expression(document, expression)
+
+            if operator == "$sum":
+                group[field] = group.get(field, 0) + (value or 0)
+            elif operator == "$push":
+                group.setdefault(field, []).append(value)
+            elif operator == "$addToSet":
+                group.setdefault(field, [])
+                if value not in group[field]:
+                    group[field].append(value)
+            elif operator == "$first":
+                group.setdefault(field, value)
+            elif operator == "$last":
+                group[field] = value
+            elif operator == "$max":
+                group[field] = value if field not in group or _compare(value, group[field]) > 0 else group[field]
+            elif operator == "$min":
+                group[field] = value if field not in group or _compare(value, group[field]) < 0 else group[field]
+            else:
+                raise OperationFailure("Unsupported group accumulator for the in-memory engine: %s" % operator)
+
+    return groups
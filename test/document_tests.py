@@ -8,10 +8,16 @@ import time
 from bson import ObjectId
 from tornado.testing import gen_test
 from nose.tools import raises, ok_
+from jsonschema import ValidationError
+from pymongo import GEOSPHERE
 import datetime
+import json
 
 from .base_tests import BaseAsyncTest
-from caesium.document import AsyncRevisionStackManager, AsyncSchedulableDocumentRevisionStack, RevisionActionNotValid, BaseAsyncMotorDocument
+from caesium.metrics import InMemoryMetricsSink
+from caesium.document import AsyncRevisionStackManager, AsyncSchedulableDocumentRevisionStack, RevisionActionNotValid, BaseAsyncMotorDocument, \
+    AsyncRevisionCompactor, SchemaValidatorRegistry, Revision, AsyncSchedulerLease, AsyncStaleRevisionReaper, \
+    group_documents_by, OperationTimings, SlowOperationLog
 
 test_attr = u'foo'
 test_val = u'bar'
@@ -126,6 +132,291 @@ class TestBaseAsyncMotorDocument(BaseAsyncTest):
         resp2 = yield self.client.find_one_by_id(resp)
         self.assertEqual(resp2.get(test_attr), test_val)
 
+    @tornado.testing.gen_test
+    def test_08_spherical_location_search(self):
+        """Test that a 2dsphere search returns the closest objects first, with their distance"""
+        places = BaseAsyncMotorDocument("test_places", settings=settings)
+        yield places.collection.drop()
+        yield places.create_index("loc", GEOSPHERE)
+
+        far = yield places.insert({"name": "far", "loc": {"type": "Point", "coordinates": [-75.0, 39.25]}})
+        near = yield places.insert({"name": "near", "loc": {"type": "Point", "coordinates": [-75.2, 39.25]}})
+        yield places.insert({"name": "away", "loc": {"type": "Point", "coordinates": [-70.0, 39.25]}})
+
+        results = yield places.spherical_location_search(-75.22, 39.25, 20, unit="kilometers")
+        self.assertEqual([result.get("id") for result in results], [near, far])
+        self.assertAlmostEqual(results[0].get("distance"), 1.72, places=1)
+        self.assertLess(results[0].get("distance"), results[1].get("distance"))
+
+        #Paging with ties at the page boundary neither repeats nor skips results
+        tied = yield places.insert({"name": "tied", "loc": {"type": "Point", "coordinates": [-75.24, 39.25]}})
+
+        seen = []
+        cursor = None
+        results = yield places.spherical_location_search(-75.22, 39.25, 20, unit="kilometers", limit=1)
+        while results and len(seen) < 10:
+            seen.extend(result.get("id") for result in results)
+            cursor = places.next_location_page(results, "kilometers", cursor=cursor)
+            results = yield places.spherical_location_search(-75.22, 39.25, 20, limit=1, **cursor)
+
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(sorted(seen[:2]), sorted([near, tied]))
+        self.assertEqual(seen[2:], [far])
+
+    @tornado.testing.gen_test
+    def test_09_location_search_geo_tile_cache(self):
+        """Test that nearby location searches share a cached tile, and that writes invalidate it"""
+        cache_settings = dict(settings, geo_cache={"collections": ["test_collection"]})
+        client = BaseAsyncMotorDocument("test_collection", settings=cache_settings)
+        yield client.create_index("loc")
+
+        first = yield client.insert(dict(self.test_fixture))
+
+        results = yield client.location_based_search(-75.221, 39.251, 10, attribute_map={"bool_val": True})
+        self.assertEqual([result.get("id") for result in results], [first])
+
+        results = yield client.location_based_search(-75.2211, 39.2511, 10, attribute_map={"bool_val": True})
+        self.assertEqual(len(results), 1)
+        self.assertEqual(client.geo_cache.hits, 1)
+
+        second = yield client.insert(dict(self.test_fixture, loc=[-75.23, 39.26]))
+        results = yield client.location_based_search(-75.221, 39.251, 10, attribute_map={"bool_val": True})
+        self.assertEqual(sorted(result.get("id") for result in results), sorted([first, second]))
+
+        yield client.patch(first, {"bool_val": False})
+        results = yield client.location_based_search(-75.221, 39.251, 10, attribute_map={"bool_val": True})
+        self.assertEqual([result.get("id") for result in results], [second])
+
+        results = yield client.location_based_search(-75.221, 39.251, 0.001, attribute_map={"bool_val": True})
+        self.assertEqual(results, [])
+
+    @tornado.testing.gen_test
+    def test_10_group_by(self):
+        """Test that grouping in mongo and in memory give the same groups"""
+        for attr1, date1 in [("a", 3), ("b", 1), ("a", 2)]:
+            yield self.client.insert(dict(self.mini_doc, attr1=attr1, date1=date1))
+
+        groups = yield self.client.group_by("attr1", orderby="date1")
+        self.assertEqual([group.get("value") for group in groups], ["a", "b"])
+        self.assertEqual([child.get("date1") for child in groups[0].get("children")], [2, 3])
+        self.assertEqual(groups[0].get("attribute"), "attr1")
+
+        objects = yield self.client.find({}, orderby="date1")
+        in_memory = group_documents_by(objects, "attr1", valueLabel="name", childrenLabel="items")
+        self.assertEqual([group.get("name") for group in in_memory], ["b", "a"])
+        self.assertEqual([len(group.get("items")) for group in in_memory], [1, 2])
+
+        groups = yield self.client.group_by("attr1", query={"date1": {"$gt": 1}})
+        self.assertEqual([len(group.get("children")) for group in groups], [2])
+
+        #Mongo types in the grouped attribute are converted like the documents
+        store = ObjectId()
+        yield self.client.insert(dict(self.mini_doc, attr1="c", store_id=store))
+        groups = yield self.client.group_by("store_id", query={"attr1": "c"})
+        self.assertEqual([group.get("value") for group in groups], [str(store)])
+        json.dumps(groups)
+
+    @tornado.testing.gen_test
+    def test_11_count(self):
+        """Test that counting matches the number of objects found, without loading them"""
+        yield self.client.insert(dict(self.test_fixture))
+        yield self.client.insert(dict(self.test_fixture))
+        yield self.client.insert(self.mini_doc)
+
+        count = yield self.client.count({"attr1": "attr1_val"})
+        self.assertEqual(count, 2)
+
+        count = yield self.client.count()
+        self.assertEqual(count, 3)
+
+        count = yield self.client.count(estimated=True)
+        self.assertEqual(count, 3)
+
+    @tornado.testing.gen_test
+    def test_12_query_result_cache(self):
+        """Test that repeated finds are answered from the cache until the collection is written to"""
+        sink = InMemoryMetricsSink()
+        cache_settings = dict(settings, metrics_sink=sink, query_cache={"collections": ["test_collection"]})
+        client = BaseAsyncMotorDocument("test_collection", settings=cache_settings)
+
+        id = yield client.insert(dict(self.test_fixture))
+
+        results = yield client.find({"attr1": "attr1_val", "bool_val": True})
+        results[0]["attr1"] = "changed by the caller"
+        results = yield client.find({"bool_val": True, "attr1": "attr1_val"})
+        self.assertEqual(results[0].get("attr1"), "attr1_val")
+
+        tags = {"collection": "test_collection"}
+        self.assertEqual(sink.counter("query_cache_hits_total", tags), 1)
+        self.assertEqual(sink.counter("query_cache_misses_total", tags), 1)
+        self.assertEqual(sink.gauges[sink.key("query_cache_hit_ratio", tags)], 0.5)
+
+        yield client.patch(id, {"bool_val": False})
+        results = yield client.find({"attr1": "attr1_val", "bool_val": True})
+        self.assertEqual(results, [])
+
+        stack = AsyncSchedulableDocumentRevisionStack("test_collection", cache_settings, master_id=id)
+        yield stack.revisions.collection.drop()
+        yield stack.push({"bool_val": True}, time.time() - 60)
+        yield stack.pop()
+
+        results = yield client.find({"attr1": "attr1_val", "bool_val": True})
+        self.assertEqual(len(results), 1)
+
+        #Another process, with its own cache, sees the write once it checks the shared generation
+        other_settings = dict(cache_settings, query_cache={"collections": ["test_collection"],
+                                                           "generation_check_in_seconds": 0})
+        other = BaseAsyncMotorDocument("test_collection", settings=other_settings)
+        results = yield other.find({"attr1": "attr1_val", "bool_val": True})
+        self.assertEqual(len(results), 1)
+
+        yield client.patch(id, {"bool_val": False})
+        results = yield other.find({"attr1": "attr1_val", "bool_val": True})
+        self.assertEqual(results, [])
+
+    @tornado.testing.gen_test
+    def test_13_collection_replica(self):
+        """Test that a replicated collection is read from memory, and follows writes from other clients"""
+        replica_settings = dict(settings, replicas={"test_collection": {"indexes": ["attr1"],
+                                                                        "refresh_in_seconds": 0}})
+        client = BaseAsyncMotorDocument("test_collection", settings=replica_settings)
+
+        first = yield client.insert(dict(self.test_fixture))
+        second = yield client.insert(dict(self.test_fixture, attr1="other", list_val=["a", "b"]))
+
+        results = yield client.find({"attr1": "other"})
+        self.assertEqual([result.get("id") for result in results], [second])
+        self.assertEqual(len(client.replica), 2)
+
+        results = yield client.find({"list_val": "a", "bool_val": True})
+        self.assertEqual([result.get("id") for result in results], [second])
+
+        obj = yield client.find_one_by_id(first)
+        self.assertEqual(obj.get("attr1"), "attr1_val")
+
+        yield client.patch(first, {"attr1": "other"})
+        results = yield client.find({"attr1": "other"}, orderby="attr1")
+        self.assertEqual(len(results), 2)
+
+        #A write from a client without the replica is picked up by the modified since poll
+        yield self.client.collection.update({"_id": ObjectId(second)},
+                                            {"$set": {"attr1": "polled", "modified_at": time.time() + 1}})
+        results = yield client.find({"attr1": "polled"})
+        self.assertEqual([result.get("id") for result in results], [second])
+
+        #A writer whose clock is behind is still seen, within the skew margin
+        yield self.client.collection.update({"_id": ObjectId(first)},
+                                            {"$set": {"attr1": "behind", "modified_at": time.time() - 2}})
+        results = yield client.find({"attr1": "behind"})
+        self.assertEqual([result.get("id") for result in results], [first])
+
+        #Writes don't change the caller's dictionary
+        attrs = {"attr1": "patched"}
+        yield client.patch(first, attrs)
+        self.assertEqual(attrs, {"attr1": "patched"})
+
+        results = yield client.find({"date1": {"$gt": 0}})
+        self.assertEqual(len(results), 2)
+
+        #Mixed types are ordered by type like mongo, missing values first, instead of raising a TypeError
+        number = yield client.insert(dict(self.test_fixture, attr1=3))
+        missing = yield client.insert(dict(self.test_fixture, attr1=None))
+        results = yield client.find({}, orderby="attr1")
+        self.assertEqual([result.get("id") for result in results], [missing, number, first, second])
+
+        results = yield client.find({}, orderby="attr1", order_by_direction=-1)
+        self.assertEqual([result.get("id") for result in results], [second, first, number, missing])
+
+    @tornado.testing.gen_test
+    def test_14_operation_timings(self):
+        """Test that a client with timings records its operations, validation and conversions"""
+        timings = OperationTimings()
+        client = BaseAsyncMotorDocument("test_collection", settings=settings,
+                                        schema={"type": "object"}).with_timings(timings)
+
+        yield client.insert(dict(self.test_fixture))
+        yield client.find({})
+        yield client.find({"attr1": "attr1_val"})
+
+        operations = timings.to_dict()
+        self.assertEqual(operations["insert"]["count"], 1)
+        self.assertEqual(operations["validate"]["count"], 1)
+        self.assertEqual(operations["find"]["count"], 2)
+        self.assertEqual(operations["convert"]["count"], 2)
+        self.assertIn('find;dur=', timings.server_timing())
+        self.assertIsNone(self.client.timings)
+
+    @tornado.testing.gen_test
+    def test_15_slow_operation_log(self):
+        """Test that slow operations are aggregated by query shape, without their literal values"""
+        slow_settings = dict(settings, slow_operations={"threshold_in_milliseconds": 0})
+        client = BaseAsyncMotorDocument("test_collection", settings=slow_settings)
+        client = client.with_timings(None, handler="StoreHandler")
+
+        id = yield client.insert(dict(self.test_fixture))
+        yield client.find({"attr1": "attr1_val", "date1": {"$gt": 1}})
+        yield client.find({"date1": {"$gt": 2}, "attr1": "other"})
+        yield client.patch(id, {"bool_val": False})
+
+        self.assertEqual(SlowOperationLog.shape({"b": [1, 2], "a": {"$in": [1]}, "$or": [{"c": 1}]}),
+                         {"$or": [{"c": "?"}], "a": {"$in": "?"}, "b": "?"})
+
+        top = client.slow_log.top(n=10, by="count")
+        self.assertEqual(top[0].get("operation"), "find")
+        self.assertEqual(top[0].get("shape"), '{"attr1": "?", "date1": {"$gt": "?"}}')
+        self.assertEqual(top[0].get("count"), 2)
+        self.assertEqual(top[0].get("documents"), 1)
+        self.assertEqual(top[0].get("handlers"), ["StoreHandler"])
+
+        self.assertEqual(sorted(stats.get("operation") for stats in top), ["find", "insert", "update"])
+
+        #The log lives in its settings, copies with their own configuration get their own log
+        self.assertIs(BaseAsyncMotorDocument.get_slow_log(slow_settings), client.slow_log)
+        self.assertIs(slow_settings[BaseAsyncMotorDocument.SLOW_LOG_SETTING], client.slow_log)
+        other_settings = dict(slow_settings, slow_operations={"threshold_in_milliseconds": 500})
+        self.assertEqual(BaseAsyncMotorDocument.get_slow_log(other_settings).threshold, 0.5)
+        self.assertEqual(client.slow_log.threshold, 0)
+
+    @tornado.testing.gen_test
+    def test_16_document_metrics(self):
+        """Test that operations, errors, returned documents and conversions are reported when turned on"""
+        sink = InMemoryMetricsSink()
+        client = BaseAsyncMotorDocument("test_collection",
+                                        settings=dict(settings, metrics_sink=sink, document_metrics=True))
+
+        yield client.insert(dict(self.test_fixture))
+        yield client.insert(dict(self.test_fixture))
+        yield client.find({"attr1": "attr1_val"})
+
+        try:
+            yield client.find_one_by_id("not an object id")
+        except Exception:
+            pass
+
+        tags = {"collection": "test_collection"}
+        self.assertEqual(sink.counter("document_operations_total", dict(tags, operation="insert")), 2)
+        self.assertEqual(sink.counter("document_operations_total", dict(tags, operation="find")), 1)
+        self.assertEqual(sink.counter("document_documents_returned_total", dict(tags, operation="find")), 2)
+        self.assertEqual(sink.counter("document_errors_total", dict(tags, operation="find_one_by_id")), 1)
+        self.assertEqual(sink.counter("document_errors_total", dict(tags, operation="find")), 0)
+        self.assertEqual(sink.histogram("document_operation_seconds", dict(tags, operation="insert")).count, 2)
+        self.assertEqual(sink.histogram("document_conversion_seconds", tags).count, 2)
+
+        #Off by default, or for collections that aren't listed
+        quiet_sink = InMemoryMetricsSink()
+        for config in [{}, {"document_metrics": ["other_collection"]}]:
+            client = BaseAsyncMotorDocument("test_collection",
+                                            settings=dict(settings, metrics_sink=quiet_sink, **config))
+            self.assertIsNone(client.metrics)
+            yield client.find({})
+
+        self.assertEqual(quiet_sink.snapshot()["counters"], {})
+        self.assertEqual(quiet_sink.snapshot()["histograms"], {})
+
+        listed = BaseAsyncMotorDocument("test_collection", settings=dict(settings, metrics_sink=quiet_sink,
+                                                                         document_metrics=["test_collection"]))
+        self.assertIs(listed.metrics, quiet_sink)
+
 class TestAsyncRevisionStackAndManagerFunctions(BaseAsyncTest):
     """ Test the Mongo Client funcitons here"""
     mini_doc = {
@@ -162,6 +453,7 @@ class TestAsyncRevisionStackAndManagerFunctions(BaseAsyncTest):
     def setup_database(self):
         self.collection.collection.drop()
         self.stack.revisions.collection.drop()
+        self.stack.migrated_cache.clear()
         #self.stack.previews.collection.drop()
 
     @tornado.testing.gen_test
@@ -375,3 +667,478 @@ class TestAsyncRevisionStackAndManagerFunctions(BaseAsyncTest):
         #response = yield stack.preview(id)
         list = yield revisions.find({"master_id": master_id})
         self.assertEqual(len(list), 4)
+
+
+    @gen_test
+    def test_stack_preview_replays_from_checkpoints(self):
+        """Test that previews store checkpoints, reuse them, and that earlier revisions invalidate them"""
+        checkpoint_settings = dict(settings)
+        checkpoint_settings["scheduler"] = dict(settings["scheduler"], preview_checkpoint_interval=2)
+
+        master_id = yield self.collection.insert(self.test_fixture)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", checkpoint_settings, master_id=master_id)
+        yield stack.checkpoints.collection.drop()
+
+        for index in range(5):
+            id = yield stack.push({"counter": index}, self.one_min_from_now + index)
+
+        response = yield stack.preview(id)
+        self.assertEqual(response.get("snapshot").get("counter"), 4)
+        self.assertEqual(response.get("snapshot").get("bool_val"), True)
+
+        checkpoints = yield stack.checkpoints.find({"master_id": master_id})
+        self.assertEqual(len(checkpoints), 2)
+
+        response = yield stack.preview(id)
+        self.assertEqual(response.get("snapshot").get("counter"), 4)
+
+        yield stack.push({"counter": -1}, self.one_min_from_now + 2)
+        checkpoints = yield stack.checkpoints.find({"master_id": master_id})
+        self.assertEqual(len(checkpoints), 1)
+
+    @gen_test
+    def test_stack_as_of_reads_past_and_future_states(self):
+        """Test that the stack answers point in time reads from snapshots and previews"""
+        master_id = yield self.collection.insert(self.mini_doc)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", settings, master_id=master_id)
+
+        yield stack.push({test_attr: test_val}, self.three_min_past_now)
+        yield stack.pop()
+        yield stack.push({test_attr: "future"}, self.three_min_ahead_of_now)
+
+        past = yield stack.as_of(self.two_min_past_now)
+        self.assertEqual(past.get(test_attr), test_val)
+
+        before_revisions = yield stack.as_of(self.three_min_past_now - 3600)
+        self.assertIsNone(before_revisions)
+
+        future = yield stack.as_of(self.three_min_ahead_of_now + 1)
+        self.assertEqual(future.get(test_attr), "future")
+
+    @gen_test
+    def test_processed_revisions_store_snapshot_deltas(self):
+        """Test that processed revisions between keyframes store deltas and still read back full snapshots"""
+        master_id = yield self.collection.insert(self.test_fixture)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", settings, master_id=master_id)
+
+        yield stack.push({test_attr: test_val}, self.three_min_past_now)
+        yield stack.push({"sub_document.depth": 2}, self.two_min_past_now)
+        popped = yield stack.pop()
+        popped = yield stack.pop()
+
+        self.assertEqual(popped.get("snapshot").get("sub_document").get("depth"), 2)
+
+        stored = yield stack.revisions.collection.find_one({"_id": ObjectId(popped.get("id"))})
+        self.assertNotIn("snapshot", stored)
+        self.assertIn("snapshot_delta", stored)
+
+        history = yield stack.list(show_history=True)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history[-1].get("snapshot"), popped.get("snapshot"))
+        self.assertEqual(history[-1].get("snapshot").get(test_attr), test_val)
+
+        preview = yield stack.preview(popped.get("id"))
+        self.assertEqual(preview.get("snapshot"), popped.get("snapshot"))
+
+    @gen_test
+    def test_compactor_archives_old_processed_revisions(self):
+        """Test that the compactor keeps the last revisions and the keyframe they need, and archives the rest"""
+        compaction_settings = dict(settings)
+        compaction_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"],
+                                                compaction={"keep_last": 2, "batch_size": 2,
+                                                            "batch_delay_in_milliseconds": 1})
+
+        master_id = yield self.collection.insert(self.test_fixture)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", compaction_settings, master_id=master_id)
+        archive = BaseAsyncMotorDocument("test_fixture_revisions_archive", compaction_settings)
+        yield archive.collection.drop()
+
+        for index, toa in enumerate([self.three_min_past_now, self.two_min_past_now, self.one_min_past_now, self.now]):
+            yield stack.push({"counter": index}, toa)
+            yield stack.pop()
+
+        yield AsyncRevisionCompactor(compaction_settings).compact()
+
+        archived = yield archive.find({"master_id": master_id})
+        self.assertEqual(len(archived), 2)
+
+        history = yield stack.list(show_history=True)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history[-1].get("snapshot").get("counter"), 3)
+
+        #Point in time reads inside the archived range are answered from the archive
+        for toa, counter in [(self.two_min_past_now, 1), (self.one_min_past_now, 2), (self.now, 3)]:
+            document = yield stack.as_of(toa)
+            self.assertEqual(document.get("counter"), counter)
+
+    @gen_test
+    def test_stack_remembers_migrated_master_ids(self):
+        """Test that pushes only look for a legacy migration once per master id, and that the cache can be warmed"""
+        master_id = yield self.collection.insert(self.mini_doc)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", settings, master_id=master_id)
+
+        yield stack.push({test_attr: test_val}, self.one_min_from_now)
+        self.assertIn(master_id, stack.migrated_cache)
+
+        yield stack.push({test_attr: "again"}, self.three_min_ahead_of_now)
+        revisions = yield stack.revisions.find({"master_id": master_id})
+        self.assertEqual(len(revisions), 3)
+
+        stack.migrated_cache.clear()
+        yield stack.warm_migrated_cache()
+        self.assertIn(master_id, stack.migrated_cache)
+
+    def test_schema_validator_registry_compiles_once(self):
+        """Test that validators are compiled once per schema, fast paths fall back and timings are recorded"""
+        registry = SchemaValidatorRegistry()
+        schema = AsyncSchedulableDocumentRevisionStack.SCHEMA
+        registry.register_fast_path(schema, AsyncSchedulableDocumentRevisionStack.is_valid_revision)
+
+        self.assertIs(registry.validator(schema), registry.validator(schema))
+
+        revision = {
+            "toa": self.now,
+            "processed": False,
+            "collection": "test_fixture",
+            "master_id": "52b0ede98ac752b358b1bd69",
+            "action": "update",
+            "patch": {test_attr: test_val},
+            "meta": {}
+        }
+        registry.validate(revision, schema)
+
+        revision["processed"] = "no"
+        self.assertRaises(ValidationError, registry.validate, revision, schema)
+
+        stats = registry.stats()[schema["title"]]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["fast_path_count"], 1)
+
+    def test_stacks_share_collection_clients(self):
+        """Test that stacks on the same collection reuse one set of collection clients"""
+        first = AsyncSchedulableDocumentRevisionStack("test_fixture", settings, master_id="52b0ede98ac752b358b1bd69")
+        second = AsyncSchedulableDocumentRevisionStack("test_fixture", settings, master_id="52b0ede98ac752b358b1bd70")
+
+        self.assertIs(first.collection, second.collection)
+        self.assertIs(first.revisions, second.revisions)
+        self.assertIs(first.previews, second.previews)
+        self.assertIsNot(first.revisions, BaseAsyncMotorDocument.shared("test_fixture_revisions", settings))
+
+        #Clients for copied settings don't pile up
+        for _ in range(BaseAsyncMotorDocument.MAX_SHARED_INSTANCES + 10):
+            BaseAsyncMotorDocument.shared("test_fixture", dict(settings))
+        self.assertEqual(len(BaseAsyncMotorDocument.shared_instances), BaseAsyncMotorDocument.MAX_SHARED_INSTANCES)
+
+    def test_revision_record_decodes_scheduler_fields(self):
+        """Test that the scheduler revision record reads only what it needs from a revision document"""
+        _id = ObjectId()
+        revision = Revision.from_document({
+            "_id": _id,
+            "toa": self.now,
+            "collection": "test_fixture",
+            "master_id": "52b0ede98ac752b358b1bd69",
+            "action": "update",
+            "meta": {"comment": "foo"}
+        })
+
+        self.assertEqual(revision.id, str(_id))
+        self.assertEqual(revision.comment, "foo")
+        self.assertFalse(hasattr(revision, "__dict__"))
+        self.assertEqual(revision.to_dict().get("master_id"), "52b0ede98ac752b358b1bd69")
+
+    @gen_test
+    def test_list_of_revisions_with_limit_and_projection(self):
+        """Test that list can return only the top of the stack, and only some fields"""
+        master_id = yield self.collection.insert(self.test_fixture)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", settings, master_id=master_id)
+        id1 = yield stack.push(self.mini_doc, self.three_min_past_now)
+        yield stack.push(self.mini_doc, self.two_min_past_now)
+
+        revisions = yield stack.list(limit=1, projection={"toa": 1})
+        self.assertEqual(len(revisions), 1)
+        self.assertEqual(revisions[0].get("id"), id1)
+        self.assertIsNone(revisions[0].get("patch"))
+
+    @gen_test
+    def test_stack_push_coalesces_updates_with_the_same_toa(self):
+        """Test that opt in coalescing merges same toa updates into one revision that applies all of them"""
+        master_id = yield self.collection.insert(self.test_fixture)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", settings, master_id=master_id)
+
+        id1 = yield stack.push({test_attr: test_val}, self.three_min_past_now, coalesce=True)
+        id2 = yield stack.push({"baz": "bop", test_attr: "last"}, self.three_min_past_now,
+                               meta={"comment": "second"}, coalesce=True)
+        id3 = yield stack.push({"sub_document.depth": 2}, self.three_min_past_now, coalesce=True)
+        id4 = yield stack.push({"sub_document": {}}, self.three_min_past_now, coalesce=True)
+
+        self.assertEqual(id1, id2)
+        self.assertEqual(id1, id3)
+        self.assertNotEqual(id1, id4)
+
+        revision = yield stack.revisions.find_one_by_id(id1)
+        self.assertEqual(revision.get("meta").get("coalesced_count"), 2)
+        self.assertEqual(revision.get("meta").get("coalesced")[0].get("comment"), "second")
+
+        yield stack.pop()
+        obj = yield self.collection.find_one_by_id(master_id)
+        self.assertEqual(obj.get(test_attr), "last")
+        self.assertEqual(obj.get("baz"), "bop")
+        self.assertEqual(obj.get("sub_document").get("depth"), 2)
+
+    @gen_test
+    def test_scheduler_lease_is_held_by_one_process(self):
+        """Test that only one owner holds a scheduler lease, and that it can be handed over"""
+        leader = AsyncSchedulerLease(settings, "test_fixture", owner="leader")
+        standby = AsyncSchedulerLease(settings, "test_fixture", owner="standby")
+        yield leader.leases.collection.drop()
+
+        acquired = yield leader.acquire()
+        self.assertTrue(acquired)
+
+        acquired = yield standby.acquire()
+        self.assertFalse(acquired)
+
+        renewed = yield leader.acquire()
+        self.assertTrue(renewed)
+
+        yield leader.release()
+        acquired = yield standby.acquire()
+        self.assertTrue(acquired)
+
+    @gen_test
+    def test_standby_manager_does_not_publish(self):
+        """Test that a manager without the lease leaves the revisions alone"""
+        election_settings = dict(settings)
+        election_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"],
+                                              leader_election={"lease_in_seconds": 30})
+
+        master_id = yield self.collection.insert(self.mini_doc)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", election_settings, master_id=master_id)
+        yield stack.push({test_attr: test_val}, self.three_min_past_now)
+
+        leader = AsyncSchedulerLease(election_settings, "test_fixture")
+        yield leader.leases.collection.drop()
+        yield leader.acquire()
+
+        yield AsyncRevisionStackManager(election_settings).publish()
+        revisions = yield stack.list()
+        self.assertEqual(len(revisions), 1)
+
+        yield leader.release()
+        yield AsyncRevisionStackManager(election_settings).publish()
+        revisions = yield stack.list()
+        self.assertEqual(len(revisions), 0)
+
+    @gen_test
+    def test_partitioned_managers_split_the_revisions(self):
+        """Test that managers only publish their partitions, and that partition leases are shared out"""
+        partition_settings = dict(settings)
+        partition_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"], partitions=2,
+                                               leader_election={"lease_in_seconds": 30})
+
+        master_id = yield self.collection.insert(self.mini_doc)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", partition_settings, master_id=master_id)
+        yield stack.push({test_attr: test_val}, self.three_min_past_now)
+
+        partition = AsyncSchedulableDocumentRevisionStack.partition_hash(master_id) % 2
+
+        yield AsyncRevisionStackManager(partition_settings, partitions=[1 - partition]).publish()
+        revisions = yield stack.list()
+        self.assertEqual(len(revisions), 1)
+
+        yield AsyncRevisionStackManager(partition_settings, partitions=[partition]).publish()
+        revisions = yield stack.list()
+        self.assertEqual(len(revisions), 0)
+
+        first = AsyncRevisionStackManager(partition_settings, owner="first")
+        second = AsyncRevisionStackManager(partition_settings, owner="second")
+        yield AsyncSchedulerLease(partition_settings, "test_fixture").leases.collection.drop()
+
+        yield first.publish()
+        yield second.publish()
+        yield first.publish()
+        yield second.publish()
+
+        held = lambda manager: [name for name, lease in manager.leases.items()
+                                if lease.held and not name.startswith("member:")]
+        self.assertEqual(len(held(first)), 1)
+        self.assertEqual(len(held(second)), 1)
+        self.assertNotEqual(held(first), held(second))
+
+        yield first.step_down()
+        yield second.step_down()
+
+    @gen_test
+    def test_partitioned_managers_hold_their_own_member_leases(self):
+        """Test that managers without an owner name register distinct member leases on their first run"""
+        partition_settings = dict(settings)
+        partition_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"], partitions=2,
+                                               leader_election={"lease_in_seconds": 30})
+        yield AsyncSchedulerLease(partition_settings, "test_fixture").leases.collection.drop()
+
+        first = AsyncRevisionStackManager(partition_settings)
+        second = AsyncRevisionStackManager(partition_settings)
+        yield first.publish()
+        yield second.publish()
+
+        members = lambda manager: [name for name, lease in manager.leases.items()
+                                   if lease.held and name.startswith("member:")]
+        self.assertEqual(len(members(first)), 1)
+        self.assertEqual(len(members(second)), 1)
+        self.assertNotEqual(members(first), members(second))
+        self.assertNotIn("member:None", members(first) + members(second))
+
+        yield first.step_down()
+        yield second.step_down()
+
+    @gen_test
+    def test_legacy_revisions_keep_their_master_id_in_order(self):
+        """Test that revisions without a partition hash are backfilled, and pop only applies the claimed top revision"""
+        partition_settings = dict(settings)
+        partition_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"], partitions=2)
+
+        master_id = yield self.collection.insert({"name": "partitioned"})
+        while AsyncSchedulableDocumentRevisionStack.partition_hash(master_id) % 2 == 0:
+            master_id = yield self.collection.insert({"name": "partitioned"})
+
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", partition_settings, master_id=master_id)
+        legacy_id = yield stack.push({test_attr: "first"}, self.three_min_past_now)
+        hashed_id = yield stack.push({test_attr: "second"}, self.two_min_past_now)
+        yield stack.revisions.collection.update({"_id": ObjectId(legacy_id)}, {"$unset": {"partition_hash": ""}})
+
+        revision = yield stack.pop(revision_id=hashed_id)
+        self.assertIsNone(revision)
+        obj = yield self.collection.find_one_by_id(master_id)
+        self.assertNotIn(test_attr, obj)
+
+        yield AsyncRevisionStackManager(partition_settings, partitions=[1]).publish()
+
+        legacy = yield stack.revisions.find_one_by_id(legacy_id)
+        self.assertEqual(legacy.get("partition_hash"), AsyncSchedulableDocumentRevisionStack.partition_hash(master_id))
+        revisions = yield stack.list()
+        self.assertEqual(revisions, [])
+        obj = yield self.collection.find_one_by_id(master_id)
+        self.assertEqual(obj.get(test_attr), "second")
+
+    @gen_test
+    def test_manager_reports_scheduler_metrics(self):
+        """Test that publishing records apply lag, backlog, applies by action and phase timings"""
+        sink = InMemoryMetricsSink()
+        metrics_settings = dict(settings, metrics_sink=sink)
+        metrics_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"])
+
+        master_id = yield self.collection.insert(self.mini_doc)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", metrics_settings, master_id=master_id)
+        yield stack.push({test_attr: test_val}, self.three_min_past_now)
+
+        yield AsyncRevisionStackManager(metrics_settings).publish()
+
+        tags = {"collection": "test_fixture"}
+        self.assertEqual(sink.counter("scheduler_applied_total", dict(tags, action="update")), 1)
+        self.assertEqual(sink.counter("scheduler_failed_total", dict(tags, action="update")), 0)
+        self.assertGreater(sink.rate("scheduler_applied_total", dict(tags, action="update")), 0)
+        self.assertEqual(sink.gauges[sink.key("scheduler_backlog", tags)], 1)
+        self.assertGreaterEqual(sink.histogram("scheduler_apply_lag_seconds", tags).min, 170)
+
+        for phase in ["claim", "apply", "snapshot", "mark"]:
+            self.assertEqual(sink.histogram("scheduler_phase_seconds", dict(tags, phase=phase)).count, 1)
+
+    @gen_test
+    def test_reaper_returns_abandoned_claims_to_the_queue(self):
+        """Test that expired claims are reclaimed, fresh ones are left alone and untimed ones get a timeout"""
+        sink = InMemoryMetricsSink()
+        reaper_settings = dict(settings, metrics_sink=sink)
+        reaper_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"],
+                                            reaper={"claim_timeout_in_seconds": 60, "batch_size": 1,
+                                                    "batch_delay_in_milliseconds": 0})
+
+        master_id = yield self.collection.insert(self.mini_doc)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", reaper_settings, master_id=master_id)
+        expired_id = yield stack.push({test_attr: test_val}, self.three_min_past_now)
+        untimed_id = yield stack.push({"baz": "bop"}, self.three_min_past_now + 1)
+        fresh_id = yield stack.push({"baz": "bip"}, self.three_min_past_now + 2)
+
+        yield stack.revisions.patch(expired_id, {"inProcess": True, "claimed_at": time.time() - 120})
+        yield stack.revisions.patch(untimed_id, {"inProcess": True})
+        yield stack.revisions.patch(fresh_id, {"inProcess": True, "claimed_at": time.time()})
+
+        reclaimed = yield AsyncStaleRevisionReaper(reaper_settings).reap_collection("test_fixture")
+        self.assertEqual(reclaimed, 1)
+        self.assertEqual(sink.counter("scheduler_reclaimed_total", {"collection": "test_fixture"}), 1)
+
+        for revision_id, in_process in [(expired_id, None), (untimed_id, True), (fresh_id, True)]:
+            revision = yield stack.revisions.find_one_by_id(revision_id)
+            self.assertEqual(revision.get("inProcess"), in_process)
+
+        untimed = yield stack.revisions.find_one_by_id(untimed_id)
+        self.assertGreaterEqual(untimed.get("claimed_at"), time.time() - 5)
+
+        #Once the untimed claim is older than the timeout it is reclaimed too
+        yield stack.revisions.patch(untimed_id, {"claimed_at": time.time() - 120})
+        reclaimed = yield AsyncStaleRevisionReaper(reaper_settings).reap_collection("test_fixture")
+        self.assertEqual(reclaimed, 1)
+
+    @gen_test
+    def test_reaper_leaves_claims_that_are_being_applied(self):
+        """Test that pop renews its claim, so a revision that waited longer than the timeout isn't reaped mid apply"""
+        reaper_settings = dict(settings)
+        reaper_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"],
+                                            reaper={"claim_timeout_in_seconds": 60})
+
+        master_id = yield self.collection.insert(self.mini_doc)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", reaper_settings, master_id=master_id)
+        revision_id = yield stack.push({test_attr: test_val}, self.three_min_past_now)
+        yield stack.revisions.patch(revision_id, {"inProcess": True, "claimed_at": time.time() - 120})
+
+        reaped = []
+        patch = stack.collection.patch
+
+        @tornado.gen.coroutine
+        def reaped_patch(*args, **kwargs):
+            reclaimed = yield AsyncStaleRevisionReaper(reaper_settings).reap_collection("test_fixture")
+            reaped.append(reclaimed)
+            response = yield patch(*args, **kwargs)
+            raise tornado.gen.Return(response)
+
+        stack.collection.patch = reaped_patch
+        try:
+            yield stack.pop(revision_id=revision_id)
+        finally:
+            del stack.collection.patch
+
+        self.assertEqual(reaped, [0])
+        revision = yield stack.revisions.find_one_by_id(revision_id)
+        self.assertTrue(revision.get("processed"))
+
+    @gen_test
+    def test_manager_scans_the_due_queue(self):
+        """Test that pushes are queued, backfilled and removed from the due queue as they are published"""
+        due_settings = dict(settings)
+        due_settings["scheduler"] = dict(settings["scheduler"], collections=["test_fixture"])
+
+        master_id = yield self.collection.insert(self.mini_doc)
+        stack = AsyncSchedulableDocumentRevisionStack("test_fixture", due_settings, master_id=master_id)
+        yield stack.due.collection.drop()
+        legacy_id = yield stack.push({test_attr: test_val}, self.three_min_past_now)
+
+        due_settings["scheduler"]["due_queue"] = True
+        queued_id = yield stack.push({"baz": "bop"}, self.three_min_past_now + 1)
+        future_id = yield stack.push({"baz": "bip"}, time.time() + 3600)
+
+        queued = yield stack.due.find({})
+        self.assertEqual(sorted(entry.get("id") for entry in queued), sorted([queued_id, future_id]))
+
+        yield AsyncRevisionStackManager(due_settings).publish()
+
+        indexes = yield stack.due.collection.index_information()
+        self.assertIn([("toa", 1)], [index["key"] for index in indexes.values()])
+
+        obj = yield self.collection.find_one_by_id(master_id)
+        self.assertEqual(obj.get(test_attr), test_val)
+        self.assertEqual(obj.get("baz"), "bop")
+
+        queued = yield stack.due.find({})
+        self.assertEqual([entry.get("id") for entry in queued], [future_id])
+
+        revision = yield stack.revisions.find_one_by_id(legacy_id)
+        self.assertTrue(revision.get("processed"))
@@ -0,0 +1,203 @@
+__author__ = 'hunt3r'
+
+import json
+import logging
+from tornado.testing import AsyncHTTPTestCase
+import tornado.web
+
+from caesium.document import BaseAsyncMotorDocument
+from caesium.handler import BaseMotorSearch, MetricsHandler
+from caesium.metrics import InMemoryMetricsSink, MetricsSink
+from caesium.storage import MemoryStorageBackend
+
+
+class StoreSearch(BaseMotorSearch):
+    """A search handler over the stores collection"""
+
+    def initialize(self):
+        super(StoreSearch, self).initialize()
+        self.client = BaseAsyncMotorDocument("stores", self.settings)
+
+
+class BaseHandlerTest(AsyncHTTPTestCase):
+    """Serves the search and metrics handlers from the in-memory engine, no mongod needed"""
+
+    settings = {}
+
+    def setUp(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.sink = InMemoryMetricsSink()
+        self.storage = MemoryStorageBackend()
+        super(BaseHandlerTest, self).setUp()
+
+    def get_app(self):
+        settings = dict(self.settings, storage=self.storage, metrics_sink=self.sink)
+        return tornado.web.Application([
+            (r"/stores", StoreSearch),
+            (r"/metrics", MetricsHandler)
+        ], **settings)
+
+    def insert_stores(self, *stores):
+        collection = self.storage.collection("stores")
+        for store in stores:
+            collection.insert(dict(store))
+
+    def fetch_json(self, path):
+        response = self.fetch(path)
+        return response.code, json.loads(response.body.decode("utf-8"))
+
+
+class TestBaseMotorSearch(BaseHandlerTest):
+    """Test the search parameters of BaseMotorSearch"""
+
+    def setUp(self):
+        super(TestBaseMotorSearch, self).setUp()
+        self.insert_stores({"name": "a", "region": "east", "page": 1},
+                           {"name": "b", "region": "east", "page": 2},
+                           {"name": "c", "region": "west", "page": 3})
+
+    def test_search_by_attribute(self):
+        code, body = self.fetch_json("/stores?region=east")
+        self.assertEqual(code, 200)
+        self.assertEqual(body["count"], 2)
+        self.assertEqual(sorted(result["name"] for result in body["results"]), ["a", "b"])
+
+    def test_count_only(self):
+        code, body = self.fetch_json("/stores?region=east&countOnly=true")
+        self.assertEqual(body, {"count": 2})
+
+        code, body = self.fetch_json("/stores?countOnly=yes&estimated=true")
+        self.assertEqual(body, {"count": 3})
+
+    def test_limit_and_page(self):
+        code, body = self.fetch_json("/stores?limit=2&page=1")
+        self.assertEqual(code, 200)
+        self.assertEqual(body["count"], 1)
+        self.assertEqual(body["total"], 3)
+        self.assertEqual(body["page"], 1)
+        self.assertEqual(body["limit"], 2)
+
+        code, body = self.fetch_json("/stores?region=west&limit=2")
+        self.assertEqual([result["name"] for result in body["results"]], ["c"])
+        self.assertEqual(body["total"], 1)
+        self.assertEqual(body["page"], 0)
+
+    def test_limit_and_page_must_be_integers(self):
+        code, body = self.fetch_json("/stores?limit=ten")
+        self.assertEqual(code, 400)
+
+        code, body = self.fetch_json("/stores?limit=1&page=last")
+        self.assertEqual(code, 400)
+
+    def test_search_parameters_are_not_queried(self):
+        #A field called page can't be searched on, page only pages the results
+        code, body = self.fetch_json("/stores?page=3")
+        self.assertEqual(body["count"], 3)
+
+        code, body = self.fetch_json("/stores?region=east&limit=5&page=0")
+        self.assertEqual(body["count"], 2)
+
+
+class RecordingLogHandler(logging.Handler):
+    """Keeps the records it is sent"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestServerTiming(BaseHandlerTest):
+    """Test the Server-Timing header and the timing log line of BaseHandler"""
+
+    settings = {"server_timing": True}
+
+    def setUp(self):
+        super(TestServerTiming, self).setUp()
+        self.insert_stores({"name": "a", "region": "east"})
+
+        self.timing_log = RecordingLogHandler()
+        self.timing_logger = logging.getLogger("caesium.timing")
+        self.timing_logger.addHandler(self.timing_log)
+        self.level = self.timing_logger.level
+        self.timing_logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.timing_logger.removeHandler(self.timing_log)
+        self.timing_logger.setLevel(self.level)
+        super(TestServerTiming, self).tearDown()
+
+    def test_header_and_log_line(self):
+        response = self.fetch("/stores?region=east")
+
+        header = response.headers["Server-Timing"]
+        self.assertTrue(header.startswith("total;dur="))
+        self.assertIn("find;dur=", header)
+
+        self.assertEqual(len(self.timing_log.records), 1)
+        line = json.loads(self.timing_log.records[0].getMessage())
+        self.assertEqual(line["method"], "GET")
+        self.assertEqual(line["uri"], "/stores?region=east")
+        self.assertEqual(line["status"], 200)
+        self.assertEqual(line["operations"]["find"]["count"], 1)
+
+
+class TestServerTimingTurnedOff(BaseHandlerTest):
+    """Test that requests get no Server-Timing header without settings["server_timing"]"""
+
+    def test_no_header(self):
+        response = self.fetch("/stores")
+        self.assertEqual(response.code, 200)
+        self.assertNotIn("Server-Timing", response.headers)
+
+
+class TestRequestMetrics(BaseHandlerTest):
+    """Test the request metrics of BaseHandler and their MetricsHandler endpoint"""
+
+    settings = {"document_metrics": ["stores"]}
+
+    def test_requests_are_counted_and_timed(self):
+        self.fetch("/stores")
+        self.fetch("/stores?limit=ten")
+
+        tags = {"handler": "StoreSearch", "method": "GET"}
+        self.assertEqual(self.sink.counter("http_requests_total", dict(tags, status="200")), 1)
+        self.assertEqual(self.sink.counter("http_requests_total", dict(tags, status="400")), 1)
+        self.assertEqual(self.sink.histogram("http_request_duration_seconds", dict(tags, status="200")).count, 1)
+
+    def test_metrics_endpoint(self):
+        self.fetch("/stores")
+
+        response = self.fetch("/metrics")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+
+        lines = response.body.decode("utf-8").splitlines()
+        self.assertIn('http_requests_total{handler="StoreSearch",method="GET",status="200"} 1', lines)
+        self.assertIn("# TYPE document_operation_seconds histogram", lines)
+
+
+class TestRequestMetricsTurnedOff(BaseHandlerTest):
+    """Test that settings["request_metrics"] turns the request metrics off"""
+
+    settings = {"request_metrics": False}
+
+    def test_requests_are_not_recorded(self):
+        self.fetch("/stores")
+        self.assertEqual(self.sink.counter("http_requests_total",
+                                           {"handler": "StoreSearch", "method": "GET", "status": "200"}), 0)
+
+
+class TestMetricsHandlerWithoutScraping(BaseHandlerTest):
+    """Test the metrics endpoint with a sink that keeps nothing to scrape"""
+
+    def get_app(self):
+        return tornado.web.Application([(r"/metrics", MetricsHandler)], storage=self.storage,
+                                       metrics_sink=MetricsSink())
+
+    def test_not_found(self):
+        response = self.fetch("/metrics")
+        self.assertEqual(response.code, 404)
+        self.assertEqual(json.loads(response.body.decode("utf-8"))["status"], 404)
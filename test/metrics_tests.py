@@ -0,0 +1,38 @@
+__author__ = 'hunt3r'
+
+from .base_tests import BaseTest
+from caesium.metrics import InMemoryMetricsSink
+
+
+class TestInMemoryMetricsSink(BaseTest):
+    """Test the in memory metrics sink and its Prometheus output"""
+
+    def setUp(self):
+        super(TestInMemoryMetricsSink, self).setUp()
+        self.sink = InMemoryMetricsSink()
+
+    def test_counters_and_rates(self):
+        self.sink.increment("requests_total", tags={"status": "200"})
+        self.sink.increment("requests_total", 2, tags={"status": "200"})
+
+        self.assertEqual(self.sink.counter("requests_total", {"status": "200"}), 3)
+        self.assertEqual(self.sink.counter("requests_total", {"status": "500"}), 0)
+        self.assertAlmostEqual(self.sink.rate("requests_total", {"status": "200"}), 3 / 60.0)
+
+    def test_prometheus_text_format(self):
+        self.sink.increment("http_requests_total", tags={"handler": "Stores", "status": "200"})
+        self.sink.gauge("scheduler_backlog", 4, {"collection": 'say "hi"'})
+        self.sink.observe("latency_seconds", 0.2)
+        self.sink.observe("latency_seconds", 7)
+
+        lines = self.sink.prometheus().splitlines()
+
+        self.assertIn("# TYPE http_requests_total counter", lines)
+        self.assertIn('http_requests_total{handler="Stores",status="200"} 1', lines)
+        self.assertIn('scheduler_backlog{collection="say \\"hi\\""} 4', lines)
+        self.assertIn("# TYPE latency_seconds histogram", lines)
+        self.assertIn('latency_seconds_bucket{le="0.25"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="10.0"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn("latency_seconds_sum 7.2", lines)
+        self.assertIn("latency_seconds_count 2", lines)
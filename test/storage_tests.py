@@ -0,0 +1,95 @@
+__author__ = 'hunt3r'
+
+import collections
+import time
+from bson import ObjectId
+from tornado.testing import gen_test
+
+from .base_tests import BaseTest, BaseAsyncTest
+from caesium.storage import MemoryStorageBackend, MotorStorageBackend, get_storage_backend, match, _expression
+from caesium.document import AsyncSchedulableDocumentRevisionStack, AsyncRevisionStackManager, BaseAsyncMotorDocument
+
+
+class TestStorageBackendSelection(BaseTest):
+    """Test how the document layer finds its storage backend"""
+
+    def test_storage_setting_wins(self):
+        storage = MemoryStorageBackend()
+        self.assertIs(get_storage_backend({"storage": storage, "db": object()}), storage)
+
+    def test_db_is_wrapped_in_a_motor_backend(self):
+        db = {"stores": "a motor collection"}
+        storage = get_storage_backend({"db": db})
+        self.assertIsInstance(storage, MotorStorageBackend)
+        self.assertEqual(storage.collection("stores"), "a motor collection")
+
+    def test_client_is_the_motor_database(self):
+        db = collections.defaultdict(str)
+        self.assertIs(BaseAsyncMotorDocument("stores", {"db": db}).client, db)
+        self.assertIs(AsyncRevisionStackManager({"db": db}).client, db)
+
+        storage = MemoryStorageBackend()
+        self.assertIs(BaseAsyncMotorDocument("stores", {"storage": storage}).client, storage)
+
+    def test_missing_database_fails_early(self):
+        with self.assertRaises(AssertionError):
+            BaseAsyncMotorDocument("stores", {})
+
+    def test_unicode_field_expressions(self):
+        document = {"region": "east"}
+        self.assertEqual(_expression(document, u"$region"), "east")
+        self.assertEqual(_expression(document, {"region": u"$region", "fixed": u"value"}),
+                         {"region": "east", "fixed": u"value"})
+
+    def test_query_matching(self):
+        document = {"toa": 5, "processed": False, "meta": {"comment": "hi"}, "tags": ["a", "b"]}
+
+        self.assertTrue(match(document, {"toa": {"$lt": 10}, "processed": False, "inProcess": None}))
+        self.assertTrue(match(document, {"meta.comment": "hi", "tags": "a"}))
+        self.assertTrue(match(document, {"$or": [{"toa": 1}, {"toa": {"$in": [4, 5]}}]}))
+        self.assertFalse(match(document, {"toa": {"$gt": "4"}}))
+        self.assertFalse(match(document, {"meta": {"$exists": False}}))
+
+
+class TestMemoryStorageBackend(BaseAsyncTest):
+    """Test the document layer and scheduler against the in-memory engine, no mongod needed"""
+
+    def setUp(self):
+        super(TestMemoryStorageBackend, self).setUp()
+        self.settings = {
+            "storage": MemoryStorageBackend(),
+            "scheduler": {"collections": ["stores"]}
+        }
+
+    @gen_test
+    def test_crud_and_sort(self):
+        client = BaseAsyncMotorDocument("stores", self.settings)
+
+        first = yield client.insert({"name": "b", "rank": 2})
+        yield client.insert({"name": "a", "rank": 1})
+        yield client.patch(first, {"open": True})
+
+        results = yield client.find({}, orderby="rank", order_by_direction=-1)
+        self.assertEqual([result.get("name") for result in results], ["b", "a"])
+        self.assertTrue(results[0].get("open"))
+        self.assertIsInstance(ObjectId(results[0].get("id")), ObjectId)
+
+        yield client.delete(first)
+        count = yield client.count()
+        self.assertEqual(count, 1)
+
+    @gen_test
+    def test_scheduled_update_is_published(self):
+        client = BaseAsyncMotorDocument("stores", self.settings)
+        master_id = yield client.insert({"name": "store"})
+
+        stack = AsyncSchedulableDocumentRevisionStack("stores", self.settings, master_id=master_id)
+        yield stack.push({"name": "renamed"}, time.time() - 60)
+
+        yield AsyncRevisionStackManager(self.settings).publish()
+
+        obj = yield client.find_one_by_id(master_id)
+        self.assertEqual(obj.get("name"), "renamed")
+
+        revisions = yield stack.list()
+        self.assertEqual(revisions, [])